@@ -25,6 +25,8 @@ THE SOFTWARE.
 
 import os
 import sys
+import copy
+import types
 
 # try to import the python2 ConfigParser
 # if unable to import, then try to import the python3 configparser
@@ -64,6 +66,9 @@ def log_settings():
     lines.append("bypass translated search = " + str(bypass_translated_search))
     lines.append("translated search = " + translated_alignment_selected)
     lines.append("threads = " + str(threads))
+    lines.append("memory use = " + memory_use)
+    if memory_use == "auto":
+        lines.append("memory budget = " + str(memory_budget))
     lines.append("")
     
     lines.append("Identity thresholds")
@@ -73,6 +78,10 @@ def log_settings():
     
     lines.append("ALIGNMENT SETTINGS")
     lines.append("bowtie2 options = " + str(" ".join(map(str,bowtie2_align_opts))))
+    lines.append("stream nucleotide alignment = " + stream_nucleotide_alignment_toggle)
+    lines.append("keep sam = " + str(keep_sam))
+    lines.append("bowtie2 unaligned reads = " + bowtie2_unaligned_reads_toggle)
+    lines.append("collapse duplicate reads = " + collapse_duplicate_reads_toggle)
     lines.append("diamond options = " + str(" ".join(map(str,diamond_opts))))
     lines.append("evalue threshold = " + str(evalue_threshold))
     lines.append("prescreen threshold = " + str(prescreen_threshold))
@@ -101,6 +110,27 @@ def log_settings():
     
     logger.info("\nRun config settings: \n\n" + "\n".join(lines))
 
+def copy_settings():
+    """
+    Return a copy of the current config settings
+    This allows settings updated for one sample to be reset before the next sample
+    """
+
+    settings={}
+    for name, value in globals().items():
+        if name.startswith("_") or isinstance(value, (types.ModuleType, types.FunctionType, logging.Logger)):
+            continue
+        settings[name]=copy.deepcopy(value)
+
+    return settings
+
+def restore_settings(settings):
+    """
+    Restore the config settings from a copy
+    """
+
+    globals().update(copy.deepcopy(settings))
+
 # User config file
 user_edit_config_file="humann.cfg"
 
@@ -268,6 +298,15 @@ translated_query_coverage_threshold=get_item(config_items, "alignment_settings",
 nucleotide_subject_coverage_threshold=get_item(config_items, "alignment_settings", "nucleotide_subject_coverage_threshold", "float")
 nucleotide_query_coverage_threshold=get_item(config_items, "alignment_settings", "nucleotide_query_coverage_threshold", "float")
 
+# the number of ranges hit in a protein (or gene) before the overlapping ranges are merged
+coverage_ranges_merge_size=1024
+
+# the number of alignments passing the filters stored in memory before they are written to a temp file
+filtered_alignments_max=1000000
+
+# the size (in bytes) of the data copied at a time when writing the unaligned reads from their records
+read_records_copy_size=1024**2
+
 # output file decimal places
 output_max_decimals=get_item(config_items, "output_format", "output_max_decimals", "int")
     
@@ -313,10 +352,46 @@ sgb_to_species_file=os.path.abspath(os.path.join(utility_mapping_database,"vOct2
 # query annotation
 query_length_annotation_delimiter="|"
 
+# batch manifest formats
+batch_manifest_comment_indicator="#"
+batch_manifest_delimiter="\t"
+
+# server mode (jobs are batch manifests added to the queue folder)
+serve_job_extension=".job"
+serve_running_extension=".running"
+serve_done_extension=".done"
+serve_failed_extension=".failed"
+serve_stop_file="stop"
+serve_poll_seconds=5
+
+# stage manifests (used to check if a stage can be bypassed with resume)
+stage_manifest_extension=".manifest"
+stage_fingerprint_block_size=65536
+# the file fingerprints are cached by the file size, modification time, and inode
+stage_fingerprint_cache_name="stage_fingerprints.json"
+stage_fingerprint_cache_seconds=2
+stage_fingerprint_cache_file=""
+stage_fingerprint_cache={}
+
+# performance report (written next to the log file)
+performance_report_name="_performance.json"
+performance_stages=[]
+performance_usage={}
+performance_child_peak_rss_kb=0
+performance_peak_reset=False
+
 # memory use
-memory_use_options=["minimum","maximum"]
+memory_use_options=["minimum","maximum","auto"]
 memory_use=memory_use_options[0]
 
+# the memory (in GB) for the auto memory use mode, past which the alignments
+# and reads stored are written to temp files (checked after each set of additions)
+memory_budget=16.0
+memory_budget_check_additions=100000
+
+# the alignments in the temp file (for minimum memory use) are read in sets of records
+temp_alignments_records_per_read=65536
+
 # log options
 log_level_choices=["DEBUG","INFO","WARNING","ERROR","CRITICAL"]
 log_level=log_level_choices[0]
@@ -327,6 +402,10 @@ xipe_toggle = "off"
 minpath_toggle = "on"
 gap_fill_toggle = "on"
 pick_frames_toggle = "off"
+stream_nucleotide_alignment_toggle = "off"
+bowtie2_unaligned_reads_toggle = "off"
+collapse_duplicate_reads_toggle = "off"
+keep_sam = False
 
 # normalization options
 count_normalization_choices=["Adjusted CPMs","Adjusted RPKs","RPKs","Counts"]
@@ -335,7 +414,13 @@ count_normalization=count_normalization_choices[0]
 # file format
 output_format_choices=["tsv", "biom"]
 output_format=output_format_choices[0]
-input_format_choices=["fastq","fastq.gz","fasta","fasta.gz","sam","bam","blastm8","genetable","biom"]
+input_format_choices=["fastq","fastq.gz","fastq.bz2","fasta","fasta.gz","fasta.bz2","sam","bam","blastm8","genetable","biom"]
+
+# compressed input files are read directly (decompressed in parallel if the software is installed)
+compressed_extensions=[".gz",".bz2"]
+parallel_decompression_commands={".gz": [["pigz","-dc"]], ".bz2": [["lbzip2","-dc"],["pbzip2","-dc"]]}
+# the formats which are read directly when compressed (others are decompressed to a temp file)
+compressed_input_formats=["fastq","fasta","sam","blastm8"]
 input_format=""
 
 # translated alignment options
@@ -347,9 +432,14 @@ temp_dir=""
 unnamed_temp_dir=""
 file_basename=""
 fasta_extension=".fa"
+fastq_extension=".fq"
 
 metaphlan_bowtie2_name="_metaphlan_bowtie2.txt"
 
+collapsed_reads_name_no_ext="_collapsed_reads"
+# the temp files the reads are split into to collapse duplicates with minimum memory use
+collapse_duplicate_reads_partitions=16
+
 chocophlan_custom_database_name="_custom_chocophlan_database.ffn"
 bowtie2_index_name="_bowtie2_index"
 chocophlan_alignment_name="_bowtie2_aligned.sam"
@@ -357,6 +447,7 @@ chocophlan_alignment_name="_bowtie2_aligned.sam"
 nucleotide_unaligned_reads_name_no_ext="_bowtie2_unaligned"
 nucleotide_unaligned_reads_picked_frames_name_no_ext="_bowtie2_unaligned_picked_frames"
 nucleotide_aligned_reads_name_tsv="_bowtie2_aligned.tsv"
+nucleotide_aligner_unaligned_reads_name_no_ext="_bowtie2_no_alignments"
 
 translated_alignment_name="_aligned.tsv"
 translated_unaligned_reads_name_no_ext="_unaligned"
@@ -396,6 +487,9 @@ chocophlan_location_extra_characters="[:|c]"
 chocophlan_multiple_location_delimiter=","
 chocophlan_length_index=4
 
+# the maximum number of reference annotations stored once processed
+reference_annotations_max=1000000
+
 # uniref formatting
 uniref_delimiter="|"
 uniref_gene_index=-2
@@ -434,6 +528,15 @@ sam_delimiter="\t"
 sam_cigar_match_mismatch_indel_identifiers=["M","=","X","I","D"]
 sam_cigar_add_to_reference_identifiers=["M","D","N","=","X"]
 sam_md_field_identifier="MD:Z:"
+# the maximum number of cigar strings to store the lengths computed
+cigar_lengths_max=100000
+
+# bam files are read in sets of blocks decompressed by each thread
+bam_blocks_per_thread=16
+
+# sam files are parsed in chunks (of bytes) by each thread
+sam_chunk_size=4*1024**2
+sam_chunks_per_thread=2
 
 #set the locations of data in a tabulated blast formatted file
 # all translated alignment files will be of the tabulated blast format
@@ -448,6 +551,8 @@ blast_subject_start_index=8
 blast_subject_end_index=9
 blast_evalue_index=10
 blast_total_columns=12
+# the query length is included by diamond as an extra column
+blast_query_length_index=12
 
 # output file formats
 output_file_column_delimiter="\t"
@@ -468,6 +573,8 @@ id_mapping_reference_index=0
 id_mapping_gene_index=1
 id_mapping_gene_length_index=2
 id_mapping_bug_index=3
+# the first line of the reference tables written by humann_reference_table
+reference_table_marker="# humann_reference_table"
 
 # usearch options
 usearch_database_extension=".udb"
@@ -496,8 +603,13 @@ diamond_database_extension=".dmnd"
 diamond_options_custom=False
 diamond_opts_uniref50=["--top","1","--sensitive","--outfmt","6"]
 diamond_opts_uniref90=["--top","1","--sensitive","--outfmt","6"]
+# the columns of the tabular output format with the query length added
+diamond_outfmt_fields=["qseqid","sseqid","pident","length","mismatch","gapopen",
+    "qstart","qend","sstart","send","evalue","bitscore","qlen"]
 diamond_cmmd_protein_search="blastp"
 diamond_cmmd_nucleotide_search="blastx"
+# the minimum number of threads for each database shard aligned concurrently
+diamond_min_threads_per_shard=4
 diamond_version={
     "flag" : "--version",
     "major" : 2,
@@ -51,7 +51,9 @@ import os
 import time
 import tempfile
 import re
+import copy
 import logging  
+import traceback
 
 from . import config
 from . import store
@@ -79,18 +81,35 @@ def parse_arguments(args):
         formatter_class=argparse.RawTextHelpFormatter,
         prog="humann")
 
+    # the input and output are provided in the manifest when running in batch or server mode
+    batch_mode=any(arg.startswith("--batch") or arg.startswith("--serve") for arg in args)
+
     common_settings=parser.add_argument_group("[0] Common settings")
 
     common_settings.add_argument(
         "-i", "--input", 
         help="input file of type {" +",".join(config.input_format_choices)+ "} \n[REQUIRED]", 
         metavar="<input.fastq>", 
-        required=True)
+        required=not batch_mode)
     common_settings.add_argument(
         "-o", "--output", 
         help="directory to write output files\n[REQUIRED]", 
         metavar="<output>", 
-        required=True)
+        required=not batch_mode)
+    common_settings.add_argument(
+        "--batch", 
+        help="tab-delimited manifest of samples to run in a single process\n" +
+            "each line contains an input file and, optionally, an output directory\n" +
+            "and an output basename (the databases are loaded once for all samples)\n" +
+            "[DEFAULT: run the single input file]", 
+        metavar="<manifest.tsv>")
+    common_settings.add_argument(
+        "--serve", 
+        help="folder to watch for jobs to run while keeping the databases loaded\n" +
+            "each job is a manifest, in the batch format, written with the extension " + config.serve_job_extension + "\n" +
+            "write a file named " + config.serve_stop_file + " to the folder to stop the server once the queue is empty\n" +
+            "[DEFAULT: run the single input file]", 
+        metavar="<queue_folder>")
     common_settings.add_argument(
         "--threads", 
         help="number of threads/processes\n[DEFAULT: " + str(config.threads) + "]", 
@@ -106,7 +125,7 @@ def parse_arguments(args):
 
     workflow_refinement.add_argument(
         "-r","--resume", 
-        help="bypass commands if the output files exist\n", 
+        help="bypass commands if the output files exist and match the inputs and settings\n", 
         action="store_true",
         default=config.resume)
     workflow_refinement.add_argument(
@@ -139,6 +158,42 @@ def parse_arguments(args):
         config.memory_use + "]",
         default=config.memory_use,
         choices=config.memory_use_options)
+    workflow_refinement.add_argument(
+        "--memory-budget",
+        help="the memory (in GB) to use with the auto memory use mode before\n" +
+        "writing the alignments and reads stored to temp files\n[DEFAULT: " +
+        str(config.memory_budget) + "]",
+        metavar="<" + str(config.memory_budget) + ">",
+        type=float,
+        default=config.memory_budget)
+    workflow_refinement.add_argument(
+        "--stream-nucleotide-alignment",
+        help="turn on/off streaming the bowtie2 alignments directly into post-processing\n" +
+        "(the sam file is not written unless --keep-sam is set)\n[DEFAULT: " +
+        config.stream_nucleotide_alignment_toggle + "]",
+        default=config.stream_nucleotide_alignment_toggle,
+        choices=config.toggle_choices)
+    workflow_refinement.add_argument(
+        "--bowtie2-unaligned-reads",
+        help="turn on/off having bowtie2 write the unaligned reads to a file\n" +
+        "(the unaligned reads are not included in the sam file)\n[DEFAULT: " +
+        config.bowtie2_unaligned_reads_toggle + "]",
+        default=config.bowtie2_unaligned_reads_toggle,
+        choices=config.toggle_choices)
+    workflow_refinement.add_argument(
+        "--collapse-duplicate-reads",
+        help="turn on/off aligning each duplicate read sequence once\n" +
+        "(the alignments are weighted by the copies of the read)\n" +
+        "(a digest of each unique sequence is stored in memory, with\n" +
+        "minimum memory use the reads are split into temp files first)\n[DEFAULT: " +
+        config.collapse_duplicate_reads_toggle + "]",
+        default=config.collapse_duplicate_reads_toggle,
+        choices=config.toggle_choices)
+    workflow_refinement.add_argument(
+        "--keep-sam",
+        help="write the sam file when streaming the nucleotide alignment\n",
+        action="store_true",
+        default=config.keep_sam)
     workflow_refinement.add_argument(
         "--input-format",
         help="the format of the input file\n[DEFAULT: format identified by software]",
@@ -480,6 +535,14 @@ def update_configuration(args):
     
     # Update memory use
     config.memory_use=args.memory_use
+    config.memory_budget=args.memory_budget
+    
+    # Update the nucleotide alignment streaming settings
+    config.stream_nucleotide_alignment_toggle=args.stream_nucleotide_alignment
+    config.bowtie2_unaligned_reads_toggle=args.bowtie2_unaligned_reads
+    config.collapse_duplicate_reads_toggle=args.collapse_duplicate_reads
+    if args.keep_sam:
+        config.keep_sam=True
     
     # Update threads
     config.threads=args.threads
@@ -533,8 +596,8 @@ def update_configuration(args):
     else:
         # Determine the basename of the input file to use as output file basename
         input_file_basename=os.path.basename(args.input)
-        # Remove gzip extension if present
-        if re.search('.gz$',input_file_basename):
+        # Remove gzip or bzip2 extension if present
+        if utilities.compressed_extension(input_file_basename):
             input_file_basename='.'.join(input_file_basename.split('.')[:-1])
         # Remove input file extension if present
         if '.' in input_file_basename:
@@ -584,6 +647,11 @@ def update_configuration(args):
     if args.o_log:
         log_file=args.o_log
         
+    # remove the handlers for a prior sample (batch mode) so messages are written to this log file
+    for handler in logging.root.handlers[:]:
+        logging.root.removeHandler(handler)
+        handler.close()
+
     # configure the logger
     logging.basicConfig(filename=log_file,format='%(asctime)s - %(name)s - %(levelname)s: %(message)s',
         level=getattr(logging,args.log_level), filemode='w', datefmt='%m/%d/%Y %I:%M:%S %p')
@@ -650,16 +718,19 @@ def check_requirements(args):
     
     config.input_format = args.input_format
         
-    # If the input file is compressed, then decompress
-    if args.input_format.endswith(".gz"):
-        new_file=utilities.gunzip_file(args.input)
-        
-        if new_file:
-            args.input=new_file
-            args.input_format=args.input_format.split(".")[0]
-        else:
-            sys.exit("CRITICAL ERROR: Unable to use gzipped input file. " + 
-                " Please check the format of the input file.")
+    # If the input file is compressed, then read directly or decompress (for formats not read directly)
+    compression=utilities.compressed_extension(args.input_format)
+    if compression:
+        args.input_format=args.input_format.split(".")[0]
+        if not args.input_format in config.compressed_input_formats or \
+            utilities.compressed_extension(args.input) != compression:
+            new_file=utilities.gunzip_file(args.input)
+            
+            if new_file:
+                args.input=new_file
+            else:
+                sys.exit("CRITICAL ERROR: Unable to use compressed input file. " + 
+                    " Please check the format of the input file.")
             
     # check if the input file has sequence identifiers of the new illumina casava v1.8+ format
     # these have spaces causing the paired end reads to have the same identifier after
@@ -676,22 +747,6 @@ def check_requirements(args):
             else:
                 sys.exit("CRITICAL ERROR: Unable to remove spaces from identifiers in input file.")
             
-    # If the input format is in binary then convert to sam (tab-delimited text)
-    if args.input_format == "bam":
-        
-        # Check for the samtools software
-        if not utilities.find_exe_in_path("samtools"):
-            sys.exit("CRITICAL ERROR: The samtools executable can not be found. "
-            "Please check the install or select another input format.")
-        
-        new_file=utilities.bam_to_sam(args.input)
-        
-        if new_file:
-            args.input=new_file
-            args.input_format="sam"
-        else:
-            sys.exit("CRITICAL ERROR: Unable to convert bam input file to sam.")
-
     # If the input format is in biom then convert to tsv
     if args.input_format == "biom":
         
@@ -893,23 +948,69 @@ def check_requirements(args):
     config.nucleotide_identity_threshold=args.nucleotide_identity_threshold
     config.identity_threshold=args.identity_threshold
 
-def timestamp_message(task, start_time):
+def timestamp_message(task, start_time, counts=None):
     """
     Print and log a message about the task completed and the time
     Log messages are tab delimited for quick task/time access with awk
+    Record the performance of the task for the report
     Return the new start time
     """
+    end_time=time.time()
     message="TIMESTAMP: Completed \t" + task + " \t:\t " + \
-        str(int(round(time.time() - start_time))) + "\t seconds"
+        str(int(round(end_time - start_time))) + "\t seconds"
     logger.info(message)
     if config.verbose:
         print("\n"+message.replace("\t","")+"\n")   
         
+    usage=utilities.resource_usage()
+    config.performance_stages.append(utilities.performance_stage(task, end_time - start_time,
+        config.performance_usage, usage, counts))
+    config.performance_usage=usage
+    utilities.reset_peak_memory()
+        
     return time.time() 
+
+def alignment_counts(alignments, unaligned_reads_store):
+    """
+    Return the counts of the alignments and unaligned reads for the performance report
+    """
+    
+    return {"alignments": alignments.count_hits(), "bugs": alignments.count_bugs(),
+        "genes": alignments.count_genes(), "unaligned_reads": unaligned_reads_store.count_reads()}
               
-def main():
-    # Parse arguments from command line
-    args=parse_arguments(sys.argv)
+def load_databases():
+    """
+    Load the reactions and pathways databases plus the pathway names
+    """
+    
+    # Load in the reactions database
+    reactions_database=None
+    if config.pathways_database_part1:
+        reactions_database=store.ReactionsDatabase(config.pathways_database_part1)
+    
+        message="Load pathways database part 1: " + config.pathways_database_part1
+        logger.info(message)
+    
+    # Load in the pathways database
+    pathways_database=store.PathwaysDatabase(config.pathways_database_part2, reactions_database)
+    
+    if config.pathways_database_part1:
+        message="Load pathways database part 2: " + config.pathways_database_part2
+    else:
+        message="Load pathways database: " + config.pathways_database_part2
+    logger.info(message)
+    
+    # Load in the pathway id to name mappings
+    pathway_names=store.Names(config.pathway_name_mapping_file)
+    
+    return reactions_database, pathways_database, pathway_names
+
+def run_sample(args, databases=None):
+    """
+    Run the workflow for a single input file
+    Load the databases if they are not provided
+    Return the databases so they can be reused for the next sample
+    """
     
     # Update the configuration settings based on the arguments
     log_file=update_configuration(args)
@@ -922,36 +1023,39 @@ def main():
 
     # Initialize alignments and gene scores
     minimize_memory_use=True
+    memory_budget=None
     if config.memory_use == "maximum":
         minimize_memory_use=False
+    elif config.memory_use == "auto":
+        minimize_memory_use=False
+        memory_budget=config.memory_budget
         
-    alignments=store.Alignments(minimize_memory_use=minimize_memory_use)
-    unaligned_reads_store=store.Reads(minimize_memory_use=minimize_memory_use)
+    # with minimum memory use the hits are normalized as the alignments for each query are added
+    # (a hash of each query is kept, so the memory used still grows with the reads aligned)
+    # the stores share the query ids so the name of each read is only stored once
+    query_ids=store.QueryIds()
+    alignments=store.Alignments(minimize_memory_use=minimize_memory_use, memory_budget=memory_budget,
+        grouped_queries=config.memory_use == "minimum", query_ids=query_ids)
+    unaligned_reads_store=store.Reads(minimize_memory_use=minimize_memory_use, memory_budget=memory_budget,
+        query_ids=query_ids)
     gene_scores=store.GeneScores()
     
     # If id mapping is provided then process
     if args.id_mapping:
         alignments.process_id_mapping(args.id_mapping)
     
-    # Load in the reactions database
-    reactions_database=None
-    if config.pathways_database_part1:
-        reactions_database=store.ReactionsDatabase(config.pathways_database_part1)
-    
-        message="Load pathways database part 1: " + config.pathways_database_part1
-        logger.info(message)
-    
-    # Load in the pathways database
-    pathways_database=store.PathwaysDatabase(config.pathways_database_part2, reactions_database)
-    
-    if config.pathways_database_part1:
-        message="Load pathways database part 2: " + config.pathways_database_part2
+    # Load in the reactions and pathways databases if not already loaded
+    if databases is None:
+        databases=load_databases()
     else:
-        message="Load pathways database: " + config.pathways_database_part2
-    logger.info(message)
+        logger.info("Using the pathways databases loaded for a prior sample")
+    reactions_database, pathways_database, pathway_names = databases
 
-    # Start timer
+    # Start timer and the performance report
     start_time=time.time()
+    config.performance_stages=[]
+    utilities.reset_peak_memory()
+    config.performance_usage=utilities.resource_usage()
 
     # Process fasta or fastq input files
     output_files=[]
@@ -974,6 +1078,20 @@ def main():
         else:
             custom_database = "Bypass"
     
+        # Collapse the duplicate reads so each sequence is aligned once
+        alignment_input=args.input
+        if config.collapse_duplicate_reads_toggle == "on" and not (config.bypass_nucleotide_search
+            and config.bypass_translated_search):
+            message="Collapsing duplicate reads ..."
+            logger.info(message)
+            print("\n"+message)
+            alignment_input, total_reads, unique_reads = utilities.collapse_duplicate_reads(args.input, query_ids,
+                minimize_memory_use=minimize_memory_use, memory_budget=memory_budget)
+            message="Unique reads: " + str(unique_reads) + " of " + str(total_reads)
+            logger.info(message)
+            print(message)
+            start_time=timestamp_message("collapsing duplicate reads",start_time)
+    
         # Run nucleotide search on custom database
         if custom_database != "Empty" and not config.bypass_nucleotide_search:
             if not config.bypass_nucleotide_index:
@@ -982,17 +1100,27 @@ def main():
             else:
                 nucleotide_index_file = nucleotide.find_index(config.nucleotide_database)
                 
-            nucleotide_alignment_file = nucleotide.alignment(args.input, 
-                nucleotide_index_file)
-    
-            start_time=timestamp_message("nucleotide alignment",start_time)
-    
-            # Determine which reads are unaligned and reduce aligned reads file
-            # Remove the alignment_file as we only need the reduced aligned reads file
-            [ unaligned_reads_file_fasta, reduced_aligned_reads_file ] = nucleotide.unaligned_reads(
-                nucleotide_alignment_file, alignments, unaligned_reads_store, keep_sam=True)
-            
-            start_time=timestamp_message("nucleotide alignment post-processing",start_time)
+            if config.stream_nucleotide_alignment_toggle == "on":
+                # Process the alignments as they are written by bowtie2
+                [ unaligned_reads_file_fasta, reduced_aligned_reads_file ] = nucleotide.alignment_unaligned_reads_stream(
+                    alignment_input, nucleotide_index_file, alignments, unaligned_reads_store, keep_sam=config.keep_sam)
+                
+                start_time=timestamp_message("nucleotide alignment and post-processing",start_time,
+                    alignment_counts(alignments, unaligned_reads_store))
+            else:
+                nucleotide_alignment_file = nucleotide.alignment(alignment_input, 
+                    nucleotide_index_file)
+        
+                start_time=timestamp_message("nucleotide alignment",start_time)
+        
+                # Determine which reads are unaligned and reduce aligned reads file
+                # Remove the alignment_file as we only need the reduced aligned reads file
+                [ unaligned_reads_file_fasta, reduced_aligned_reads_file ] = nucleotide.unaligned_reads(
+                    nucleotide_alignment_file, alignments, unaligned_reads_store, keep_sam=True,
+                    aligner_unaligned_reads=nucleotide.aligner_unaligned_reads_file(alignment_input))
+                
+                start_time=timestamp_message("nucleotide alignment post-processing",start_time,
+                    alignment_counts(alignments, unaligned_reads_store))
     
             # Print out total alignments per bug
             message="Total bugs from nucleotide alignment: " + str(alignments.count_bugs())
@@ -1015,8 +1143,9 @@ def main():
         else:
             logger.debug("Custom database is empty")
             reduced_aligned_reads_file = "Empty"
-            unaligned_reads_file_fasta=args.input
-            unaligned_reads_store=store.Reads(unaligned_reads_file_fasta, minimize_memory_use=minimize_memory_use)
+            unaligned_reads_file_fasta=alignment_input
+            unaligned_reads_store=store.Reads(unaligned_reads_file_fasta, minimize_memory_use=minimize_memory_use,
+                memory_budget=memory_budget, query_ids=query_ids)
     
         # Do not run if set to bypass translated search in config file
         if not config.bypass_translated_search:
@@ -1031,7 +1160,8 @@ def main():
                 translated_unaligned_reads_file_fastq = translated.unaligned_reads(
                     unaligned_reads_store, translated_alignment_file, alignments)
                 
-                start_time=timestamp_message("translated alignment post-processing",start_time)
+                start_time=timestamp_message("translated alignment post-processing",start_time,
+                    alignment_counts(alignments, unaligned_reads_store))
         
                 # Print out total alignments per bug
                 message="Total bugs after translated alignment: " + str(alignments.count_bugs())
@@ -1061,17 +1191,22 @@ def main():
             print(message)
     
     # Process input files of sam format
-    elif args.input_format in ["sam"]:
+    elif args.input_format in ["sam","bam"]:
         
         # Store the sam mapping results
-        message="Process the sam mapping results ..."
+        message="Process the " + args.input_format + " mapping results ..."
         logger.info(message)
         print("\n"+message)
             
-        [unaligned_reads_file_fasta, reduced_aligned_reads_file] = nucleotide.unaligned_reads(
-            args.input, alignments, unaligned_reads_store, keep_sam=True)
+        if args.input_format == "bam":
+            [unaligned_reads_file_fasta, reduced_aligned_reads_file] = nucleotide.unaligned_reads_from_bam(
+                args.input, alignments, unaligned_reads_store)
+        else:
+            [unaligned_reads_file_fasta, reduced_aligned_reads_file] = nucleotide.unaligned_reads(
+                args.input, alignments, unaligned_reads_store, keep_sam=True)
         
-        start_time=timestamp_message("alignment post-processing",start_time)
+        start_time=timestamp_message("alignment post-processing",start_time,
+            alignment_counts(alignments, unaligned_reads_store))
             
     # Process input files of tab-delimited blast format
     elif args.input_format in ["blastm8"]:
@@ -1084,7 +1219,8 @@ def main():
         translated_unaligned_reads_file_fastq = translated.unaligned_reads(
             unaligned_reads_store, args.input, alignments)
         
-        start_time=timestamp_message("alignment post-processing",start_time)
+        start_time=timestamp_message("alignment post-processing",start_time,
+            alignment_counts(alignments, unaligned_reads_store))
         
     # Get the number of remaining unaligned reads
     unaligned_reads_count=unaligned_reads_store.count_reads()
@@ -1093,7 +1229,7 @@ def main():
     unaligned_reads_store.clear()
         
     # Compute or load in gene families
-    if args.input_format in ["fasta","fastq","sam","blastm8"]:
+    if args.input_format in ["fasta","fastq","sam","bam","blastm8"]:
         # Compute the gene families
         message="Computing gene families ..."
         logger.info(message)
@@ -1102,7 +1238,8 @@ def main():
         families_file=families.gene_families(alignments,gene_scores,unaligned_reads_count)
         output_files.append(families_file)
     
-        start_time=timestamp_message("computing gene families",start_time)
+        start_time=timestamp_message("computing gene families",start_time,
+            {"genes": len(gene_scores.gene_list())})
 
     elif args.input_format in ["genetable"]:
         # Load the gene scores
@@ -1112,7 +1249,8 @@ def main():
         
         unaligned_reads_count=gene_scores.add_from_file(args.input,id_mapping_file=args.id_mapping) 
         
-        start_time=timestamp_message("processing gene table",start_time)
+        start_time=timestamp_message("processing gene table",start_time,
+            {"genes": len(gene_scores.gene_list())})
 
     # Handle input files of unknown formats
     else:
@@ -1130,13 +1268,20 @@ def main():
 
     # Compute pathway abundance and coverage
     abundance_file, coverage_file, reaction_file=modules.compute_pathways_abundance_and_coverage(
-        gene_scores, reactions_database, pathways_and_reactions_store, pathways_database, unaligned_reads_count)
+        gene_scores, reactions_database, pathways_and_reactions_store, pathways_database, unaligned_reads_count,
+        pathway_names=pathway_names)
     output_files.append(reaction_file)
     output_files.append(abundance_file)
     output_files.append(log_file)
     #output_files.append(coverage_file)
 
-    start_time=timestamp_message("computing pathways",start_time)
+    start_time=timestamp_message("computing pathways",start_time,
+        {"pathways": pathways_and_reactions_store.count_pathways("all")})
+    
+    # Write the performance report next to the log file
+    performance_report=os.path.splitext(log_file)[0]+config.performance_report_name
+    utilities.write_performance_report(performance_report, VERSION, args.input, config.performance_stages)
+    output_files.append(performance_report)
 
     message="\nOutput files created: \n" + "\n".join(output_files) + "\n"
     logger.info(message)
@@ -1148,4 +1293,176 @@ def main():
     # Remove named temp directory
     if args.remove_temp_output:
         utilities.remove_directory(config.temp_dir)
+
+    return databases
+
+def read_batch_manifest(manifest_file, default_output=None):
+    """
+    Read the batch manifest, returning the input, output directory, and basename for each sample
+    Each line contains the input file and, optionally, the output directory and basename
+    """
+    
+    utilities.file_exists_readable(manifest_file)
+    
+    manifest_folder=os.path.dirname(os.path.abspath(manifest_file))
+    samples=[]
+    with open(manifest_file,"rt") as file_handle:
+        for line in file_handle:
+            if not line.strip() or line.startswith(config.batch_manifest_comment_indicator):
+                continue
+            
+            data=line.rstrip("\r\n").split(config.batch_manifest_delimiter)
+            input_file=data[0].strip()
+            output_folder=data[1].strip() if len(data) > 1 else ""
+            basename=data[2].strip() if len(data) > 2 else ""
+            
+            if not output_folder:
+                output_folder=default_output
+            if not output_folder:
+                sys.exit("CRITICAL ERROR: An output directory is not provided for batch input file: " + input_file +
+                    ". Please add the output directory to the manifest or provide it with the --output option.")
+            
+            # paths relative to the manifest are allowed
+            if not os.path.isabs(input_file):
+                input_file=os.path.join(manifest_folder,input_file)
+            
+            samples.append((input_file, output_folder, basename))
+    
+    if not samples:
+        sys.exit("CRITICAL ERROR: No samples found in batch manifest: " + manifest_file)
+    
+    return samples
+
+def run_samples(args, samples, databases=None):
+    """
+    Run the workflow for each of the samples, reusing the databases loaded
+    Return the databases and the input files of the samples that failed
+    """
+    
+    # record the settings so they can be reset after each sample
+    default_settings=config.copy_settings()
+    
+    failed_samples=[]
+    for sample_number, (input_file, output_folder, basename) in enumerate(samples):
+        print("\nRunning batch sample " + str(sample_number+1) + " of " + str(len(samples)) + ": " + input_file)
+        
+        config.restore_settings(default_settings)
         
+        sample_args=copy.copy(args)
+        sample_args.input=input_file
+        sample_args.output=output_folder
+        sample_args.output_basename=basename
+        sample_args.o_log=None
+        
+        try:
+            databases=run_sample(sample_args, databases)
+        except (SystemExit, Exception) as error:
+            # record the failure and continue with the remaining samples
+            message="Unable to run batch sample " + input_file + " : " + str(error)
+            logger.critical(message)
+            if not isinstance(error, SystemExit):
+                logger.critical("TRACEBACK: \n" + traceback.format_exc())
+            print(message)
+            failed_samples.append(input_file)
+            config.restore_settings(default_settings)
+    
+    config.restore_settings(default_settings)
+    
+    message="Batch samples completed: " + str(len(samples)-len(failed_samples)) + " of " + str(len(samples))
+    print("\n"+message)
+    
+    return databases, failed_samples
+
+def run_batch(args):
+    """
+    Run the workflow for all samples in the batch manifest
+    The databases are loaded once and then reused for all samples
+    """
+    
+    samples=read_batch_manifest(args.batch, args.output)
+    
+    databases, failed_samples=run_samples(args, samples)
+    
+    if failed_samples:
+        sys.exit("CRITICAL ERROR: Unable to run batch samples: \n" + "\n".join(failed_samples))
+
+def claim_server_job(queue_folder):
+    """
+    Return the next job in the queue folder, renamed so it is not claimed again
+    Return None if there are no jobs waiting
+    """
+    
+    for file in sorted(os.listdir(queue_folder)):
+        if file.endswith(config.serve_job_extension):
+            job_file=os.path.join(queue_folder,file)
+            running_file=re.sub(config.serve_job_extension+"$",config.serve_running_extension,job_file)
+            try:
+                os.rename(job_file,running_file)
+            except EnvironmentError:
+                # the job was claimed by another server
+                continue
+            return running_file
+    
+    return None
+
+def run_server(args):
+    """
+    Run the workflow for the jobs added to the queue folder
+    Each job is a manifest (of the batch format) written to the folder with the job extension
+    The databases are loaded with the first job and then reused for all of the jobs
+    The server stops once the stop file is written to the folder and no jobs are waiting
+    """
+    
+    queue_folder=os.path.abspath(args.serve)
+    if not os.path.isdir(queue_folder):
+        sys.exit("CRITICAL ERROR: The queue folder selected does not exist: " + queue_folder)
+    stop_file=os.path.join(queue_folder,config.serve_stop_file)
+    
+    message="Waiting for jobs in queue folder: " + queue_folder
+    print(message)
+    
+    databases=None
+    while True:
+        running_file=claim_server_job(queue_folder)
+        if not running_file:
+            # stop once all of the jobs waiting have been run
+            if os.path.isfile(stop_file):
+                break
+            time.sleep(config.serve_poll_seconds)
+            continue
+        
+        print("\nRunning job: " + running_file)
+        try:
+            samples=read_batch_manifest(running_file, args.output)
+            databases, failed_samples=run_samples(args, samples, databases)
+        except (SystemExit, Exception) as error:
+            message="Unable to run job " + running_file + " : " + str(error)
+            logger.critical(message)
+            if not isinstance(error, SystemExit):
+                logger.critical("TRACEBACK: \n" + traceback.format_exc())
+            print(message)
+            failed_samples=[str(error)]
+            
+        # record the job status, adding any failures to the end of the job file
+        if failed_samples:
+            with open(running_file,"a") as file_handle:
+                for failed in failed_samples:
+                    file_handle.write(config.batch_manifest_comment_indicator+" Unable to run: "+failed+"\n")
+            status_extension=config.serve_failed_extension
+        else:
+            status_extension=config.serve_done_extension
+        os.rename(running_file,re.sub(config.serve_running_extension+"$",status_extension,running_file))
+        
+    utilities.remove_file(stop_file)
+    print("\nStopping server as requested with file: " + stop_file)
+
+def main():
+    # Parse arguments from command line
+    args=parse_arguments(sys.argv)
+    
+    if args.serve:
+        run_server(args)
+    elif args.batch:
+        run_batch(args)
+    else:
+        run_sample(args)
@@ -611,13 +611,16 @@ def compute_unmapped_and_unintegrated(gene_abundance_in_pathways, remaining_gene
     
 
 def compute_pathways_abundance_and_coverage(gene_scores, reactions_database, 
-                                            pathways_and_reactions_store, pathways_database, unaligned_reads_count):
+                                            pathways_and_reactions_store, pathways_database, unaligned_reads_count,
+                                            pathway_names=None):
     """
     Compute the abundance and coverage of the pathways
+    Use the pathway names if provided (already loaded) instead of reading the mapping file
     """
     
     # Read in and store the pathway id to name mappings
-    pathway_names=store.Names(config.pathway_name_mapping_file)
+    if pathway_names is None:
+        pathway_names=store.Names(config.pathway_name_mapping_file)
     
     # Compute abundance for all pathways
     pathways_abundance, reactions_in_pathways_present=compute_pathways_abundance(
@@ -0,0 +1,240 @@
+"""
+HUMAnN: bam_reader module
+Read the alignment records from a bam file without converting to sam
+
+Copyright (c) 2014 Harvard School of Public Health
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import sys
+import struct
+import zlib
+import logging
+
+from concurrent import futures
+
+from .. import config
+
+# name global logging instance
+logger=logging.getLogger(__name__)
+
+# the bgzf (blocked gzip) block header and the bam binary values
+BGZF_MAGIC=b"\x1f\x8b\x08\x04"
+BGZF_HEADER=struct.Struct("<4sIBBH")
+BAM_MAGIC=b"BAM\x01"
+BAM_RECORD_CORE=struct.Struct("<iiBBHHHiiii")
+INT32=struct.Struct("<i")
+
+CIGAR_OPERATIONS="MIDNSHP=X"
+SEQUENCE_CODES="=ACMGRSVTWYHKDBN"
+# the two bases for each byte of the packed sequence
+SEQUENCE_PAIRS=[SEQUENCE_CODES[byte >> 4]+SEQUENCE_CODES[byte & 15] for byte in range(256)]
+# the size of each tag value type (others are null terminated or arrays)
+TAG_SIZES={b"A":1,b"c":1,b"C":1,b"s":2,b"S":2,b"i":4,b"I":4,b"f":4}
+
+def bgzf_blocks(file_handle):
+    """
+    Yield the compressed data from each of the blocks in the bgzf file
+    """
+
+    while True:
+        header=file_handle.read(BGZF_HEADER.size)
+        if not header:
+            break
+        try:
+            magic, mtime, extra_flags, os_flag, extra_length = BGZF_HEADER.unpack(header)
+        except struct.Error:
+            magic=None
+        if magic != BGZF_MAGIC:
+            raise EnvironmentError("File is not of the bgzf format")
+
+        # find the total block size from the BC extra subfield
+        extra=file_handle.read(extra_length)
+        block_size=None
+        index=0
+        while index < extra_length:
+            subfield_length=struct.unpack("<H",extra[index+2:index+4])[0]
+            if extra[index:index+2] == b"BC":
+                block_size=struct.unpack("<H",extra[index+4:index+6])[0]+1
+            index+=4+subfield_length
+        if block_size is None:
+            raise EnvironmentError("File is not of the bgzf format")
+
+        # the block ends with the crc32 and the uncompressed size
+        data=file_handle.read(block_size-BGZF_HEADER.size-extra_length)
+        yield data[:-8]
+
+def decompress_block(data):
+    """
+    Return the decompressed data from the raw deflate block
+    """
+
+    return zlib.decompress(data, -15)
+
+def decompressed_blocks(file_handle, threads):
+    """
+    Yield the decompressed data from each block in order
+    The blocks are decompressed with a set of threads
+    """
+
+    if threads < 2:
+        for data in bgzf_blocks(file_handle):
+            yield decompress_block(data)
+        return
+
+    # decompress sets of blocks at a time to limit the memory used
+    with futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        blocks=[]
+        for data in bgzf_blocks(file_handle):
+            blocks.append(data)
+            if len(blocks) == threads*config.bam_blocks_per_thread:
+                for decompressed in executor.map(decompress_block, blocks):
+                    yield decompressed
+                blocks=[]
+        for decompressed in executor.map(decompress_block, blocks):
+            yield decompressed
+
+class DecompressedData(object):
+    """
+    Read the data from the bam file as it is decompressed
+    """
+
+    def __init__(self, blocks):
+        self.__blocks=blocks
+        self.__data=bytearray()
+        self.__position=0
+
+    def read(self, size):
+        """
+        Return the next set of bytes of the size requested (or fewer at the end of the file)
+        """
+
+        while len(self.__data) - self.__position < size:
+            try:
+                block=next(self.__blocks)
+            except StopIteration:
+                break
+            # remove the data already read before adding the next block
+            if self.__position:
+                del self.__data[:self.__position]
+                self.__position=0
+            self.__data+=block
+
+        data=bytes(self.__data[self.__position:self.__position+size])
+        self.__position+=len(data)
+        return data
+
+def read_int32(data):
+    """
+    Return the next integer from the data
+    """
+
+    return INT32.unpack(data.read(INT32.size))[0]
+
+def find_tag(data, start, tag):
+    """
+    Return the string value of the tag from the record data (or an empty string if not found)
+    """
+
+    index=start
+    while index < len(data):
+        name=data[index:index+2]
+        value_type=data[index+2:index+3]
+        index+=3
+        if value_type in TAG_SIZES:
+            index+=TAG_SIZES[value_type]
+        elif value_type in [b"Z",b"H"]:
+            end=data.index(b"\x00",index)
+            if name == tag:
+                return data[index:end].decode("ascii")
+            index=end+1
+        elif value_type == b"B":
+            array_type=data[index:index+1]
+            count=INT32.unpack(data[index+1:index+5])[0]
+            index+=5+TAG_SIZES[array_type]*count
+        else:
+            break
+
+    return ""
+
+def read_records(bam_file, threads=1):
+    """
+    Yield the alignment records from the bam file
+    Each record includes the query, flag, reference, position (1-based),
+    cigar operations (as length and operation), md field, and sequence
+    """
+
+    try:
+        file_handle=open(bam_file,"rb")
+    except EnvironmentError:
+        sys.exit("CRITICAL ERROR: Unable to read bam file: " + bam_file)
+
+    # close the file even if the records are not all read
+    try:
+        data=DecompressedData(decompressed_blocks(file_handle, threads))
+
+        # read the header and the reference names
+        if data.read(len(BAM_MAGIC)) != BAM_MAGIC:
+            sys.exit("CRITICAL ERROR: The input file is not of the bam format: " + bam_file)
+        data.read(read_int32(data))
+        references=[]
+        for index in range(read_int32(data)):
+            references.append(data.read(read_int32(data))[:-1].decode("ascii"))
+            data.read(INT32.size)
+
+        while True:
+            block_size=data.read(INT32.size)
+            if len(block_size) < INT32.size:
+                break
+            record_size=INT32.unpack(block_size)[0]
+            record=data.read(record_size)
+            if len(record) < record_size:
+                raise EnvironmentError("The last record is incomplete")
+
+            (reference_id, position, query_length, mapq, bin, cigar_length, flag, sequence_length,
+                next_reference_id, next_position, template_length) = BAM_RECORD_CORE.unpack_from(record)
+
+            index=BAM_RECORD_CORE.size
+            query=record[index:index+query_length-1].decode("ascii")
+            index+=query_length
+
+            cigar=[]
+            for operation in struct.unpack_from("<"+str(cigar_length)+"I",record,index):
+                cigar.append((operation >> 4, CIGAR_OPERATIONS[operation & 15]))
+            index+=cigar_length*4
+
+            packed_length=(sequence_length+1)//2
+            sequence="".join([SEQUENCE_PAIRS[byte] for byte in record[index:index+packed_length]])[:sequence_length]
+            if not sequence:
+                sequence="*"
+            index+=packed_length+sequence_length
+
+            reference="*"
+            if reference_id >= 0:
+                reference=references[reference_id]
+
+            yield (query, flag, reference, position+1, cigar, find_tag(record, index, b"MD"), sequence)
+    except (EnvironmentError, struct.error, zlib.error, IndexError, UnicodeDecodeError) as error:
+        message="Unable to read bam file, it is not of the bgzf format or is truncated: " + bam_file + \
+            "\n" + str(error)
+        logger.critical(message)
+        sys.exit("CRITICAL ERROR: " + message)
+    finally:
+        file_handle.close()
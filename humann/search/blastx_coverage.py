@@ -23,23 +23,25 @@ from humann import store
 # name global logging instance
 logger=logging.getLogger(__name__)
 
-def blastx_coverage( blast6out, min_coverage, alignments=None, log_messages=None, apply_filter=None, nucleotide = False, query_coverage_threshold=config.translated_query_coverage_threshold, identity_threshold = config.nucleotide_identity_threshold):
+def blastx_coverage( blast6out, min_coverage, alignments=None, log_messages=None, apply_filter=None, nucleotide = False, query_coverage_threshold=config.translated_query_coverage_threshold, identity_threshold = config.nucleotide_identity_threshold, filtered_alignments=None):
     # create alignments instance if none is passed
     if alignments is None:
         alignments=store.Alignments()
     
     # store protein lengths
     protein_lengths = {}
-    # store unique positions hit in each protein as sets
-    protein_hits = defaultdict( str )
-    # track proteins with sufficient coverage
-    allowed = set()
+    # store the ranges hit in each protein
+    protein_hits = defaultdict( list )
     # track alignments unable to compute coverage
     no_coverage=0
     # parse blast6out file, applying filtering as selected
     for alignment_info in utilities.get_filtered_translated_alignments(blast6out, alignments, apply_filter=apply_filter, log_filter = log_messages, query_coverage_threshold = query_coverage_threshold, identity_threshold = identity_threshold):
         ( protein_name, gene_length, queryid, matches, bug, alignment_length,
           subject_start_index, subject_stop_index) = alignment_info
+        
+        # store the alignment if set so the file is not read again
+        if filtered_alignments is not None:
+            filtered_alignments.add(protein_name, gene_length, queryid, matches, bug, alignment_length)
           
         # divide the gene length by 3 to get protein length from nucleotide length
         if not nucleotide:
@@ -49,27 +51,61 @@ def blastx_coverage( blast6out, min_coverage, alignments=None, log_messages=None
         protein_lengths[protein_name] = gene_length
         
         # add the range of the alignment to the protein hits
-        protein_range=range(subject_start_index, subject_stop_index)
-        if protein_range:
-            # keep track of unique hit positions in this protein
-            protein_hits[protein_name]+="{0}-{1};".format(subject_start_index, subject_stop_index)
-        else:
+        if not add_protein_hit(protein_hits, protein_name, subject_start_index, subject_stop_index):
             no_coverage+=1
+
+    return allowed_proteins(protein_lengths, protein_hits, min_coverage, no_coverage, log_messages)
+
+def add_protein_hit(protein_hits, protein_name, subject_start_index, subject_stop_index):
+    """
+    Add the range of the alignment to the protein hits
+    Return False if the range is empty (unable to compute coverage)
+    """
+
+    if subject_stop_index > subject_start_index:
+        hit_ranges=protein_hits[protein_name]
+        hit_ranges.append((subject_start_index, subject_stop_index))
+        # merge the ranges each time the total doubles to limit the memory used
+        total_ranges=len(hit_ranges)
+        if total_ranges >= config.coverage_ranges_merge_size and not total_ranges & (total_ranges - 1):
+            hit_ranges[:]=merge_ranges(hit_ranges)
+        return True
+
+    return False
+
+def merge_ranges(hit_ranges):
+    """
+    Return the sorted ranges with the overlapping ranges merged
+    """
+
+    merged=[]
+    for start_index, stop_index in sorted(hit_ranges):
+        if merged and start_index <= merged[-1][1]:
+            if stop_index > merged[-1][1]:
+                merged[-1]=(merged[-1][0], stop_index)
+        else:
+            merged.append((start_index, stop_index))
+
+    return merged
+
+def allowed_proteins(protein_lengths, protein_hits, min_coverage, no_coverage=0, log_messages=None):
+    """
+    Return the proteins with coverage greater than the threshold
+    """
+
+    # track proteins with sufficient coverage
+    allowed = set()
     # track proteins without lengths
     no_length=0
     # compute coverage
-    for protein_name, hit_positions in protein_hits.items():
+    for protein_name, hit_ranges in protein_hits.items():
 
-        # compile the hit positions
-        range_hit_positions = set()
-        for alignment_hit in hit_positions.split(";")[:-1]:
-             start_index, stop_index = alignment_hit.split("-")
-             new_range = range(int(start_index), int(stop_index))
-             range_hit_positions.update(new_range)
+        # count the positions hit
+        total_hit_positions = sum(stop_index - start_index for start_index, stop_index in merge_ranges(hit_ranges))
 
         try:
             # compute coverage, with 50 indicating that 50% of the protein is covered
-            coverage = len( range_hit_positions ) / float( protein_lengths[protein_name] ) * 100
+            coverage = total_hit_positions / float( protein_lengths[protein_name] ) * 100
         except ZeroDivisionError:
             coverage = 0
             no_length+=1
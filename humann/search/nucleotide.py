@@ -24,20 +24,36 @@ THE SOFTWARE.
 """
 
 import os
+import io
 import re
 import logging
 import traceback
 import sys
 
+from collections import defaultdict
+from concurrent import futures
+
 from .. import utilities
 from .. import config
 from .. import store
 from ..search import pick_frames
 from ..search import blastx_coverage
+from ..search import bam_reader
 
 # name global logging instance
 logger=logging.getLogger(__name__)
 
+# the patterns to parse the cigar strings and md fields
+cigar_string_pattern=re.compile("(?:[0-9]+[MIDNSHP=X])+")
+cigar_operation_pattern=re.compile("([0-9]+)([MIDNSHP=X])")
+number_pattern=re.compile("\\d+")
+non_number_pattern=re.compile("\\D+")
+match_mismatch_indel_identifiers=frozenset(config.sam_cigar_match_mismatch_indel_identifiers)
+add_to_reference_identifiers=frozenset(config.sam_cigar_add_to_reference_identifiers)
+
+# the lengths computed for each cigar string
+cigar_lengths={}
+
 def find_index(directory):
     """
     Search through the directory for the name of the bowtie2 index files
@@ -109,21 +125,34 @@ def index(custom_database):
     tmpfile=utilities.unnamed_temp_file("bowtie2_stdout_")
     tmpfile2=utilities.unnamed_temp_file("bowtie2_stderr_")
     
+    # the threads used do not change the index so they are not included in the stage settings
+    stage_settings=[exe]+opts+[outfiles[0].replace(index_name,"")]
     utilities.execute_command(exe,args,[custom_database],outfiles,
-        stdout_file=tmpfile, stderr_file=tmpfile2)
+        stdout_file=tmpfile, stderr_file=tmpfile2, stage_settings=stage_settings)
 
     return index_name
 
-def alignment(user_fastq, index_name):
+def aligner_unaligned_reads_file(user_fastq):
     """
-    Run alignment with bowtie2
+    Return the file of the reads bowtie2 does not align (in the format of the input)
+    or None if bowtie2 is not set to write the unaligned reads
+    """
+
+    if config.bowtie2_unaligned_reads_toggle != "on":
+        return None
+
+    extension=config.fasta_extension
+    if utilities.fasta_or_fastq(user_fastq) == "fastq":
+        extension=config.fastq_extension
+
+    return utilities.name_temp_file(config.nucleotide_aligner_unaligned_reads_name_no_ext + extension)
+
+def alignment_command(user_fastq, index_name):
+    """
+    Return the bowtie2 executable, arguments (without the output file),
+    and the stage settings to align the input to the index
     """
-    
-    # name the alignment file
-    alignment_file = utilities.name_temp_file(
-        config.chocophlan_alignment_name)
 
-    # align user input to database
     exe="bowtie2"
     opts=config.bowtie2_align_opts
 
@@ -138,42 +167,128 @@ def alignment(user_fastq, index_name):
     if input_type == "fasta":
         input_type_flag="-f"
 
-    args=[input_type_flag,"-x",index_name,"-U",user_fastq,"-S",alignment_file]
+    args=[input_type_flag,"-x",index_name,"-U",user_fastq]
     
     #add threads
     if config.threads > 1:
         args+=["-p",config.threads]
 
+    args+=opts
+
+    # have bowtie2 write the reads that do not align instead of including them in the sam file
+    unaligned_opts=[]
+    aligner_unaligned_reads=aligner_unaligned_reads_file(user_fastq)
+    if aligner_unaligned_reads:
+        unaligned_opts=["--no-unal","--un"]
+        args+=unaligned_opts+[aligner_unaligned_reads]
+
+    # include the index so a new custom database will not bypass the alignment on resume
+    index_files=[index_name+ext for ext in [config.bowtie2_index_ext_list[0],config.bowtie2_large_index_ext]]
+    stage_settings=[exe,input_type_flag]+opts+unaligned_opts+[utilities.file_fingerprint(file) for file in index_files]
+
+    return exe, args, stage_settings
+
+def alignment(user_fastq, index_name):
+    """
+    Run alignment with bowtie2
+    """
+    
+    # name the alignment file
+    alignment_file = utilities.name_temp_file(
+        config.chocophlan_alignment_name)
+
+    # align user input to database
+    exe, args, stage_settings = alignment_command(user_fastq, index_name)
+
+    args+=["-S",alignment_file]
+
+    # the unaligned reads file is also required to bypass the alignment on resume
+    outfiles=[alignment_file]
+    aligner_unaligned_reads=aligner_unaligned_reads_file(user_fastq)
+    if aligner_unaligned_reads:
+        outfiles.append(aligner_unaligned_reads)
+
     # run the bowtie2 alignment
     message="Running " + exe + " ........"
     print("\n"+message+"\n")
-    
-    args+=opts
 
-    utilities.execute_command(exe,args,[user_fastq],[alignment_file])
+    utilities.execute_command(exe,args,[user_fastq],outfiles,stage_settings=stage_settings)
 
     return alignment_file
 
-def calculate_percent_identity(cigar_string, md_field):
+def alignment_unaligned_reads_stream(user_fastq, index_name, alignments, unaligned_reads_store, keep_sam=None):
     """
-    Calculate the percent identity using the cigar string and md field from the sam file
-    Returns the percent identity and the alignment length
+    Run alignment with bowtie2, processing the alignments as they are written to stdout
+    The sam file is only written if selected to keep
+    Return file of the unaligned reads and the reduced aligned reads file
+    """
+    
+    alignment_file = utilities.name_temp_file(
+        config.chocophlan_alignment_name)
+    
+    exe, args, stage_settings = alignment_command(user_fastq, index_name)
+    
+    outfiles=[alignment_file]
+    aligner_unaligned_reads=aligner_unaligned_reads_file(user_fastq)
+    if aligner_unaligned_reads:
+        outfiles.append(aligner_unaligned_reads)
+    
+    # if the sam file is kept, check if the alignment can be bypassed on resume
+    if keep_sam:
+        if utilities.check_outfiles(outfiles, [user_fastq], stage_settings):
+            message="Bypass"
+            logger.info(message)
+            print(message)
+            return unaligned_reads(alignment_file, alignments, unaligned_reads_store, keep_sam=True,
+                aligner_unaligned_reads=aligner_unaligned_reads)
+    else:
+        utilities.remove_file(alignment_file)
+        utilities.remove_file(utilities.stage_manifest_file([alignment_file]))
+    
+    message="Running " + exe + " ........"
+    print("\n"+message+"\n")
+    
+    stderr_file=utilities.unnamed_temp_file("bowtie2_stderr_")
+    sam_stream=utilities.execute_command_stream(exe, args, [user_fastq], stderr_file=stderr_file)
+    
+    if keep_sam:
+        sam_stream=utilities.tee_lines(sam_stream, alignment_file)
+        
+    return_list=unaligned_reads_from_stream(sam_stream, alignments, unaligned_reads_store,
+        aligner_unaligned_reads=aligner_unaligned_reads)
+    
+    if keep_sam:
+        utilities.write_stage_manifest(outfiles, [user_fastq], stage_settings)
+    
+    return return_list
+
+def cigar_string_lengths(cigar_string):
+    """
+    Return the total match/mismatch/indel and the reference length from the cigar string
     """
     
-    match_numbers=re.compile("\d+")
-    match_non_numbers=re.compile("\D+")
+    # parse the operations directly if the cigar string is of the standard format
+    if cigar_string_pattern.fullmatch(cigar_string):
+        match_mismatch_indel_count=0
+        reference_length=0
+        for length, cigar_identifier in cigar_operation_pattern.findall(cigar_string):
+            if cigar_identifier in match_mismatch_indel_identifiers:
+                match_mismatch_indel_count+=float(length)
+            if cigar_identifier in add_to_reference_identifiers:
+                reference_length+=int(length)
+        return match_mismatch_indel_count, reference_length
     
     # find the sets of numbers and identifers from the cigar string
-    cigar_numbers=match_numbers.findall(cigar_string)
-    cigar_identifiers=match_non_numbers.findall(cigar_string)
+    cigar_numbers=number_pattern.findall(cigar_string)
+    cigar_identifiers=non_number_pattern.findall(cigar_string)
 
     # find the index for all of the match/mismatch/insert/delete
     match_mismatch_indel_index = []
     reference_length_index = []
     for index, cigar_identifier in enumerate(cigar_identifiers):
-        if cigar_identifier in config.sam_cigar_match_mismatch_indel_identifiers:
+        if cigar_identifier in match_mismatch_indel_identifiers:
             match_mismatch_indel_index.append(index)
-        if cigar_identifier in config.sam_cigar_add_to_reference_identifiers:
+        if cigar_identifier in add_to_reference_identifiers:
             reference_length_index.append(index)
     
     # get reference length
@@ -187,16 +302,17 @@ def calculate_percent_identity(cigar_string, md_field):
         match_mismatch_indel_count=sum([float(cigar_numbers[index]) for index in match_mismatch_indel_index])
     except (IndexError, ValueError):
         match_mismatch_indel_count=0.0
-    
-    # remove the tag from the md field
-    md_field=md_field.split(config.sam_md_field_identifier)[-1]
-    
-    # find the sets of numbers from the md field
-    md_field_numbers=match_numbers.findall(md_field)
+        
+    return match_mismatch_indel_count, reference_length
+
+def md_field_percent_identity(match_mismatch_indel_count, md_field):
+    """
+    Calculate the percent identity from the md field and the total match/mismatch/indel
+    """
     
     # sum the md field numbers to get the total number of matches
     try:
-        matches=sum(int(n) for n in md_field_numbers)
+        matches=sum(map(int, number_pattern.findall(md_field)))
     except ValueError:
         matches=0.0
     
@@ -204,8 +320,46 @@ def calculate_percent_identity(cigar_string, md_field):
     if match_mismatch_indel_count > 0.0:
         percent_identity = 100.0 * ( matches / ( match_mismatch_indel_count * 1.0 ) )
         
+    return percent_identity
+
+def calculate_percent_identity(cigar_string, md_field):
+    """
+    Calculate the percent identity using the cigar string and md field from the sam file
+    Returns the percent identity and the alignment length
+    """
+    
+    # the lengths are stored for each cigar string as most alignments share a few cigar strings
+    try:
+        match_mismatch_indel_count, reference_length = cigar_lengths[cigar_string]
+    except KeyError:
+        if len(cigar_lengths) >= config.cigar_lengths_max:
+            cigar_lengths.clear()
+        match_mismatch_indel_count, reference_length = cigar_string_lengths(cigar_string)
+        cigar_lengths[cigar_string]=(match_mismatch_indel_count, reference_length)
+    
+    # the md field tag does not include numbers so is not removed
+    percent_identity=md_field_percent_identity(match_mismatch_indel_count, md_field)
+        
     return percent_identity, match_mismatch_indel_count, reference_length 
     
+def calculate_percent_identity_from_cigar(cigar_operations, md_field):
+    """
+    Calculate the percent identity using the cigar operations (length and identifier) and md field
+    Returns the percent identity and the alignment length
+    """
+    
+    match_mismatch_indel_count=0.0
+    reference_length=0
+    for length, cigar_identifier in cigar_operations:
+        if cigar_identifier in match_mismatch_indel_identifiers:
+            match_mismatch_indel_count+=length
+        if cigar_identifier in add_to_reference_identifiers:
+            reference_length+=length
+            
+    percent_identity=md_field_percent_identity(match_mismatch_indel_count, md_field)
+        
+    return percent_identity, match_mismatch_indel_count, reference_length 
+
 def find_md_field(info):
     """
     Using the array of data from an alignment line, find the md field
@@ -214,16 +368,189 @@ def find_md_field(info):
     # Search the data, starting with the first optional column to find the md field
     md_field=""
     for data in info[config.sam_start_optional_index:]:
-        if re.match(config.sam_md_field_identifier,data):
+        if data.startswith(config.sam_md_field_identifier):
             md_field=data
             break
         
     return md_field
 
-def unaligned_reads(sam_alignment_file, alignments, unaligned_reads_store, keep_sam=None):
+def unaligned_reads(sam_alignment_file, alignments, unaligned_reads_store, keep_sam=None,
+    aligner_unaligned_reads=None):
     """ 
     Return file and data structure of the unaligned reads 
     Store the alignments and return
+    If provided, the reads bowtie2 did not align (not in the sam file) are read from the file
+    """
+  
+    utilities.file_exists_readable(sam_alignment_file)
+    
+    # parse chunks of the sam file with a set of processes if not compressed
+    if config.threads > 1 and not utilities.compressed_extension(sam_alignment_file):
+        return_list=unaligned_reads_from_records(sam_file_records(sam_alignment_file, config.threads),
+            alignments, unaligned_reads_store, aligner_unaligned_reads=aligner_unaligned_reads)
+    else:
+        file_handle_read=utilities.open_read(sam_alignment_file)
+        
+        return_list=unaligned_reads_from_stream(file_handle_read, alignments, unaligned_reads_store,
+            aligner_unaligned_reads=aligner_unaligned_reads)
+        
+        file_handle_read.close()
+
+    # remove the alignment file as it will be replaced by the two files created
+    if not config.resume:
+        if keep_sam:
+            logger.debug("Keeping sam file")
+        else:
+            logger.debug("Remove sam file")
+            utilities.remove_file(sam_alignment_file)
+
+    return return_list
+
+def unaligned_reads_from_bam(bam_alignment_file, alignments, unaligned_reads_store):
+    """ 
+    Return file and data structure of the unaligned reads 
+    Store the alignments from the bam file and return
+    """
+    
+    utilities.file_exists_readable(bam_alignment_file)
+    
+    message="Reading bam file ..."
+    logger.info(message)
+    print(message)
+    
+    return unaligned_reads_from_records(bam_records(bam_alignment_file), alignments, unaligned_reads_store)
+
+def unaligned_reads_from_stream(sam_lines, alignments, unaligned_reads_store, aligner_unaligned_reads=None):
+    """ 
+    Return file and data structure of the unaligned reads 
+    Store the alignments from the sam lines and return
+    """
+    
+    return unaligned_reads_from_records(sam_records(sam_lines), alignments, unaligned_reads_store,
+        aligner_unaligned_reads=aligner_unaligned_reads)
+
+def sam_records(sam_lines):
+    """
+    Yield the alignment records from the sam lines
+    Each record includes the query, flag, reference, position, percent identity,
+    alignment length, reference length, and sequence
+    """
+    
+    for line in sam_lines:
+        # ignore headers ^@ 
+        if line[0] != "@":
+            info=line.split(config.sam_delimiter)
+            flag=int(info[config.sam_flag_index])
+            if flag & config.sam_unmapped_flag != 0:
+                identity, alignment_length, reference_length = 0.0, 0.0, 0
+            else:
+                # convert the cigar string and md field to percent identity
+                identity, alignment_length, reference_length=calculate_percent_identity(
+                    info[config.sam_cigar_index], find_md_field(info))
+            yield (info[config.sam_read_name_index], flag, info[config.sam_reference_index],
+                info[config.sam_pos_index], identity, alignment_length, reference_length,
+                info[config.sam_read_index])
+            
+def sam_chunks(sam_alignment_file, chunk_size):
+    """
+    Yield the file, start, and end of each chunk of the sam file
+    Each chunk ends at the end of a line
+    """
+    
+    file_size=os.path.getsize(sam_alignment_file)
+    with open(sam_alignment_file, "rb") as file_handle:
+        start=0
+        while start < file_size:
+            file_handle.seek(start+chunk_size)
+            file_handle.readline()
+            end=min(file_handle.tell(), file_size)
+            yield sam_alignment_file, start, end
+            start=end
+
+def sam_chunk_records(chunk):
+    """
+    Return the list of alignment records from the chunk of the sam file
+    """
+    
+    sam_alignment_file, start, end = chunk
+    with open(sam_alignment_file, "rb") as file_handle:
+        file_handle.seek(start)
+        data=file_handle.read(end-start)
+    
+    return list(sam_records(io.TextIOWrapper(io.BytesIO(data))))
+
+def sam_file_records(sam_alignment_file, threads):
+    """
+    Yield the alignment records from the sam file in order
+    The chunks of the file are parsed with a set of processes
+    """
+    
+    # parse sets of chunks at a time to limit the memory used
+    with futures.ProcessPoolExecutor(max_workers=threads) as executor:
+        chunks=[]
+        for chunk in sam_chunks(sam_alignment_file, config.sam_chunk_size):
+            chunks.append(chunk)
+            if len(chunks) == threads*config.sam_chunks_per_thread:
+                for records in executor.map(sam_chunk_records, chunks):
+                    for record in records:
+                        yield record
+                chunks=[]
+        for records in executor.map(sam_chunk_records, chunks):
+            for record in records:
+                yield record
+
+def bam_records(bam_alignment_file):
+    """
+    Yield the alignment records from the bam file
+    Each record includes the query, flag, reference, position, percent identity,
+    alignment length, reference length, and sequence
+    """
+    
+    for query, flag, reference, position, cigar, md_field, sequence in bam_reader.read_records(
+        bam_alignment_file, config.threads):
+        if flag & config.sam_unmapped_flag != 0:
+            identity, alignment_length, reference_length = 0.0, 0.0, 0
+        else:
+            identity, alignment_length, reference_length=calculate_percent_identity_from_cigar(
+                cigar, md_field)
+        yield (query, flag, reference, position, identity, alignment_length, reference_length, sequence)
+
+def write_unaligned_read(query, sequence, offset, file_handle_write_unaligned, unaligned_reads_store,
+    file_handle_write_unaligned_frames=None):
+    """
+    Write the unaligned read (with its length annotation) and store its location
+    If provided, write the frames picked for the read
+    Return the offset after the read and if frames were found
+    """
+
+    annotated_sam_read_name=utilities.add_length_annotation(query,len(sequence))
+    unaligned_record=(">"+annotated_sam_read_name+"\n"+sequence+"\n").encode()
+    file_handle_write_unaligned.write(unaligned_record)
+    
+    # find the frames for the sequence and write to file
+    frames_found=True
+    if file_handle_write_unaligned_frames:
+        picked_frames=pick_frames.pick_frames(sequence)
+        if not picked_frames:
+            frames_found=False
+        for frame in picked_frames:
+            file_handle_write_unaligned_frames.write(">"+
+                annotated_sam_read_name+"\n")
+            file_handle_write_unaligned_frames.write(frame+"\n")
+    
+    # store the unaligned reads data
+    unaligned_reads_store.add(query, sequence, offset, len(unaligned_record))
+
+    return offset+len(unaligned_record), frames_found
+
+def unaligned_reads_from_records(alignment_records, alignments, unaligned_reads_store, aligner_unaligned_reads=None):
+    """ 
+    Return file and data structure of the unaligned reads 
+    Store the alignments and return
+    The records are read once, collecting the gene coverage and writing the unaligned
+    reads, with the aligned records stored in a reduced temp file to apply the filters
+    The unaligned reads are those without alignments, followed by those aligned
+    but filtered, and then any reads bowtie2 wrote to a file as it did not align them
     """
 
     #for translated search create fasta unaligned reads file
@@ -240,131 +567,194 @@ def unaligned_reads(sam_alignment_file, alignments, unaligned_reads_store, keep_
             config.fasta_extension)
         file_handle_write_unaligned_frames=open(unaligned_reads_file_picked_frames_fasta, "w")
         write_picked_frames=True
+    else:
+        file_handle_write_unaligned_frames=None
 
     #name the reduced aligned reads file with tsv extension
     reduced_aligned_reads_file=utilities.name_temp_file(
         config.nucleotide_aligned_reads_name_tsv)
-
-  
-    utilities.file_exists_readable(sam_alignment_file)
-    file_handle_read=open(sam_alignment_file, "rt")
+    
+    # the records needed to apply the filters to the alignments, in the order of the sam lines
+    # query, reference annotation index, query coverage and identity filters, matches,
+    # alignment length, and the location of the read sequence in the sequences file
+    sam_records_file=utilities.unnamed_temp_file("sam_records_")
+    file_handle_write_records=open(sam_records_file, "w")
+    
+    # the sequences of the aligned reads (written once for the consecutive lines of a read)
+    # which are only read if all of the alignments for the read are filtered
+    aligned_sequences_file=utilities.unnamed_temp_file("sam_sequences_")
+    file_handle_write_sequences=open(aligned_sequences_file, "wb")
+    sequences_offset=0
+    last_query=None
+    last_sequence_location=None
     
     file_handle_write_aligned=open(reduced_aligned_reads_file, "w")
+    
+    # write the unaligned reads as bytes to store the location of each record
+    file_handle_write_unaligned=open(unaligned_reads_file_fasta, "wb")
+    unaligned_offset=0
+    no_frames_found_count=0
 
-    # read through the file line by line
+    # the annotation (gene, gene length, and bug) for each of the references
+    reference_indexes={}
+    reference_annotations=[]
+    # the gene lengths and ranges hit for the subject coverage filter
+    gene_lengths={}
+    gene_hits=defaultdict(list)
+    no_coverage=0
+    coverage_small_identity_count=0
+    coverage_small_query_coverage_count=0
+
+    # read through the lines once
     # generate blast-like output file of alignments
-    line = file_handle_read.readline()
-    while line:
-        # ignore headers ^@ 
-        unaligned_read=False
-        if line[0] != "@":
-            info=line.split(config.sam_delimiter)
-            # check flag to determine if unaligned
-            if int(info[config.sam_flag_index]) & config.sam_unmapped_flag != 0:
-                unaligned_read=True
-            else:
-                # convert the cigar string and md field to percent identity
-                cigar_string=info[config.sam_cigar_index]
-                md_field=find_md_field(info)
-                identity, alignment_length, reference_length=calculate_percent_identity(cigar_string, md_field)
-                
-                query=info[config.sam_read_name_index]
-                # write output to be blastm8-like
-                new_info=[""] * config.blast_total_columns
-                new_info[config.blast_query_index]=query
-                new_info[config.blast_reference_index]=info[config.sam_reference_index]
-                new_info[config.blast_subject_start_index]=str(info[config.sam_pos_index])
-                new_info[config.blast_subject_end_index]=str(int(info[config.sam_pos_index])+reference_length)
-                new_info[config.blast_evalue_index]="0"
-                new_info[config.blast_identity_index]=str(identity)
-                new_info[config.blast_aligned_length_index]=str(alignment_length)
-                new_info[config.blast_query_start_index]="0"
-                new_info[config.blast_query_end_index]=str(alignment_length-1)
-                file_handle_write_aligned.write(config.blast_delimiter.join(new_info)+"\n")
-        line=file_handle_read.readline()
-                   
-    file_handle_read.close()
+    # and collect the gene coverage
+    # the queries are counted by the ids of their names shared with the stores
+    query_ids=unaligned_reads_store.get_query_ids()
+    queries_found=bytearray()
+    total_queries=0
+    for query, flag, reference, position, identity, alignment_length, reference_length, sequence in alignment_records:
+        name_id=query_ids.get_id(query)
+        if name_id >= len(queries_found):
+            queries_found.extend(bytes(query_ids.count()-len(queries_found)))
+        # count each copy of the read if the duplicate reads were collapsed
+        if not queries_found[name_id]:
+            queries_found[name_id]=1
+            total_queries+=query_ids.get_weight(name_id)
+        # check flag to determine if unaligned
+        if flag & config.sam_unmapped_flag != 0:
+            unaligned_offset, frames_found = write_unaligned_read(query, sequence, unaligned_offset,
+                file_handle_write_unaligned, unaligned_reads_store, file_handle_write_unaligned_frames)
+            if not frames_found:
+                no_frames_found_count+=1
+        else:
+            subject_start_index=int(position)
+            subject_stop_index=subject_start_index+reference_length
+            # write output to be blastm8-like
+            new_info=[""] * config.blast_total_columns
+            new_info[config.blast_query_index]=query
+            new_info[config.blast_reference_index]=reference
+            new_info[config.blast_subject_start_index]=str(subject_start_index)
+            new_info[config.blast_subject_end_index]=str(subject_stop_index)
+            new_info[config.blast_evalue_index]="0"
+            new_info[config.blast_identity_index]=str(identity)
+            new_info[config.blast_aligned_length_index]=str(alignment_length)
+            new_info[config.blast_query_start_index]="0"
+            new_info[config.blast_query_end_index]=str(alignment_length-1)
+            file_handle_write_aligned.write(config.blast_delimiter.join(new_info)+"\n")
+
+            # get the gene annotation once for each reference
+            try:
+                reference_index=reference_indexes[reference]
+            except KeyError:
+                reference_index=len(reference_annotations)
+                reference_indexes[reference]=reference_index
+                reference_annotations.append(alignments.process_reference_annotation(reference))
+            gene_name, gene_length, bug = reference_annotations[reference_index]
+
+            # apply the filters for the alignments included in the gene coverage
+            # (the query is only covered by its length annotation as the query end
+            # in the reduced file is not an integer)
+            coverage_filter=False
+            if identity < config.nucleotide_identity_threshold:
+                coverage_filter=True
+                coverage_small_identity_count+=1
+            if utilities.filter_based_on_query_coverage(utilities.get_length_annotation(query)[1],
+                0, 0, config.nucleotide_query_coverage_threshold):
+                coverage_filter=True
+                coverage_small_query_coverage_count+=1
+            if not coverage_filter:
+                gene_lengths[gene_name]=gene_length
+                if not blastx_coverage.add_protein_hit(gene_hits, gene_name, subject_start_index, subject_stop_index):
+                    no_coverage+=1
+
+            # apply the filters for the alignments stored
+            query_coverage_filter=""
+            if utilities.filter_based_on_query_coverage(alignment_length, 0, alignment_length-1,
+                config.nucleotide_query_coverage_threshold):
+                query_coverage_filter="1"
+            identity_filter=""
+            if not identity > config.nucleotide_identity_threshold:
+                identity_filter="1"
+
+            # store the sequence of the read in case all of its alignments are filtered
+            if query != last_query:
+                sequence_bytes=sequence.encode()
+                file_handle_write_sequences.write(sequence_bytes)
+                last_sequence_location=[str(sequences_offset),str(len(sequence_bytes))]
+                sequences_offset+=len(sequence_bytes)
+                last_query=query
+
+            record=[query,str(reference_index),query_coverage_filter,identity_filter,
+                repr(identity/100.0*alignment_length),repr(alignment_length)]+last_sequence_location
+            file_handle_write_records.write(config.sam_delimiter.join(record)+"\n")
+               
+    file_handle_write_records.close()
+    file_handle_write_sequences.close()
     file_handle_write_aligned.close()
 
-    # process alignments to determine genes for filtering
-    allowed_genes = blastx_coverage.blastx_coverage(reduced_aligned_reads_file,
-        config.nucleotide_subject_coverage_threshold, alignments, log_messages=True, apply_filter=True,
-        nucleotide=True, query_coverage_threshold=config.nucleotide_query_coverage_threshold,
-        identity_threshold = config.nucleotide_identity_threshold)
+    logger.debug("Total alignments not included in gene coverage based on small percent identity: " +
+        str(coverage_small_identity_count))
+    logger.debug("Total alignments not included in gene coverage based on small query coverage: " +
+        str(coverage_small_query_coverage_count))
 
-    file_handle_read=open(sam_alignment_file, "rt")
-    file_handle_write_unaligned=open(unaligned_reads_file_fasta, "w")
+    # apply the subject coverage threshold to determine genes for filtering
+    allowed_genes = blastx_coverage.allowed_proteins(gene_lengths, gene_hits,
+        config.nucleotide_subject_coverage_threshold, no_coverage, log_messages=True)
+    gene_hits.clear()
 
-    # read through the file line by line
-    # capture alignments and also write out unaligned reads for next step in processing
-    line = file_handle_read.readline()
-    query_ids=set()
-    no_frames_found_count=0
+    file_handle_read=open(sam_records_file, "rt")
+    file_handle_read_sequences=open(aligned_sequences_file, "rb")
+
+    # read through the records
+    # capture alignments and also write out the filtered reads for next step in processing
     small_identity_count=0
     filtered_genes_count=0
     query_coverage_count=0
-    while line:
-        # ignore headers ^@ 
+    for line in file_handle_read:
+        (query, reference_index, query_coverage_filter, identity_filter, matches,
+            alignment_length, sequence_offset, sequence_length) = line.rstrip("\n").split(config.sam_delimiter)
+        # only store alignments with identity greater than threshold
+        # and with genes included in the filtered list
         unaligned_read=False
-        if not re.search("^@",line):
-            info=line.split(config.sam_delimiter)
-            query_ids.add(info[config.blast_query_index])
-            # check flag to determine if unaligned
-            if int(info[config.sam_flag_index]) & config.sam_unmapped_flag != 0:
-                unaligned_read=True
-            else:
-                # convert the cigar string and md field to percent identity
-                cigar_string=info[config.sam_cigar_index]
-                md_field=find_md_field(info)
-                identity, alignment_length, reference_length=calculate_percent_identity(cigar_string, md_field)
-
-                # only store alignments with identity greater than threshold
-                # and with genes included in the filtered list
-                query=info[config.sam_read_name_index]
-
-                gene_name, gene_length, bug = alignments.process_reference_annotation(
-                info[config.sam_reference_index])
-
-                if not gene_name in allowed_genes:
-                    filtered_genes_count+=1
-                    unaligned_read=True
-
-                query_start_index=0
-                query_stop_index=alignment_length-1
-                if utilities.filter_based_on_query_coverage(alignment_length, query_start_index, query_stop_index, config.nucleotide_query_coverage_threshold):
-                    query_coverage_count+=1
-                    unaligned_read=True
-
-                if identity > config.nucleotide_identity_threshold:
-                    matches=identity/100.0*alignment_length
-                    if not unaligned_read:
-                        alignments.add_annotated(query,matches,info[config.sam_reference_index],
-                            alignment_length)
-                else:
-                    small_identity_count+=1
-                    unaligned_read=True
-
-            if unaligned_read:
-                annotated_sam_read_name=utilities.add_length_annotation(info[config.sam_read_name_index],
-                                                                    len(info[config.sam_read_index]))
-                file_handle_write_unaligned.write(">"+annotated_sam_read_name+"\n")
-                file_handle_write_unaligned.write(info[config.sam_read_index]+"\n")
-                
-                # find the frames for the sequence and write to file
-                if write_picked_frames:
-                    picked_frames=pick_frames.pick_frames(info[config.sam_read_index])
-                    if not picked_frames:
-                        no_frames_found_count+=1
-                    for frame in picked_frames:
-                        file_handle_write_unaligned_frames.write(">"+
-                            annotated_sam_read_name+"\n")
-                        file_handle_write_unaligned_frames.write(frame+"\n")
-                
-                # store the unaligned reads data
-                unaligned_reads_store.add(info[config.sam_read_name_index], 
-                    info[config.sam_read_index])
-                    
-        line=file_handle_read.readline()
+        gene_name, gene_length, bug = reference_annotations[int(reference_index)]
+
+        if not gene_name in allowed_genes:
+            filtered_genes_count+=1
+            unaligned_read=True
+
+        if query_coverage_filter:
+            query_coverage_count+=1
+            unaligned_read=True
+
+        if not identity_filter:
+            if not unaligned_read:
+                alignments.add(gene_name,gene_length,query,float(matches),bug,float(alignment_length))
+        else:
+            small_identity_count+=1
+            unaligned_read=True
+
+        if unaligned_read:
+            file_handle_read_sequences.seek(int(sequence_offset))
+            sequence=file_handle_read_sequences.read(int(sequence_length)).decode()
+            unaligned_offset, frames_found = write_unaligned_read(query, sequence, unaligned_offset,
+                file_handle_write_unaligned, unaligned_reads_store, file_handle_write_unaligned_frames)
+            if not frames_found:
+                no_frames_found_count+=1
+
+    # add the reads bowtie2 did not align (not included in the sam file)
+    if aligner_unaligned_reads:
+        aligner_unaligned_count=0
+        for query, sequence in unaligned_reads_store.process_file(aligner_unaligned_reads):
+            # the file is empty if all reads aligned
+            if not query:
+                continue
+            total_queries+=query_ids.get_weight(query_ids.get_id(query))
+            aligner_unaligned_count+=1
+            unaligned_offset, frames_found = write_unaligned_read(query, sequence, unaligned_offset,
+                file_handle_write_unaligned, unaligned_reads_store, file_handle_write_unaligned_frames)
+            if not frames_found:
+                no_frames_found_count+=1
+        logger.debug("Total reads not aligned by bowtie2: " + str(aligner_unaligned_count))
 
     if write_picked_frames:
         logger.debug("Total sequences without frames found: " + str(no_frames_found_count))
@@ -376,11 +766,13 @@ def unaligned_reads(sam_alignment_file, alignments, unaligned_reads_store, keep_
         str(query_coverage_count))
     
     file_handle_read.close()
+    file_handle_read_sequences.close()
     file_handle_write_unaligned.close()   
-    file_handle_write_aligned.close()
+    utilities.remove_file(sam_records_file)
+    utilities.remove_file(aligned_sequences_file)
     
     # set the total number of queries
-    unaligned_reads_store.set_initial_read_count(len(query_ids))
+    unaligned_reads_store.set_initial_read_count(total_queries)
     
     # set the unaligned reads file to read sequences from
     unaligned_reads_store.set_file(unaligned_reads_file_fasta)
@@ -388,14 +780,6 @@ def unaligned_reads(sam_alignment_file, alignments, unaligned_reads_store, keep_
     if write_picked_frames:
         file_handle_write_unaligned_frames.close()
 
-    # remove the alignment file as it will be replaced by the two files created
-    if not config.resume:
-        if keep_sam:
-            logger.debug("Keeping sam file")
-        else:
-            logger.debug("Remove sam file")
-            utilities.remove_file(sam_alignment_file)
-
     # return the picked frames file if written
     return_list=[unaligned_reads_file_fasta, reduced_aligned_reads_file]
     if write_picked_frames:
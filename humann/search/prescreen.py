@@ -59,7 +59,10 @@ def alignment(input):
     message="Running " + exe + " ........"
     logger.info(message)
     print("\n"+message+"\n")
-    utilities.execute_command(exe, args, [input], [config.profile_file, bowtie2_out])
+    # record the options and database version so a resume only bypasses if these have not changed
+    stage_settings=[exe]+opts+[config.metaphlan_v4_db_version]
+    utilities.execute_command(exe, args, [input], [config.profile_file, bowtie2_out],
+        stage_settings=stage_settings)
     
     return config.profile_file
 
@@ -223,7 +226,10 @@ def create_custom_database(chocophlan_dir, profile_file):
             args=["-c"]
         
         # check if set to bypass this step
-        bypass=utilities.check_outfiles([custom_database])
+        # only bypass if the profile and the species selected have not changed
+        profile_files=[profile_file] if profile_file != "Empty" else []
+        stage_settings=["custom database",chocophlan_dir]+[os.path.basename(file) for file in species_file_list]
+        bypass=utilities.check_outfiles([custom_database], profile_files, stage_settings)
         
         if not bypass:
             # run the command with chunks of input files to not exceed max arguments
@@ -237,5 +243,7 @@ def create_custom_database(chocophlan_dir, profile_file):
             for subset in species_file_list_subsets:
                 utilities.execute_command(exe,args+subset,subset,[],[custom_database,"a"])
 
+            utilities.write_stage_manifest([custom_database], profile_files, stage_settings)
+
         return custom_database
 
@@ -155,13 +155,42 @@ def rapsearch_alignment(alignment_file,uniref, unaligned_reads_file_fasta):
         print(message)
 
 
+def diamond_shard_threads(threads, shards):
+    """
+    Return the number of database shards to align concurrently
+    and the number of threads for each alignment
+    """
+    
+    concurrent=max(1,min(shards, threads // config.diamond_min_threads_per_shard))
+    
+    return concurrent, max(1, threads // concurrent)
+
+def diamond_output_opts(opts):
+    """
+    Return the diamond options with the query length added as a column
+    of the default tabular output format (so the reads do not need length annotations)
+    The options are not changed if the output fields are set or frames are picked
+    (as the query coverage is computed with the read length not the frame length)
+    """
+
+    opts=list(opts)
+    if config.pick_frames_toggle == "on":
+        return opts
+
+    for index, opt in enumerate(opts):
+        if opt in ["--outfmt","-f"] and index+1 < len(opts) and str(opts[index+1]) == "6":
+            if index+2 == len(opts) or str(opts[index+2]).startswith("-"):
+                return opts[:index+2]+config.diamond_outfmt_fields+opts[index+2:]
+            break
+
+    return opts
+
 def diamond_alignment(alignment_file,uniref, unaligned_reads_file_fasta):
     """
     Run diamond alignment on database formatted for diamond
+    The database shards are aligned concurrently within the thread budget
     """
 
-    bypass=utilities.check_outfiles([alignment_file])
-
     exe="diamond"
     
     # Select the command based on a protein or nucleotide database search
@@ -171,10 +200,19 @@ def diamond_alignment(alignment_file,uniref, unaligned_reads_file_fasta):
     else:
         args=[config.diamond_cmmd_nucleotide_search]
         
-    opts=config.diamond_opts
+    opts=diamond_output_opts(config.diamond_opts)
+
+    # only bypass if the reads, databases, and options have not changed
+    database_files=[os.path.join(uniref,database) for database in sorted(os.listdir(uniref))
+        if database.endswith(config.diamond_database_extension)]
+    stage_settings=[exe]+args+list(opts)+[config.evalue_threshold]
+    bypass=utilities.check_outfiles([alignment_file], [unaligned_reads_file_fasta]+database_files, stage_settings)
+
+    # split the threads among the shards aligned at the same time
+    concurrent_shards, shard_threads=diamond_shard_threads(config.threads, len(database_files))
 
     args+=["--query",unaligned_reads_file_fasta,"--evalue",config.evalue_threshold]
-    args+=["--threads",config.threads]
+    args+=["--threads",shard_threads]
 
     message="Running " + exe + " ........"
     logger.info(message)
@@ -183,31 +221,35 @@ def diamond_alignment(alignment_file,uniref, unaligned_reads_file_fasta):
     if not bypass:
         args+=opts
         temp_out_files=[]
-        for database in os.listdir(uniref):          
-            # ignore any files that are not the database files
-            if database.endswith(config.diamond_database_extension):
-                # Provide the database name without the extension
-                input_database=os.path.join(uniref,database)
-                message="Aligning to reference database: " + database
-                logger.info(message)
-                print("\n"+message+"\n")  
-                input_database_extension_removed=re.sub(config.diamond_database_extension
-                    +"$","",input_database)
-                full_args=args+["--db",input_database_extension_removed]
-    
-                # create temp output file
-                temp_out_file=utilities.unnamed_temp_file("diamond_m8_")
-                utilities.remove_file(temp_out_file)
-                
-                temp_out_files.append(temp_out_file)
-    
-                full_args+=["--out",temp_out_file,"--tmpdir",os.path.dirname(temp_out_file)]
-    
-                utilities.execute_command(exe,full_args,[input_database],[])
+        command_args=[]
+        for input_database in database_files:
+            # Provide the database name without the extension
+            message="Aligning to reference database: " + os.path.basename(input_database)
+            logger.info(message)
+            print("\n"+message+"\n")  
+            input_database_extension_removed=re.sub(config.diamond_database_extension
+                +"$","",input_database)
+            full_args=args+["--db",input_database_extension_removed]
+
+            # create temp output file
+            temp_out_file=utilities.unnamed_temp_file("diamond_m8_")
+            utilities.remove_file(temp_out_file)
+            
+            temp_out_files.append(temp_out_file)
+
+            full_args+=["--out",temp_out_file,"--tmpdir",os.path.dirname(temp_out_file)]
+
+            command_args.append([exe,full_args,[input_database],[],None,None,True,None])
         
-        # merge the temp output files
+        logger.debug("Aligning to " + str(concurrent_shards) + " database shards at a time with " +
+            str(shard_threads) + " threads each")
+        utilities.command_threading(concurrent_shards,command_args)
+        
+        # merge the temp output files in the sorted order of the databases
         utilities.execute_command("cat",temp_out_files,temp_out_files,[alignment_file],
             alignment_file)
+        
+        utilities.write_stage_manifest([alignment_file], [unaligned_reads_file_fasta]+database_files, stage_settings)
 
     else:
         message="Bypass"
@@ -223,10 +265,16 @@ def alignment(uniref, unaligned_reads_file):
         "_" + config.translated_alignment_selected 
         + config.translated_alignment_name)
     
+    # diamond writes the query length so the reads do not need to be length annotated
+    # (diamond reads fastq files directly)
+    length_annotation=True
+    if config.translated_alignment_selected == "diamond" and config.pick_frames_toggle != "on":
+        length_annotation=diamond_output_opts(config.diamond_opts) == list(config.diamond_opts)
+
     # Check that the file of reads to align is fasta
     temp_file=""
     unaligned_reads_file_format=utilities.fasta_or_fastq(unaligned_reads_file)
-    if unaligned_reads_file_format == "fastq":
+    if unaligned_reads_file_format == "fastq" and length_annotation:
         logger.debug("Convert unaligned reads fastq file to fasta")
         # Convert file to fasta, also pick frames if selected
         if config.pick_frames_toggle == "on":
@@ -237,7 +285,7 @@ def alignment(uniref, unaligned_reads_file):
             input_fasta=utilities.fastq_to_fasta(unaligned_reads_file, length_annotation=True)
         # set the file as a temp to be removed later
         temp_file=input_fasta
-    elif unaligned_reads_file_format == "fasta" and config.bypass_nucleotide_search:
+    elif unaligned_reads_file_format == "fasta" and config.bypass_nucleotide_search and length_annotation:
         if config.pick_frames_toggle == "on":
             # Process the fasta file to pick frames
             logger.debug("Applying pick frames")
@@ -248,6 +296,10 @@ def alignment(uniref, unaligned_reads_file):
             input_fasta=utilities.length_annotate_fasta(unaligned_reads_file)
             # set the file as a temp to be removed later
             temp_file=input_fasta
+    elif utilities.compressed_extension(unaligned_reads_file) == ".bz2":
+        # diamond reads gzipped (but not bzip2) files directly
+        input_fasta=utilities.gunzip_file(unaligned_reads_file)
+        temp_file=input_fasta
     else:
         input_fasta=unaligned_reads_file
 
@@ -287,17 +339,17 @@ def unaligned_reads(unaligned_reads_store, alignment_file_tsv, alignments):
         return unaligned_file_fasta
         
     # get the list of proteins from the alignment that meet the coverage threshold
+    # storing the alignments that pass the filters
+    filtered_alignments=store.FilteredAlignments()
     allowed_proteins = blastx_coverage.blastx_coverage(alignment_file_tsv,
         config.translated_subject_coverage_threshold, alignments, log_messages=True, apply_filter=True,
         query_coverage_threshold=config.translated_query_coverage_threshold,
-        identity_threshold = config.identity_threshold)
+        identity_threshold = config.identity_threshold, filtered_alignments=filtered_alignments)
 
     # run through final filter of alignment by allowed proteins
     small_coverage_count=0
-    for alignment_info in utilities.get_filtered_translated_alignments(alignment_file_tsv, alignments,
-                                                  apply_filter=True, log_filter=True, identity_threshold=config.identity_threshold):
-        (protein_name, gene_length, queryid, matches, bug, alignment_length,
-         subject_start_index, subject_stop_index) = alignment_info
+    for alignment_info in filtered_alignments.alignment_list():
+        (protein_name, gene_length, queryid, matches, bug, alignment_length) = alignment_info
         # check the protein matches one allowed
         if protein_name in allowed_proteins:
             # if matches allowed, then add alignment
@@ -308,15 +360,13 @@ def unaligned_reads(unaligned_reads_store, alignment_file_tsv, alignments):
             unaligned_reads_store.remove_id(queryid)
         else:
             small_coverage_count+=1
+    filtered_alignments.clear()
 
     logger.debug("Total translated alignments not included based on small subject coverage value: " + 
         str(small_coverage_count))
 
     # create unaligned file using list of remaining unaligned stored data
-    file_handle_write=open(unaligned_file_fasta,"w")
-    for fasta_line in unaligned_reads_store.get_fasta():
-        file_handle_write.write(fasta_line+"\n")
-    file_handle_write.close()
+    unaligned_reads_store.write_fasta(unaligned_file_fasta)
 
     return unaligned_file_fasta
 
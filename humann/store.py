@@ -34,6 +34,10 @@ import math
 import sys
 import gzip
 import bz2
+import struct
+import itertools
+
+from array import array
 
 from . import config
 from . import utilities
@@ -41,6 +45,9 @@ from . import utilities
 # name global logging instance
 logger=logging.getLogger(__name__)
 
+# the pattern for a gene length in a reference annotation
+gene_length_pattern=re.compile("^[0-9]+$")
+
 def store_id_mapping(file):
     """
     Store the id mapping data from the tab delimited file
@@ -91,6 +98,18 @@ def store_id_mapping(file):
     
     return id_mapping 
 
+def is_reference_table(file):
+    """
+    Check if the id mapping file is a reference table written by humann_reference_table
+    (with the sgb as the bug so the species for the sgb is set for each sample)
+    """
+    
+    try:
+        with open(file,"rt") as file_handle:
+            return file_handle.readline().rstrip() == config.reference_table_marker
+    except EnvironmentError:
+        return False
+
 def normalized_gene_length(gene_length, read_length):
     """
     Compute the normalized gene length with the average read length if set
@@ -108,32 +127,182 @@ def normalized_gene_length(gene_length, read_length):
 
     return new_gene_length
 
+def sgb_bug(sgb):
+    """
+    Return the bug for the sgb using the sgb to species mapping
+    """
+    
+    return config.sgb_to_species_mapping.get(sgb,"unclassified")+".t__"+sgb
+
+class QueryIds:
+    """
+    Holds the query (read) names each mapped to an integer id
+    The stores share an instance so each name is only stored once
+    """
+    
+    def __init__(self):
+        self.__ids={}
+        self.__names=[]
+        # the copies of each read if the duplicate reads were collapsed (indexed by id)
+        self.__weights=array("i")
+        
+    def get_id(self, name):
+        """
+        Return the id for the name, adding the name if not present
+        """
+        
+        try:
+            return self.__ids[name]
+        except KeyError:
+            id=len(self.__names)
+            self.__ids[name]=id
+            self.__names.append(name)
+            return id
+        
+    def find_id(self, name):
+        """
+        Return the id for the name (or None if not present)
+        """
+        
+        return self.__ids.get(name)
+    
+    def get_name(self, id):
+        """
+        Return the name for the id
+        """
+        
+        return self.__names[id]
+    
+    def count(self):
+        """
+        Return the total number of names
+        """
+        
+        return len(self.__names)
+    
+    def set_weight(self, id, weight):
+        """
+        Set the weight (the copies of the read) for the id
+        """
+        
+        if id >= len(self.__weights):
+            self.__weights.extend([1]*(id+1-len(self.__weights)))
+        self.__weights[id]=weight
+        
+    def get_weight(self, id):
+        """
+        Return the weight for the id (the default is one)
+        """
+        
+        if id < len(self.__weights):
+            return self.__weights[id]
+        return 1
+    
+    def weighted(self):
+        """
+        Return True if weights have been set
+        """
+        
+        return len(self.__weights) > 0
+    
+    def clear(self):
+        """
+        Clear all of the names
+        """
+        
+        self.__ids.clear()
+        del self.__names[:], self.__weights[:]
+
 class Alignments:
     """
     Holds all of the alignments for all bugs
     """
     
-    def __init__(self,minimize_memory_use=None):
-        self.__total_scores_by_query={}
-        self.__multiple_hits_queries={}
-        self.__hits_by_query={}
+    def __init__(self,minimize_memory_use=None,memory_budget=None,grouped_queries=None,query_ids=None):
+        # the query, bug, and gene ids are interned as integers
+        # the queries are numbered in the order they are added with the id of the name
+        # of each from the query ids (which are shared with the other stores if provided)
+        self.__queries=query_ids
+        self.__shared_query_ids=query_ids is not None
+        if query_ids is None:
+            self.__queries=QueryIds()
+        self.__query_by_name_id=array("i")
+        self.__query_name_ids=array("i")
+        self.__bug_ids={}
+        self.__bug_names=[]
+        self.__gene_ids={}
+        self.__gene_names=[]
+
+        # the total score, first and last hit for each query (indexed by query id)
+        # (or the first and last run of hits if written to the temp alignments file)
+        self.__total_scores_by_query=array("d")
+        self.__first_by_query=array("q")
+        self.__last_by_query=array("q")
+        # the query ids in the order they were found to have multiple hits
+        self.__query_has_multiple_hits=bytearray()
+        self.__multiple_hits_queries=array("i")
+
+        # the hits stored in memory as a set of arrays (indexed by hit)
+        # with the next hit for the same query to keep the hits grouped by query
+        self.__hit_bugs=array("i")
+        self.__hit_genes=array("i")
+        self.__hit_scores=array("d")
+        self.__hit_lengths=array("d")
+        self.__next_hit=array("q")
+
         self.__scores_by_bug_gene={}
         self.__gene_counts={}
         self.__bug_counts={}
         self.__id_mapping={}   
+        self.__id_mapping_sgb_bugs=False
+        self.__reference_annotations={}
         
+        # the hits written to the temp alignments file as fixed width records
+        # (query id, bug id, gene id, score, length) with the runs of records
+        # for the same query (start record, number of records, next run for the query)
         self.__temp_alignments_file=None
         self.__temp_alignments_file_handle=None
-        self.__delimiter="\t"
-        
-        if minimize_memory_use:
+        self.__temp_alignments_record=struct.Struct("<iiidd")
+        self.__temp_alignments_records=0
+        self.__run_starts=array("q")
+        self.__run_counts=array("i")
+        self.__next_run=array("q")
+        
+        # if a memory budget is set, store the hits in memory until it is exceeded
+        self.__memory_budget=memory_budget
+        self.__additions=0
+        
+        # if the hits for each query are expected to be added together, the query
+        # normalization is applied as each query is complete with the hits written to
+        # the temp alignments file as a group (query length, total hits, query, hits)
+        # with each hit as (bug id, gene id, score, length)
+        # if a query is found again after it is complete, the query normalization
+        # is applied to all hits from the temp alignments file
+        # a hash of each query completed is stored to find a query again, so the
+        # memory used still grows with the number of reads aligned (though much less
+        # than storing the total scores and the hits for each query)
+        self.__grouped_queries=bool(grouped_queries)
+        self.__queries_grouped=True
+        self.__query_group=None
+        self.__query_group_hits=[]
+        self.__query_groups_written=set()
+        self.__query_group_header=struct.Struct("<Ii")
+        self.__query_group_record=struct.Struct("<iidd")
+        
+        if grouped_queries:
+            self.__minimize_memory_use=True
+            logger.debug("Initialize Alignments class instance to normalize the hits for each query as added")
+        elif minimize_memory_use:
             self.__minimize_memory_use=True
             logger.debug("Initialize Alignments class instance to minimize memory use")
+        elif memory_budget is not None:
+            self.__minimize_memory_use=False
+            logger.debug("Initialize Alignments class instance to use memory up to " + str(memory_budget) + " GB")
         else:
             self.__minimize_memory_use=False
             logger.debug("Initialize Alignments class instance to maximize memory use")
         
-    def write_temp_alignments_file(self,query,bug,reference,score,normalized_reference_length):
+    def write_temp_alignments_file(self,query_id,bug_id,gene_id,score,normalized_reference_length):
         """
         Write an alignment to the temp alignments file, first create if needed
         """
@@ -141,40 +310,82 @@ class Alignments:
         if not self.__temp_alignments_file:
             self.create_temp_alignments_file()
         
-        line=self.__delimiter.join([query,bug,reference,str(score),str(normalized_reference_length)])
+        # extend the run if the last record written was for the same query
+        record=self.__temp_alignments_records
+        if self.__run_starts and self.__last_by_query[query_id] == len(self.__run_starts)-1:
+            self.__run_counts[-1]+=1
+        else:
+            run=len(self.__run_starts)
+            self.__run_starts.append(record)
+            self.__run_counts.append(1)
+            self.__next_run.append(-1)
+            if self.__first_by_query[query_id] == -1:
+                self.__first_by_query[query_id]=run
+            else:
+                self.__next_run[self.__last_by_query[query_id]]=run
+            self.__last_by_query[query_id]=run
         
         try:
-            self.__temp_alignments_file_handle.write(line+"\n")
+            self.__temp_alignments_file_handle.write(self.__temp_alignments_record.pack(
+                query_id,bug_id,gene_id,score,normalized_reference_length))
         except EnvironmentError:
             logger.warning("Unable to write to temp alignments file")
+        self.__temp_alignments_records+=1
             
-    def read_temp_alignments_file(self, queries):
+    def read_temp_alignments_file(self, queries=None):
         """
-        Read in those alignments which are included in queries
+        Read in those alignments which are included in queries (a list of query ids)
+        Read all alignments if queries are not provided
         """
         
-        # close and reopen the temp alignments file
-        line=""
-        try:
-            self.__temp_alignments_file_handle.close()
-            self.__temp_alignments_file_handle=open(self.__temp_alignments_file, "rt")
-        
-            line=self.__temp_alignments_file_handle.readline()
-        except (EnvironmentError, AttributeError):
-            pass
-            
-        while line:
-            # lines should be of the format query \t bug \t reference \t score \t length
-            (query,bug,reference,score,length)=line.rstrip().split(self.__delimiter)
-            if query in queries:
-                yield (query,bug,reference,float(score),float(length))
-                
-            line=self.__temp_alignments_file_handle.readline()
+        for (query_id,bug_id,gene_id,score,length) in self.read_temp_alignments_records(queries):
+            yield (self.__queries.get_name(self.__query_name_ids[query_id]),self.__bug_names[bug_id],
+                self.__gene_names[gene_id],score,length)
             
+    def read_temp_alignments_records(self, queries=None):
+        """
+        Read in the records (with query, bug, and gene ids) for the alignments
+        which are included in queries (or all alignments if queries are not provided)
+        """
+        
+        if not self.__temp_alignments_file:
+            return
+        
+        # find the ranges of records to read, in the order they were written
+        if queries is None:
+            ranges=[(0,self.__temp_alignments_records)]
+        else:
+            runs=[]
+            for query_id in queries:
+                run=self.__first_by_query[query_id]
+                while run != -1:
+                    runs.append((self.__run_starts[run],self.__run_counts[run]))
+                    run=self.__next_run[run]
+            runs.sort()
+            ranges=[]
+            for start, count in runs:
+                end=start+count
+                if ranges and ranges[-1][1] == start:
+                    ranges[-1]=(ranges[-1][0],end)
+                else:
+                    ranges.append((start,end))
+        
+        record_size=self.__temp_alignments_record.size
+        records_per_read=config.temp_alignments_records_per_read
         try:
-            self.__temp_alignments_file_handle.close()
-        except (EnvironmentError, AttributeError):
-            pass
+            self.__temp_alignments_file_handle.flush()
+            for start, end in ranges:
+                while start < end:
+                    count=min(records_per_read,end-start)
+                    self.__temp_alignments_file_handle.seek(start*record_size)
+                    data=self.__temp_alignments_file_handle.read(count*record_size)
+                    for record in self.__temp_alignments_record.iter_unpack(data):
+                        yield record
+                    start+=count
+            # return to the end of the file for any alignments added
+            self.__temp_alignments_file_handle.seek(0,os.SEEK_END)
+        except EnvironmentError:
+            logger.warning("Unable to read from temp alignments file")
         
     def create_temp_alignments_file(self):
         """
@@ -184,7 +395,7 @@ class Alignments:
         self.__temp_alignments_file=utilities.unnamed_temp_file("temp_alignments")
         
         try:
-            self.__temp_alignments_file_handle=open(self.__temp_alignments_file, "w")
+            self.__temp_alignments_file_handle=open(self.__temp_alignments_file, "w+b")
         except EnvironmentError:
             sys.exit("CRITICAL ERROR: Unable to open temp alignments file")
         
@@ -193,6 +404,14 @@ class Alignments:
         Delete the temp alignments file
         """
         
+        self.__queries_grouped=True
+        self.__query_group=None
+        self.__query_group_hits=[]
+        self.__query_groups_written.clear()
+        
+        if not self.__temp_alignments_file:
+            return
+        
         try:
             self.__temp_alignments_file_handle.close()
         except EnvironmentError:
@@ -205,6 +424,163 @@ class Alignments:
         
         self.__temp_alignments_file=None
         self.__temp_alignments_file_handle=None
+        self.__temp_alignments_records=0
+        for values in [self.__run_starts, self.__run_counts, self.__next_run]:
+            del values[:]
+        for run_by_query in [self.__first_by_query, self.__last_by_query]:
+            del run_by_query[:]
+            run_by_query.extend([-1]*len(self.__query_name_ids))
+        
+    def add_query_group_hit(self,query,bug_id,gene_id,score,normalized_reference_length):
+        """
+        Add the hit to the group of hits for the query
+        Complete the prior query if the hit is for a new query
+        The hash of each query completed is stored (one for each read aligned)
+        to check the hits for each query are added together
+        """
+        
+        if query != self.__query_group:
+            self.write_query_group()
+            self.__query_group=query
+            
+            # check if the query has been found before
+            if self.__queries_grouped:
+                query_hash=hash(query)
+                if query_hash in self.__query_groups_written:
+                    logger.info("Alignments are not grouped by query, the query normalization "+
+                        "will be applied once all alignments are added")
+                    self.__queries_grouped=False
+                    self.__query_groups_written.clear()
+                else:
+                    self.__query_groups_written.add(query_hash)
+            
+        self.__query_group_hits.append((bug_id,gene_id,score,normalized_reference_length))
+        
+    def write_query_group(self):
+        """
+        Write the hits for the current query to the temp alignments file
+        Apply the query normalization if the queries are grouped
+        """
+        
+        hits=self.__query_group_hits
+        if not hits:
+            return
+        
+        if not self.__temp_alignments_file:
+            self.create_temp_alignments_file()
+            
+        query=self.__query_group.encode("utf-8")
+        data=[self.__query_group_header.pack(len(query),len(hits)),query]
+        for hit in hits:
+            data.append(self.__query_group_record.pack(*hit))
+        try:
+            self.__temp_alignments_file_handle.write(b"".join(data))
+        except EnvironmentError:
+            logger.warning("Unable to write to temp alignments file")
+            
+        if self.__queries_grouped and len(hits) > 1:
+            query_normalize=0
+            for (bug_id,gene_id,score,length) in hits:
+                query_normalize+=score
+            for (bug_id,gene_id,score,length) in hits:
+                scores=self.__scores_by_bug_gene[self.__bug_names[bug_id]]
+                gene=self.__gene_names[gene_id]
+                original_score=1/length
+                scores[gene]=scores[gene]-original_score+score/query_normalize*original_score
+        
+        self.__query_group_hits=[]
+        
+    def read_query_groups(self):
+        """
+        Read the groups of hits for each query from the temp alignments file
+        """
+        
+        self.write_query_group()
+        self.__query_group=None
+        
+        if not self.__temp_alignments_file:
+            return
+        
+        header_size=self.__query_group_header.size
+        record_size=self.__query_group_record.size
+        try:
+            self.__temp_alignments_file_handle.flush()
+            self.__temp_alignments_file_handle.seek(0)
+            while True:
+                header=self.__temp_alignments_file_handle.read(header_size)
+                if len(header) < header_size:
+                    break
+                query_length, total_hits = self.__query_group_header.unpack(header)
+                query=self.__temp_alignments_file_handle.read(query_length).decode("utf-8")
+                data=self.__temp_alignments_file_handle.read(total_hits*record_size)
+                hits=[(self.__bug_names[bug_id],self.__gene_names[gene_id],score,length)
+                    for (bug_id,gene_id,score,length) in self.__query_group_record.iter_unpack(data)]
+                yield query, hits
+            # return to the end of the file for any alignments added
+            self.__temp_alignments_file_handle.seek(0,os.SEEK_END)
+        except EnvironmentError:
+            logger.warning("Unable to read from temp alignments file")
+            
+    def normalize_query_groups(self):
+        """
+        Compute the scores for all of the hits from the temp alignments file
+        This is used if the hits for each query were not added together
+        """
+        
+        # compute the scores for each hit and the total score for each query
+        self.__scores_by_bug_gene={}
+        total_scores_by_query={}
+        multiple_hits_queries=set()
+        for query, hits in self.read_query_groups():
+            for (bug,reference,score,length) in hits:
+                if query in total_scores_by_query:
+                    multiple_hits_queries.add(query)
+                    total_scores_by_query[query]+=score
+                else:
+                    total_scores_by_query[query]=score
+                    
+                normalized_score=1
+                if config.count_normalization != "Counts":
+                    normalized_score=1/length
+                elif self.__queries.weighted():
+                    normalized_score=self.__queries.get_weight(self.__queries.get_id(query))
+                    
+                if bug in self.__scores_by_bug_gene:
+                    self.__scores_by_bug_gene[bug][reference]=self.__scores_by_bug_gene[bug].get(reference,0)+normalized_score
+                else:
+                    self.__scores_by_bug_gene[bug]={reference:normalized_score}
+        
+        # apply the query normalization for queries with multiple hits
+        for query, hits in self.read_query_groups():
+            if query in multiple_hits_queries:
+                query_normalize=total_scores_by_query[query]
+                for (bug,reference,score,length) in hits:
+                    scores=self.__scores_by_bug_gene[bug]
+                    original_score=1/length
+                    scores[reference]=scores[reference]-original_score+score/query_normalize*original_score
+        
+    def write_hits_to_temp_alignments_file(self):
+        """
+        Move the hits stored in memory to the temp alignments file
+        The hits for each query are written together and any hits added after
+        are written to the temp alignments file
+        """
+        
+        message="Memory budget exceeded, writing alignments to temp file"
+        logger.info(message)
+        
+        for query_id in range(len(self.__query_name_ids)):
+            hit=self.__first_by_query[query_id]
+            self.__first_by_query[query_id]=-1
+            self.__last_by_query[query_id]=-1
+            while hit != -1:
+                self.write_temp_alignments_file(query_id,self.__hit_bugs[hit],self.__hit_genes[hit],
+                    self.__hit_scores[hit],self.__hit_lengths[hit])
+                hit=self.__next_hit[hit]
+                
+        for values in [self.__hit_bugs, self.__hit_genes, self.__hit_scores, self.__hit_lengths, self.__next_hit]:
+            del values[:]
+        self.__minimize_memory_use=True
         
     def process_id_mapping(self,file):
         """
@@ -212,6 +588,8 @@ class Alignments:
         """
         
         self.__id_mapping=store_id_mapping(file)
+        self.__id_mapping_sgb_bugs=is_reference_table(file)
+        self.__reference_annotations.clear()
         
     def process_chocophlan_length(self,location,gene):
         """
@@ -235,6 +613,22 @@ class Alignments:
         return length
 
     def process_reference_annotation(self,reference):
+        """
+        Return the gene, gene length, and bug for the reference
+        Each reference is processed once with the annotations stored for
+        the references seen (up to the maximum set in the config)
+        """
+        
+        annotation=self.__reference_annotations.get(reference)
+        if annotation is None:
+            annotation=self.parse_reference_annotation(reference)
+            if len(self.__reference_annotations) >= config.reference_annotations_max:
+                self.__reference_annotations.clear()
+            self.__reference_annotations[reference]=annotation
+            
+        return annotation
+
+    def parse_reference_annotation(self,reference):
         """
         Process the reference string for information on gene, gene length, and bug
         Allow for chocophlan annotations, gene|gene_length, gene_length|gene, and gene
@@ -246,6 +640,9 @@ class Alignments:
         if self.__id_mapping:
             if reference in self.__id_mapping:
                 [gene,length,bug]=self.__id_mapping[reference]
+                # the species is set for the sgb bugs from the reference table
+                if self.__id_mapping_sgb_bugs and bug.startswith("SGB"):
+                    bug=sgb_bug(bug)
                 
         # if id mapping is not provided or not found for the reference then
         # try to process the reference string
@@ -260,8 +657,7 @@ class Alignments:
                 full_taxonomy=reference_info[config.chocophlan_bug_index]
                 # Limit to species/genera unless sgb
                 if full_taxonomy.startswith("SGB"):
-                    # get the sgb to species mapping
-                    bug=config.sgb_to_species_mapping.get(full_taxonomy,"unclassified")+".t__"+full_taxonomy
+                    bug=sgb_bug(full_taxonomy)
                 else:
                     bug_info=full_taxonomy.split(".")
                     bug=".".join([bug_info[config.chocophlan_bug_genera_index],bug_info[config.chocophlan_bug_species_index]])
@@ -279,16 +675,16 @@ class Alignments:
             except (IndexError, ValueError):
                 # try to find gene length if present
                 # check for gene|gene_length|taxonomy
-                if (len(reference_info)==3 and re.search("^[0-9]+$",reference_info[1])
-                    and not re.search("^[0-9]+$",reference_info[2])):
+                if (len(reference_info)==3 and gene_length_pattern.search(reference_info[1])
+                    and not gene_length_pattern.search(reference_info[2])):
                     bug=reference_info[2]
                     length=int(reference_info[1])
                     gene=reference_info[0]
                 elif len(reference_info)==2:
-                    if re.search("^[0-9]+$",reference_info[1]):
+                    if gene_length_pattern.search(reference_info[1]):
                         length=int(reference_info[1])
                         gene=reference_info[0]
-                    elif re.search("^[0-9]+$",reference_info[0]):
+                    elif gene_length_pattern.search(reference_info[0]):
                         length=int(reference_info[0])
                         gene=reference_info[1]
 
@@ -318,6 +714,11 @@ class Alignments:
             reference_length=config.default_reference_length
             logger.debug("Default gene length used for alignment to gene: " + reference)
         
+        # weight the hit by the copies of the read if the duplicate reads were collapsed
+        weight=1
+        if self.__queries.weighted():
+            weight=self.__queries.get_weight(self.__queries.get_id(query))
+        
         # store the score instead of the number of matches
         try:
             score=math.pow(matches,config.match_power)
@@ -326,21 +727,9 @@ class Alignments:
             score=0.0
             
         # Increase the counts for gene and bug
-        self.__bug_counts[bug]=self.__bug_counts.get(bug,0)+1
-        self.__gene_counts[reference]=self.__gene_counts.get(reference,0)+1
+        self.__bug_counts[bug]=self.__bug_counts.get(bug,0)+weight
+        self.__gene_counts[reference]=self.__gene_counts.get(reference,0)+weight
             
-        # Add to the scores by query and store if query has multiple scores
-        if query in self.__total_scores_by_query:
-            current_query_total=self.__total_scores_by_query[query]
-            if query in self.__multiple_hits_queries:
-                self.__multiple_hits_queries[query]=self.__multiple_hits_queries[query]+[score]
-            else:
-                self.__multiple_hits_queries[query]=[current_query_total,score]
-                
-            self.__total_scores_by_query[query]=current_query_total+score
-        else:
-            self.__total_scores_by_query[query]=score
-        
         # Store the scores by bug and gene
         normalized_reference_length=normalized_gene_length(reference_length, read_length)
 
@@ -348,22 +737,77 @@ class Alignments:
         normalized_score=1
         if config.count_normalization != "Counts":
             normalized_score=1/normalized_reference_length
+            
+        # the length stored for a weighted hit is divided by the weight
+        # so the query normalization is applied for each copy of the read
+        if weight != 1:
+            normalized_score*=weight
+            normalized_reference_length/=weight
 
         if bug in self.__scores_by_bug_gene:
             self.__scores_by_bug_gene[bug][reference]=self.__scores_by_bug_gene[bug].get(reference,0)+normalized_score
         else:
             self.__scores_by_bug_gene[bug]={reference:normalized_score}
             
+        bug_id=self.__bug_ids.get(bug)
+        if bug_id is None:
+            bug_id=len(self.__bug_names)
+            self.__bug_ids[bug]=bug_id
+            self.__bug_names.append(bug)
+        gene_id=self.__gene_ids.get(reference)
+        if gene_id is None:
+            gene_id=len(self.__gene_names)
+            self.__gene_ids[reference]=gene_id
+            self.__gene_names.append(reference)
+
+        # add to the group of hits for the query if grouped
+        if self.__grouped_queries:
+            self.add_query_group_hit(query, bug_id, gene_id, score, normalized_reference_length)
+            return
+            
+        # Add to the scores by query and store if query has multiple scores
+        name_id=self.__queries.get_id(query)
+        query_id=self.find_query(name_id)
+        if query_id == -1:
+            query_id=len(self.__query_name_ids)
+            self.__query_by_name_id[name_id]=query_id
+            self.__query_name_ids.append(name_id)
+            self.__total_scores_by_query.append(score)
+            self.__first_by_query.append(-1)
+            self.__last_by_query.append(-1)
+            self.__query_has_multiple_hits.append(0)
+        else:
+            # record the query the first time a second hit is found
+            if not self.__query_has_multiple_hits[query_id]:
+                self.__query_has_multiple_hits[query_id]=1
+                self.__multiple_hits_queries.append(query_id)
+            self.__total_scores_by_query[query_id]+=score
+        
         # write the information for the hit to the temp alignments file
         # or store in memory depending on the memory use setting
         if self.__minimize_memory_use:
-            self.write_temp_alignments_file(query, bug, reference, score, normalized_reference_length)
+            self.write_temp_alignments_file(query_id, bug_id, gene_id, score, normalized_reference_length)
         else:
-            hit=(bug,reference,score,normalized_reference_length)
-            if query in self.__hits_by_query:
-                self.__hits_by_query[query].append(hit)
+            hit=len(self.__hit_scores)
+            self.__hit_bugs.append(bug_id)
+            self.__hit_genes.append(gene_id)
+            self.__hit_scores.append(score)
+            self.__hit_lengths.append(normalized_reference_length)
+            self.__next_hit.append(-1)
+
+            # link the hit to the prior hit for the query
+            if self.__first_by_query[query_id] == -1:
+                self.__first_by_query[query_id]=hit
             else:
-                self.__hits_by_query[query]=[hit]
+                self.__next_hit[self.__last_by_query[query_id]]=hit
+            self.__last_by_query[query_id]=hit
+
+            # check the memory used if a budget is set
+            if self.__memory_budget is not None:
+                self.__additions+=1
+                if (self.__additions % config.memory_budget_check_additions == 0 and
+                    utilities.current_memory() > self.__memory_budget):
+                    self.write_hits_to_temp_alignments_file()
             
     def count_bugs(self):
         """ 
@@ -376,6 +820,12 @@ class Alignments:
         Return total number of genes
         """
         return len(self.__gene_counts)      
+
+    def count_hits(self):
+        """ 
+        Return total number of hits
+        """
+        return sum(self.__bug_counts.values())
             
     def counts_by_bug(self):
         """
@@ -401,6 +851,36 @@ class Alignments:
         
         return list(self.__bug_counts.keys())
     
+    def find_query(self,name_id):
+        """
+        Return the number of the query (in the order added) from the id of its name (or -1 if not added)
+        """
+        
+        # extend the queries by name id to include those added by the other stores
+        if name_id >= len(self.__query_by_name_id):
+            self.__query_by_name_id.extend([-1]*(self.__queries.count()-len(self.__query_by_name_id)))
+            
+        return self.__query_by_name_id[name_id]
+    
+    def query_names(self):
+        """
+        Yield the names of the queries in the order added
+        """
+        
+        for id in self.__query_name_ids:
+            yield self.__queries.get_name(id)
+    
+    def query_hits(self,query_id):
+        """
+        Yield the hits stored in memory for the query id
+        """
+        
+        hit=self.__first_by_query[query_id]
+        while hit != -1:
+            yield (self.__bug_names[self.__hit_bugs[hit]],self.__gene_names[self.__hit_genes[hit]],
+                self.__hit_scores[hit],self.__hit_lengths[hit])
+            hit=self.__next_hit[hit]
+    
     def get_hit_list(self):
         """
         Return a list of all of the hits
@@ -408,14 +888,19 @@ class Alignments:
         
         # Add the query to the hits
         list=[]
-        # if the hits are stored in memory use the dictionary
-        if self.__hits_by_query:
-            for query in self.__hits_by_query:
-                for (bug,reference,score,length) in self.__hits_by_query[query]:
-                    list.append([query]+[bug,reference,score,length])
+        # if the hits are grouped by query read the groups from the temp file
+        if self.__grouped_queries:
+            for query, hits in self.read_query_groups():
+                for (bug,reference,score,length) in hits:
+                    list.append([query,bug,reference,score,length])
+        # if the hits are stored in memory use the arrays
+        elif not self.__minimize_memory_use:
+            for query_id, query in enumerate(self.query_names()):
+                for (bug,reference,score,length) in self.query_hits(query_id):
+                    list.append([query,bug,reference,score,length])
         else:
             # else read through the temp file for the hits
-            for (query,bug,reference,score,length) in self.read_temp_alignments_file(self.__total_scores_by_query):
+            for (query,bug,reference,score,length) in self.read_temp_alignments_file():
                 list.append([query,bug,reference,score,length])
                 
         return list
@@ -427,15 +912,21 @@ class Alignments:
         
         # Add the query to the hits
         list=[]
-        # if the hits are stored in memory use the dictionary
-        if self.__hits_by_query:
-            for query in self.__hits_by_query:
-                for (bug,reference,score,length) in self.__hits_by_query[query]:
+        # if the hits are grouped by query read the groups from the temp file
+        if self.__grouped_queries:
+            for query, hits in self.read_query_groups():
+                for (bug,reference,score,length) in hits:
                     if reference==gene:
-                        list.append([query]+[bug,reference,score,length])
+                        list.append([query,bug,reference,score,length])
+        # if the hits are stored in memory use the arrays
+        elif not self.__minimize_memory_use:
+            for query_id, query in enumerate(self.query_names()):
+                for (bug,reference,score,length) in self.query_hits(query_id):
+                    if reference==gene:
+                        list.append([query,bug,reference,score,length])
         else:
             # else read through the temp file for the hits
-            for (query,bug,reference,score,length) in self.read_temp_alignments_file(self.__total_scores_by_query):
+            for (query,bug,reference,score,length) in self.read_temp_alignments_file():
                 if reference==gene:
                     list.append([query,bug,reference,score,length])
                 
@@ -451,7 +942,7 @@ class Alignments:
         # Hits where it is the only match per query will have scores of 1
         # as this is the result of normalizing (ie score/score)
         
-        query_normalize=self.__total_scores_by_query[query]
+        query_normalize=self.__total_scores_by_query[self.find_query(self.__queries.find_id(query))]
         
         original_score=1/length
         updated_score=score/query_normalize*original_score
@@ -465,16 +956,41 @@ class Alignments:
         """
         
         # Normalize by query hits for all queries with multiple hits
-        
+        # The scores for each bug are looked up once by bug id and the score added
+        # for each hit is updated as in add_query_normalization_to_alignment_score
+        scores_by_bug=[self.__scores_by_bug_gene[bug] for bug in self.__bug_names]
+        gene_names=self.__gene_names
+        total_scores_by_query=self.__total_scores_by_query
+        
+        # if the hits are grouped by query, the normalization is applied as each query is complete
+        if self.__grouped_queries:
+            self.write_query_group()
+            self.__query_group=None
+            if not self.__queries_grouped:
+                self.normalize_query_groups()
         # process through the temp alignments file if the data is not stored in memory
-        if not self.__hits_by_query:
-            for (query,bug,reference,score,length) in self.read_temp_alignments_file(self.__multiple_hits_queries):
-                self.add_query_normalization_to_alignment_score(query,bug,reference,score,length)
+        elif self.__minimize_memory_use:
+            for (query_id,bug_id,gene_id,score,length) in self.read_temp_alignments_records(self.__multiple_hits_queries):
+                scores=scores_by_bug[bug_id]
+                gene=gene_names[gene_id]
+                original_score=1/length
+                scores[gene]=scores[gene]-original_score+score/total_scores_by_query[query_id]*original_score
         # use the hits stored in memory
         else:
-            for query in self.__multiple_hits_queries:
-                for (bug,reference,score,length) in self.__hits_by_query[query]:
-                    self.add_query_normalization_to_alignment_score(query, bug, reference, score, length)
+            hit_bugs=self.__hit_bugs
+            hit_genes=self.__hit_genes
+            hit_scores=self.__hit_scores
+            hit_lengths=self.__hit_lengths
+            next_hit=self.__next_hit
+            for query_id in self.__multiple_hits_queries:
+                query_normalize=total_scores_by_query[query_id]
+                hit=self.__first_by_query[query_id]
+                while hit != -1:
+                    scores=scores_by_bug[hit_bugs[hit]]
+                    gene=gene_names[hit_genes[hit]]
+                    original_score=1/hit_lengths[hit]
+                    scores[gene]=scores[gene]-original_score+hit_scores[hit]/query_normalize*original_score
+                    hit=next_hit[hit]
         
         # compute the scores for the genes
         all_gene_scores={}
@@ -516,13 +1032,120 @@ class Alignments:
         Clear all of the stored data
         """
         
-        self.__total_scores_by_query.clear()
-        self.__multiple_hits_queries.clear()
-        self.__hits_by_query.clear()
+        # the hits in the temp alignments file refer to the ids cleared
+        self.delete_temp_alignments_file()
+        
+        if not self.__shared_query_ids:
+            self.__queries.clear()
+        self.__bug_ids.clear()
+        self.__gene_ids.clear()
+        del self.__bug_names[:], self.__gene_names[:]
+        for values in [self.__query_by_name_id, self.__query_name_ids, self.__total_scores_by_query,
+            self.__first_by_query, self.__last_by_query, self.__query_has_multiple_hits, self.__multiple_hits_queries, self.__hit_bugs, self.__hit_genes,
+            self.__hit_scores, self.__hit_lengths, self.__next_hit]:
+            del values[:]
         self.__scores_by_bug_gene.clear()
         self.__gene_counts.clear()
         self.__bug_counts.clear()
 
+
+class FilteredAlignments:
+    """
+    Holds the alignments that pass the filters in the order they were found
+    """
+    
+    def __init__(self):
+        # the annotations (gene, gene length, and bug) are interned as integers
+        self.__annotation_ids={}
+        self.__annotations=[]
+        
+        # the alignments stored in memory as a set of arrays (indexed by alignment)
+        self.__alignment_annotations=array("i")
+        self.__queries=[]
+        self.__matches=array("d")
+        self.__alignment_lengths=array("d")
+        
+        # the alignments written to the temp file once the maximum is stored in memory
+        # with a line for each alignment (annotation id, query, matches, alignment length)
+        self.__temp_file=None
+        self.__temp_file_handle=None
+        
+    def add(self, gene, gene_length, query, matches, bug, alignment_length):
+        """
+        Add the alignment
+        """
+        
+        annotation=(gene, gene_length, bug)
+        try:
+            annotation_id=self.__annotation_ids[annotation]
+        except KeyError:
+            annotation_id=len(self.__annotations)
+            self.__annotation_ids[annotation]=annotation_id
+            self.__annotations.append(annotation)
+            
+        self.__alignment_annotations.append(annotation_id)
+        self.__queries.append(query)
+        self.__matches.append(matches)
+        self.__alignment_lengths.append(alignment_length)
+        
+        if len(self.__queries) >= config.filtered_alignments_max:
+            self.write_temp_file()
+            
+    def write_temp_file(self):
+        """
+        Write the alignments stored in memory to the temp file
+        """
+        
+        if self.__temp_file is None:
+            self.__temp_file=utilities.unnamed_temp_file("filtered_alignments_")
+            self.__temp_file_handle=open(self.__temp_file,"w")
+            
+        for index, query in enumerate(self.__queries):
+            self.__temp_file_handle.write(config.blast_delimiter.join([str(self.__alignment_annotations[index]),
+                query, repr(self.__matches[index]), repr(self.__alignment_lengths[index])])+"\n")
+            
+        del self.__alignment_annotations[:], self.__queries[:], self.__matches[:], self.__alignment_lengths[:]
+        
+    def count_alignments(self):
+        """
+        Return the total number of alignments stored in memory
+        """
+        
+        return len(self.__queries)
+    
+    def alignment_list(self):
+        """
+        Yield the alignments in the order added (gene, gene length, query, matches, bug, alignment length)
+        """
+        
+        # the alignments in the temp file were added first
+        if self.__temp_file is not None:
+            self.__temp_file_handle.flush()
+            with open(self.__temp_file) as file_handle:
+                for line in file_handle:
+                    annotation_id, query, matches, alignment_length = line.rstrip("\n").split(config.blast_delimiter)
+                    gene, gene_length, bug = self.__annotations[int(annotation_id)]
+                    yield gene, gene_length, query, float(matches), bug, float(alignment_length)
+                    
+        for index, query in enumerate(self.__queries):
+            gene, gene_length, bug = self.__annotations[self.__alignment_annotations[index]]
+            yield gene, gene_length, query, self.__matches[index], bug, self.__alignment_lengths[index]
+            
+    def clear(self):
+        """
+        Clear all of the stored data and remove the temp file
+        """
+        
+        if self.__temp_file is not None:
+            self.__temp_file_handle.close()
+            utilities.remove_file(self.__temp_file)
+            self.__temp_file=None
+            self.__temp_file_handle=None
+            
+        self.__annotation_ids.clear()
+        del self.__annotations[:], self.__alignment_annotations[:], self.__queries[:]
+        del self.__matches[:], self.__alignment_lengths[:]
+
         
 class GeneScores:
     """
@@ -1286,17 +1909,64 @@ class Reads:
     Holds all of the reads data to create a fasta file
     """
     
-    def add(self, id, sequence):
+    def add(self, id, sequence, offset=None, length=None):
         """
         Store the sequence and id which should correspond to the following:
         >id
         sequence
+        If the offset and length (in bytes) of the record in the file are provided,
+        store the location instead of the id (or with the sequence if a memory budget is set)
         """
         
+        # the reads are stored by the id of their names
+        name_id=self.__queries.get_id(id)
+        
+        if offset is not None and (self.__minimize_memory_use or self.__memory_budget is not None):
+            self.add_record(name_id, offset, length)
+            if self.__minimize_memory_use:
+                return
+        
         if self.__minimize_memory_use:
-            self.__ids.add(id)
+            self.__ids.add(name_id)
         else:
-            self.__reads[id]=sequence
+            self.__reads[name_id]=sequence
+            
+            # check the memory used if a budget is set
+            if self.__memory_budget is not None:
+                self.__additions+=1
+                if (self.__additions % config.memory_budget_check_additions == 0 and
+                    utilities.current_memory() > self.__memory_budget):
+                    self.remove_sequences()
+                    
+    def add_record(self, name_id, offset, length):
+        """
+        Store the location of the record for the read (by the id of its name) in the file
+        """
+        
+        # extend the flags to include the reads added by the other stores
+        if name_id >= len(self.__unaligned):
+            self.__unaligned.extend(bytes(self.__queries.count()-len(self.__unaligned)))
+        if not self.__unaligned[name_id]:
+            self.__unaligned[name_id]=1
+            self.__unaligned_count+=1
+            
+        self.__record_offsets.append(offset)
+        self.__record_lengths.append(length)
+        self.__record_reads.append(name_id)
+            
+    def remove_sequences(self):
+        """
+        Store only the ids (or the locations of the records), with the sequences read from the file when needed
+        """
+        
+        message="Memory budget exceeded, storing only the ids of the reads"
+        logger.info(message)
+        
+        # the reads stored are all located in the file if they were added with their records
+        if len(self.__reads) != self.__unaligned_count:
+            self.__ids.update(self.__reads.keys())
+        self.__reads.clear()
+        self.__minimize_memory_use=True
             
     def process_file(self, file):
         """
@@ -1315,7 +1985,7 @@ class Reads:
         else:
             input_fasta=file
                        
-        file_handle=open(input_fasta,"rt")
+        file_handle=utilities.open_read(input_fasta)
             
         sequence=""
         id=""
@@ -1342,18 +2012,38 @@ class Reads:
         if temp_file:
             utilities.remove_file(temp_file)
     
-    def __init__(self, file=None, minimize_memory_use=None):
+    def __init__(self, file=None, minimize_memory_use=None, memory_budget=None, query_ids=None):
         """
         Create initial data structures and load if file name provided
+        If a memory budget is set, store the sequences until it is exceeded
+        The reads are stored by the id of their names from the query ids (shared with the other stores if provided)
         """
+        self.__queries=query_ids
+        self.__shared_query_ids=query_ids is not None
+        if query_ids is None:
+            self.__queries=QueryIds()
         self.__reads={}
         self.__ids=set()
+        
+        # the location (offset and length in bytes) of each record in the file
+        # with the read for each record and the reads still unaligned as a set of flags
+        self.__record_offsets=array("q")
+        self.__record_lengths=array("i")
+        self.__record_reads=array("i")
+        self.__unaligned=bytearray()
+        self.__unaligned_count=0
+        
         self.__initial_read_count=0
         self.__file=file
+        self.__memory_budget=memory_budget
+        self.__additions=0
         
         if minimize_memory_use:
             self.__minimize_memory_use=True
             logger.debug("Initialize Reads class instance to minimize memory use")
+        elif memory_budget is not None:
+            self.__minimize_memory_use=False
+            logger.debug("Initialize Reads class instance to use memory up to " + str(memory_budget) + " GB")
         else:
             self.__minimize_memory_use=False
             logger.debug("Initialize Reads class instance to maximize memory use")
@@ -1363,6 +2053,13 @@ class Reads:
                 self.add(id, sequence)
                 self.__initial_read_count+=1
                 
+    def get_query_ids(self):
+        """
+        Return the query ids used to store the reads
+        """
+        
+        return self.__queries
+    
     def set_file(self, file):
         """
         Set the file to read sequences from
@@ -1374,10 +2071,18 @@ class Reads:
         """
         Remove the id and sequence from the read structure
         """
-        if id in self.__reads:
-            del self.__reads[id]
-        elif id in self.__ids:
-            self.__ids.discard(id)
+        name_id=self.__queries.find_id(id)
+        if name_id is None:
+            return
+        
+        if name_id in self.__reads:
+            del self.__reads[name_id]
+        elif name_id in self.__ids:
+            self.__ids.discard(name_id)
+            
+        if name_id < len(self.__unaligned) and self.__unaligned[name_id]:
+            self.__unaligned[name_id]=0
+            self.__unaligned_count-=1
                 
     def get_fasta(self, file=None):
         """ 
@@ -1389,42 +2094,103 @@ class Reads:
             
         # use the stored reads if present
         if self.__reads:
-            for id, sequence in self.__reads.items():
-                yield ">"+id+"\n"+sequence
+            for name_id, sequence in self.__reads.items():
+                yield ">"+self.__queries.get_name(name_id)+"\n"+sequence
+        elif self.__record_offsets and file == self.__file:
+            with open(file, "rb") as file_handle:
+                for offset, length in self.unaligned_records():
+                    file_handle.seek(offset)
+                    yield file_handle.read(length).decode().rstrip("\n")
         else:
             if file:
                 for id, sequence in self.process_file(file):
                     # check for the id or the id without the length annotation
-                    if utilities.remove_length_annotation(id) in self.__ids or id in self.__ids:
+                    if (self.__queries.find_id(utilities.remove_length_annotation(id)) in self.__ids or
+                        self.__queries.find_id(id) in self.__ids):
                         yield ">"+id+"\n"+sequence
     
+    def unaligned_records(self):
+        """
+        Yield the location (offset and length) of the records of the reads still unaligned
+        with the records next to each other in the file joined
+        """
+        
+        start=None
+        end=None
+        for index, name_id in enumerate(self.__record_reads):
+            if self.__unaligned[name_id]:
+                offset=self.__record_offsets[index]
+                if offset != end:
+                    if start is not None:
+                        yield start, end-start
+                    start=offset
+                end=offset+self.__record_lengths[index]
+        if start is not None:
+            yield start, end-start
+            
+    def write_fasta(self, output_file):
+        """
+        Write the fasta file of the reads stored
+        Copy the records from the file if their locations are stored
+        """
+        
+        file_handle_write=open(output_file, "wb")
+        if not self.__reads and self.__record_offsets:
+            with open(self.__file, "rb") as file_handle:
+                for offset, length in self.unaligned_records():
+                    file_handle.seek(offset)
+                    while length > 0:
+                        data=file_handle.read(min(length, config.read_records_copy_size))
+                        if not data:
+                            break
+                        file_handle_write.write(data)
+                        length-=len(data)
+        else:
+            for fasta_line in self.get_fasta():
+                file_handle_write.write((fasta_line+"\n").encode())
+        file_handle_write.close()
+    
     def id_list(self):
         """
         Return a list of all of the fasta ids
         """
         
         if self.__reads:
-            return list(self.__reads.keys())
+            name_ids=list(self.__reads.keys())
         else:
-            return list(self.__ids)
+            name_ids=list(self.__ids)+[name_id for name_id, unaligned in enumerate(self.__unaligned) if unaligned]
+        return [self.__queries.get_name(name_id) for name_id in name_ids]
     
     def count_reads(self):
         """
         Return the total number of reads stored
         """
         
+        # count the copies of each read if the duplicate reads were collapsed
+        if self.__queries.weighted():
+            if self.__reads:
+                name_ids=self.__reads.keys()
+            else:
+                name_ids=itertools.chain(self.__ids,
+                    (name_id for name_id, unaligned in enumerate(self.__unaligned) if unaligned))
+            return sum(self.__queries.get_weight(name_id) for name_id in name_ids)
+        
         if self.__reads:
             return len(self.__reads.keys())
         else:
-            return len(self.__ids)
+            return len(self.__ids)+self.__unaligned_count
     
     def clear(self):
         """
         Clear all of the stored reads and ids
         """
         
+        if not self.__shared_query_ids:
+            self.__queries.clear()
         self.__reads.clear()
         self.__ids.clear()
+        del self.__record_offsets[:], self.__record_lengths[:], self.__record_reads[:], self.__unaligned[:]
+        self.__unaligned_count=0
         
     def set_initial_read_count(self,total):
         """
@@ -204,3 +204,38 @@ class TestBasicHumannBlastx_CoverageFunctions(unittest.TestCase):
         
         # check the values are unchanged
         self.assertEqual(sorted(allowed_proteins), sorted(found_proteins))
+
+    def test_allowed_proteins_overlapping_ranges_merged(self):
+        """
+        Test the coverage filter with the ranges hit for each protein
+        Test with overlapping ranges merged as they are added
+        Test the coverage matches that of the unique positions hit
+        """
+        
+        # merge the ranges after a small number are added
+        default_coverage_ranges_merge_size=config.coverage_ranges_merge_size
+        config.coverage_ranges_merge_size=4
+        
+        protein_hits={}
+        protein_lengths={"protein_a": 100, "protein_b": 100}
+        no_coverage=0
+        hit_positions={"protein_a": set(), "protein_b": set()}
+        for protein, start_index, stop_index in [("protein_a",0,10),("protein_a",5,20),("protein_a",40,45),
+            ("protein_a",18,25),("protein_a",44,60),("protein_a",30,30),("protein_a",60,61),
+            ("protein_a",70,75),("protein_a",0,2),("protein_b",0,10),("protein_b",5,49)]:
+            protein_hits.setdefault(protein,[])
+            if not blastx_coverage.add_protein_hit(protein_hits, protein, start_index, stop_index):
+                no_coverage+=1
+            hit_positions[protein].update(range(start_index, stop_index))
+        
+        config.coverage_ranges_merge_size=default_coverage_ranges_merge_size
+        
+        # the ranges are merged once the total reaches the merge size
+        self.assertEqual(protein_hits["protein_a"],[(0,25),(40,61),(70,75)])
+        self.assertEqual(no_coverage,1)
+        
+        # protein a has 51 positions hit and protein b has 49
+        allowed=blastx_coverage.allowed_proteins(protein_lengths, protein_hits, 50.0, no_coverage, True)
+        self.assertEqual(len(hit_positions["protein_a"]),51)
+        self.assertEqual(len(hit_positions["protein_b"]),49)
+        self.assertEqual(allowed,set(["protein_a"]))
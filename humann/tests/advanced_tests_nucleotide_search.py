@@ -2,6 +2,7 @@ import unittest
 import logging
 import tempfile
 import math
+import os
 
 import cfg
 import utils
@@ -473,3 +474,151 @@ class TestAdvancedHumannNucleotideSearchFunctions(unittest.TestCase):
         
 
 
+
+    def test_nucleotide_search_unaligned_reads_from_stream(self):
+        """
+        Test the unaligned reads and the store alignments
+        Test with the lines of a bowtie2/sam output file as a stream
+        Test the alignments and unaligned reads match those from the sam file
+        """
+        
+        # turn off query/subject filtering
+        config.nucleotide_subject_coverage_threshold = 0
+        config.nucleotide_query_coverage_threshold = 0
+        
+        # read in the aligned and unaligned reads from the file
+        alignments=store.Alignments()
+        unaligned_reads_store=store.Reads()
+        [unaligned_reads_file_fasta, reduced_aligned_reads_file] = nucleotide.unaligned_reads(
+            cfg.sam_file_unaligned_reads, alignments, unaligned_reads_store, keep_sam=True)
+        expected_hits=alignments.get_hit_list()
+        expected_unaligned=sorted(unaligned_reads_store.id_list())
+        utils.remove_temp_file(unaligned_reads_file_fasta)
+        utils.remove_temp_file(reduced_aligned_reads_file)
+        
+        # read in the aligned and unaligned reads from a stream of lines
+        alignments=store.Alignments()
+        unaligned_reads_store=store.Reads()
+        with open(cfg.sam_file_unaligned_reads) as file_handle:
+            sam_lines=(line for line in file_handle)
+            [unaligned_reads_file_fasta, reduced_aligned_reads_file] = nucleotide.unaligned_reads_from_stream(
+                sam_lines, alignments, unaligned_reads_store)
+        
+        # reset query/subject filtering
+        config.nucleotide_subject_coverage_threshold = self.default_nucleotide_subject_coverage_threshold
+        config.nucleotide_query_coverage_threshold = self.default_nucleotide_query_coverage_threshold
+        
+        # remove temp files
+        utils.remove_temp_file(unaligned_reads_file_fasta)
+        utils.remove_temp_file(reduced_aligned_reads_file)
+        
+        self.assertEqual(alignments.get_hit_list(),expected_hits)
+        self.assertEqual(sorted(unaligned_reads_store.id_list()),expected_unaligned)
+
+    def test_nucleotide_search_unaligned_reads_from_bam(self):
+        """
+        Test the unaligned reads and the store alignments
+        Test with a bam file of the same alignments as the sam file
+        Test the alignments and unaligned reads match those from the sam file
+        """
+        
+        # turn off query/subject filtering
+        config.nucleotide_subject_coverage_threshold = 0
+        config.nucleotide_query_coverage_threshold = 0
+        
+        # read in the aligned and unaligned reads from the sam file
+        alignments=store.Alignments()
+        unaligned_reads_store=store.Reads()
+        [unaligned_reads_file_fasta, reduced_aligned_reads_file] = nucleotide.unaligned_reads(
+            cfg.sam_file_unaligned_reads, alignments, unaligned_reads_store, keep_sam=True)
+        expected_hits=alignments.get_hit_list()
+        expected_unaligned=sorted(unaligned_reads_store.id_list())
+        utils.remove_temp_file(unaligned_reads_file_fasta)
+        utils.remove_temp_file(reduced_aligned_reads_file)
+        
+        # read in the aligned and unaligned reads from the bam file
+        alignments=store.Alignments()
+        unaligned_reads_store=store.Reads()
+        [unaligned_reads_file_fasta, reduced_aligned_reads_file] = nucleotide.unaligned_reads_from_bam(
+            cfg.bam_file_unaligned_reads, alignments, unaligned_reads_store)
+        
+        # reset query/subject filtering
+        config.nucleotide_subject_coverage_threshold = self.default_nucleotide_subject_coverage_threshold
+        config.nucleotide_query_coverage_threshold = self.default_nucleotide_query_coverage_threshold
+        
+        # remove temp files
+        utils.remove_temp_file(unaligned_reads_file_fasta)
+        utils.remove_temp_file(reduced_aligned_reads_file)
+        
+        self.assertEqual(alignments.get_hit_list(),expected_hits)
+        self.assertEqual(sorted(unaligned_reads_store.id_list()),expected_unaligned)
+
+    def test_nucleotide_search_unaligned_reads_aligner_unaligned_reads(self):
+        """
+        Test the unaligned reads and the store alignments
+        Test with the unaligned reads written by bowtie2 to a file instead of the sam file
+        Test the alignments and unaligned reads match those from the full sam file
+        """
+        
+        # turn off query/subject filtering
+        config.nucleotide_subject_coverage_threshold = 0
+        config.nucleotide_query_coverage_threshold = 0
+        
+        # read in the aligned and unaligned reads from the full sam file
+        alignments=store.Alignments()
+        unaligned_reads_store=store.Reads()
+        [unaligned_reads_file_fasta, reduced_aligned_reads_file] = nucleotide.unaligned_reads(
+            cfg.sam_file_unaligned_reads, alignments, unaligned_reads_store, keep_sam=True)
+        expected_hits=alignments.get_hit_list()
+        expected_unaligned=sorted(unaligned_reads_store.id_list())
+        expected_read_count=unaligned_reads_store.get_initial_read_count()
+        utils.remove_temp_file(unaligned_reads_file_fasta)
+        utils.remove_temp_file(reduced_aligned_reads_file)
+        
+        # split the sam lines into the aligned lines and a fasta file of the unaligned reads
+        aligned_lines=[]
+        file_out, aligner_unaligned_reads=tempfile.mkstemp()
+        with open(cfg.sam_file_unaligned_reads) as file_handle:
+            for line in file_handle:
+                data=line.split("\t")
+                if not line.startswith("@") and int(data[config.sam_flag_index]) & config.sam_unmapped_flag:
+                    os.write(file_out,(">"+data[config.sam_read_name_index]+"\n"+
+                        data[config.sam_read_index]+"\n").encode())
+                else:
+                    aligned_lines.append(line)
+        os.close(file_out)
+        
+        alignments=store.Alignments()
+        unaligned_reads_store=store.Reads()
+        [unaligned_reads_file_fasta, reduced_aligned_reads_file] = nucleotide.unaligned_reads_from_stream(
+            aligned_lines, alignments, unaligned_reads_store, aligner_unaligned_reads=aligner_unaligned_reads)
+        
+        # reset query/subject filtering
+        config.nucleotide_subject_coverage_threshold = self.default_nucleotide_subject_coverage_threshold
+        config.nucleotide_query_coverage_threshold = self.default_nucleotide_query_coverage_threshold
+        
+        # remove temp files
+        utils.remove_temp_file(aligner_unaligned_reads)
+        utils.remove_temp_file(unaligned_reads_file_fasta)
+        utils.remove_temp_file(reduced_aligned_reads_file)
+        
+        self.assertEqual(alignments.get_hit_list(),expected_hits)
+        self.assertEqual(sorted(unaligned_reads_store.id_list()),expected_unaligned)
+        self.assertEqual(unaligned_reads_store.get_initial_read_count(),expected_read_count)
+
+    def test_nucleotide_search_sam_file_records_chunks(self):
+        """
+        Test the records from the sam file parsed in chunks with a set of processes
+        Test the records match those from the sam lines in the same order
+        """
+        
+        with open(cfg.demo_sam) as file_handle:
+            expected_records=list(nucleotide.sam_records(file_handle))
+        
+        # parse small chunks so the file is split across the processes
+        default_sam_chunk_size=config.sam_chunk_size
+        config.sam_chunk_size=1000
+        records=list(nucleotide.sam_file_records(cfg.demo_sam, 2))
+        config.sam_chunk_size=default_sam_chunk_size
+        
+        self.assertEqual(records,expected_records)
@@ -482,6 +482,150 @@ class TestAdvancedHumannStoreFunctions(unittest.TestCase):
         self.assertEqual(sorted(stored_lengths),sorted([1/1000.0,100/1000.0,
             200/1000.0,1000/1000.0]))
         
+    def test_Alignments_compute_gene_scores_interleaved_queries_with_temp_alignment_file(self):
+        """
+        Test the compute_gene_scores function
+        Test with the hits for each query not added together
+        Test the gene scores match those computed with the alignments in memory
+        """
+        
+        hits=[("gene1",2,"query1",41.0,"bug1"),("gene2",3,"query2",57.1,"bug1"),
+            ("gene2",3,"query1",61.0,"bug2"),("gene3",4,"query3",72.1,"bug1"),
+            ("gene3",4,"query2",35.3,"bug2"),("gene1",2,"query1",40.2,"bug1")]
+        
+        gene_scores={}
+        for minimize_memory_use in [False, True]:
+            alignments_store=store.Alignments(minimize_memory_use=minimize_memory_use)
+            for hit in hits:
+                alignments_store.add(*hit)
+            
+            gene_scores_store=store.GeneScores()
+            alignments_store.convert_alignments_to_gene_scores(gene_scores_store,1)
+            gene_scores[minimize_memory_use]=[(gene,gene_scores_store.get_score(bug,gene))
+                for bug in ["bug1","bug2"] for gene in ["gene1","gene2","gene3"]]
+            
+            # delete the temp alignment file
+            alignments_store.delete_temp_alignments_file()
+        
+        self.assertEqual(gene_scores[True],gene_scores[False])
+
+    def test_Alignments_compute_gene_scores_grouped_queries(self):
+        """
+        Test the compute_gene_scores function
+        Test with the hits normalized as the hits for each query are added
+        Test the gene scores match those computed with the alignments in memory
+        """
+        
+        hits=[("gene1",2,"query1",41.0,"bug1"),("gene2",3,"query1",61.0,"bug2"),
+            ("gene1",2,"query1",40.2,"bug1"),("gene2",3,"query2",57.1,"bug1"),
+            ("gene3",4,"query2",35.3,"bug2"),("gene3",4,"query3",72.1,"bug1")]
+        
+        gene_scores={}
+        for grouped_queries in [False, True]:
+            alignments_store=store.Alignments(grouped_queries=grouped_queries)
+            for hit in hits:
+                alignments_store.add(*hit)
+            
+            gene_scores_store=store.GeneScores()
+            alignments_store.convert_alignments_to_gene_scores(gene_scores_store,1)
+            gene_scores[grouped_queries]=[gene_scores_store.get_score(bug,gene)
+                for bug in ["bug1","bug2"] for gene in ["gene1","gene2","gene3"]]
+            
+            # delete the temp alignment file
+            alignments_store.delete_temp_alignments_file()
+        
+        for expected_score, actual_score in zip(gene_scores[False],gene_scores[True]):
+            self.assertAlmostEqual(expected_score,actual_score)
+            
+    def test_Alignments_compute_gene_scores_grouped_queries_not_grouped(self):
+        """
+        Test the compute_gene_scores function
+        Test with the hits expected to be grouped by query but with a query found again
+        Test the gene scores match those computed with the temp alignment file
+        """
+        
+        hits=[("gene1",2,"query1",41.0,"bug1"),("gene2",3,"query2",57.1,"bug1"),
+            ("gene2",3,"query1",61.0,"bug2"),("gene3",4,"query3",72.1,"bug1"),
+            ("gene3",4,"query2",35.3,"bug2"),("gene1",2,"query1",40.2,"bug1")]
+        
+        gene_scores={}
+        hit_lists={}
+        for grouped_queries in [False, True]:
+            alignments_store=store.Alignments(minimize_memory_use=True,grouped_queries=grouped_queries)
+            for hit in hits:
+                alignments_store.add(*hit)
+            
+            gene_scores_store=store.GeneScores()
+            alignments_store.convert_alignments_to_gene_scores(gene_scores_store,1)
+            gene_scores[grouped_queries]=[gene_scores_store.get_score(bug,gene)
+                for bug in ["bug1","bug2"] for gene in ["gene1","gene2","gene3"]]
+            hit_lists[grouped_queries]=sorted(alignments_store.get_hit_list())
+            
+            # delete the temp alignment file
+            alignments_store.delete_temp_alignments_file()
+        
+        self.assertEqual(gene_scores[True],gene_scores[False])
+        self.assertEqual(hit_lists[True],hit_lists[False])
+
+    def test_Alignments_compute_gene_scores_weighted_queries(self):
+        """
+        Test the compute_gene_scores function
+        Test the hits for a query weighted by the copies of the read
+        match those for each copy of the read added
+        Test with each of the memory use settings
+        """
+        
+        hits=[("gene1",2,"query1",41.0,"bug1"),("gene2",3,"query1",57.1,"bug1"),
+            ("gene2",3,"query2",61.0,"bug2"),("gene3",4,"query3",72.1,"bug1")]
+        copies={"query1":3,"query2":2}
+        
+        for settings in [{},{"minimize_memory_use":True},{"minimize_memory_use":True,"grouped_queries":True}]:
+            # add the hits for each copy of the reads
+            alignments_store=store.Alignments(**settings)
+            for (gene, length, query, matches, bug) in hits:
+                for copy in range(copies.get(query,1)):
+                    alignments_store.add(gene,length,query+"_"+str(copy),matches,bug)
+            expected_gene_scores=store.GeneScores()
+            alignments_store.convert_alignments_to_gene_scores(expected_gene_scores,1)
+            expected_hits=alignments_store.count_hits()
+            alignments_store.clear()
+            
+            # add the hits once weighted by the copies of the reads
+            query_ids=store.QueryIds()
+            for query, total in copies.items():
+                query_ids.set_weight(query_ids.get_id(query+"_0"),total)
+            alignments_store=store.Alignments(query_ids=query_ids,**settings)
+            for (gene, length, query, matches, bug) in hits:
+                alignments_store.add(gene,length,query+"_0",matches,bug)
+            gene_scores=store.GeneScores()
+            alignments_store.convert_alignments_to_gene_scores(gene_scores,1)
+            total_hits=alignments_store.count_hits()
+            alignments_store.clear()
+            
+            self.assertEqual(total_hits,expected_hits)
+            for bug in ["bug1","bug2","all"]:
+                self.assertEqual(sorted(gene_scores.scores_for_bug(bug)),sorted(expected_gene_scores.scores_for_bug(bug)))
+                for gene in expected_gene_scores.scores_for_bug(bug):
+                    self.assertAlmostEqual(gene_scores.get_score(bug,gene),
+                        expected_gene_scores.get_score(bug,gene))
+
+    def test_Reads_count_reads_weighted_queries(self):
+        """
+        Test the count_reads function
+        Test the reads are counted with the copies of each read
+        """
+        
+        query_ids=store.QueryIds()
+        query_ids.set_weight(query_ids.get_id("read2"),4)
+        
+        for minimize_memory_use in [False,True]:
+            reads_store=store.Reads(minimize_memory_use=minimize_memory_use,query_ids=query_ids)
+            for read in ["read1","read2","read3"]:
+                reads_store.add(read,"ATCG")
+            reads_store.remove_id("read1")
+            
+            self.assertEqual(reads_store.count_reads(),5)
+
     def test_GeneScores_add_from_file_id_mapping_bug_list(self):
         """
         GeneScores class: Test add_from_file bug list with id mapping
@@ -2,6 +2,8 @@ import unittest
 import logging
 import re
 import math
+import os
+import tempfile
 
 import cfg
 import utils
@@ -324,3 +326,117 @@ class TestAdvancedHumannTranslatedSearchFunctions(unittest.TestCase):
         # there should be one bug name and the other should be unclassified
         self.assertEqual(sorted(alignments.bug_list()),sorted(["g__Bacteroides.s__Bacteroides_xylanisolvens","unclassified"]))
         
+
+    def test_translated_search_diamond_shard_threads(self):
+        """
+        Test the threads are split among the diamond database shards
+        """
+        
+        self.assertEqual(translated.diamond_shard_threads(32,4),(4,8))
+        self.assertEqual(translated.diamond_shard_threads(8,4),(2,4))
+        
+    def test_translated_search_diamond_shard_threads_single(self):
+        """
+        Test a single shard or small thread count aligns one shard at a time
+        """
+        
+        self.assertEqual(translated.diamond_shard_threads(32,1),(1,32))
+        self.assertEqual(translated.diamond_shard_threads(1,4),(1,1))
+
+    def test_translated_search_unaligned_reads_query_length_column(self):
+        """
+        Test the unaligned reads and the store alignments
+        Test with the query length as an extra column (as written by diamond)
+        Test with and without the length annotation on the query ids
+        Test the alignments match those from the length annotations with the coverage filter
+        """
+        
+        # load the alignments with the query lengths from the length annotations
+        alignments=store.Alignments()
+        unaligned_file_fasta=translated.unaligned_reads(store.Reads(), cfg.demo_m8, alignments)
+        utils.remove_temp_file(unaligned_file_fasta)
+        
+        # write the alignments with the query length column
+        file_out, annotated_file=tempfile.mkstemp()
+        os.close(file_out)
+        file_out, unannotated_file=tempfile.mkstemp()
+        os.close(file_out)
+        file_handle_annotated=open(annotated_file,"w")
+        file_handle_unannotated=open(unannotated_file,"w")
+        with open(cfg.demo_m8) as file_handle:
+            for line in file_handle:
+                data=line.rstrip("\n").split(config.blast_delimiter)
+                queryid, query_length=utilities.get_length_annotation(data[config.blast_query_index])
+                file_handle_annotated.write(config.blast_delimiter.join(data+[str(query_length)])+"\n")
+                data[config.blast_query_index]=queryid
+                file_handle_unannotated.write(config.blast_delimiter.join(data+[str(query_length)])+"\n")
+        file_handle_annotated.close()
+        file_handle_unannotated.close()
+        
+        alignments_annotated=store.Alignments()
+        unaligned_file_fasta=translated.unaligned_reads(store.Reads(), annotated_file, alignments_annotated)
+        utils.remove_temp_file(unaligned_file_fasta)
+        
+        alignments_unannotated=store.Alignments()
+        unaligned_file_fasta=translated.unaligned_reads(store.Reads(), unannotated_file, alignments_unannotated)
+        utils.remove_temp_file(unaligned_file_fasta)
+        
+        utils.remove_temp_file(annotated_file)
+        utils.remove_temp_file(unannotated_file)
+        
+        self.assertEqual(sorted(alignments_annotated.get_hit_list()), sorted(alignments.get_hit_list()))
+        self.assertEqual(sorted(alignments_unannotated.get_hit_list()), sorted(alignments.get_hit_list()))
+        
+    def test_translated_search_unaligned_reads_extra_column_not_query_length(self):
+        """
+        Test the unaligned reads and the store alignments
+        Test with an extra column that is not the query length (a bitscore) and the length annotation
+        Test the alignments match those from the length annotations with the coverage filter
+        """
+        
+        # load the alignments with the query lengths from the length annotations
+        alignments=store.Alignments()
+        unaligned_file_fasta=translated.unaligned_reads(store.Reads(), cfg.demo_m8, alignments)
+        utils.remove_temp_file(unaligned_file_fasta)
+        
+        # write the alignments with a decimal and an integer extra column
+        file_out, decimal_file=tempfile.mkstemp()
+        os.close(file_out)
+        file_out, integer_file=tempfile.mkstemp()
+        os.close(file_out)
+        file_handle_decimal=open(decimal_file,"w")
+        file_handle_integer=open(integer_file,"w")
+        with open(cfg.demo_m8) as file_handle:
+            for line in file_handle:
+                data=line.rstrip("\n").split(config.blast_delimiter)
+                file_handle_decimal.write(config.blast_delimiter.join(data+["53.5"])+"\n")
+                file_handle_integer.write(config.blast_delimiter.join(data+["7"])+"\n")
+        file_handle_decimal.close()
+        file_handle_integer.close()
+        
+        alignments_decimal=store.Alignments()
+        unaligned_file_fasta=translated.unaligned_reads(store.Reads(), decimal_file, alignments_decimal)
+        utils.remove_temp_file(unaligned_file_fasta)
+        
+        alignments_integer=store.Alignments()
+        unaligned_file_fasta=translated.unaligned_reads(store.Reads(), integer_file, alignments_integer)
+        utils.remove_temp_file(unaligned_file_fasta)
+        
+        utils.remove_temp_file(decimal_file)
+        utils.remove_temp_file(integer_file)
+        
+        self.assertEqual(sorted(alignments_decimal.get_hit_list()), sorted(alignments.get_hit_list()))
+        self.assertEqual(sorted(alignments_integer.get_hit_list()), sorted(alignments.get_hit_list()))
+        
+    def test_translated_search_diamond_output_opts(self):
+        """
+        Test the query length is added to the default diamond tabular output format
+        Test the options are not changed if the output fields are set
+        """
+        
+        self.assertEqual(translated.diamond_output_opts(["--top","1","--outfmt","6"]),
+            ["--top","1","--outfmt","6"]+config.diamond_outfmt_fields)
+        self.assertEqual(translated.diamond_output_opts(["--outfmt","6","--top","1"]),
+            ["--outfmt","6"]+config.diamond_outfmt_fields+["--top","1"])
+        self.assertEqual(translated.diamond_output_opts(["--outfmt","6","qseqid","sseqid"]),
+            ["--outfmt","6","qseqid","sseqid"])
@@ -4,8 +4,10 @@ import logging
 import cfg
 import utils
 import tempfile
+import os
 
 from humann.search import nucleotide
+from humann.search import bam_reader
 from humann import config
 
 class TestBasicHumannNucleotideSearchFunctions(unittest.TestCase):
@@ -65,6 +67,20 @@ class TestBasicHumannNucleotideSearchFunctions(unittest.TestCase):
 
         self.assertEqual(identity, expected_identity)
 
+    def test_calculate_percent_identity_from_cigar(self):
+        """
+        Test the calculate percent identity function with the cigar operations (as from a bam file)
+        Test the identity, alignment length, and reference length match those from the cigar string
+        """
+
+        cigar_string="100I84M1X2=2D"
+        cigar_operations=[(100,"I"),(84,"M"),(1,"X"),(2,"="),(2,"D")]
+        md_field="MD:Z:27A5G2T6G4T1A6T2C0A7A1A0A0C0G1G1A5"
+
+        expected=nucleotide.calculate_percent_identity(cigar_string,md_field)
+
+        self.assertEqual(nucleotide.calculate_percent_identity_from_cigar(cigar_operations,md_field), expected)
+
     def test_calculate_percent_identity_multiple_M_cigar_fields(self):
         """
         Test the calculate percent identity function
@@ -80,6 +96,34 @@ class TestBasicHumannNucleotideSearchFunctions(unittest.TestCase):
 
         self.assertEqual(identity, expected_identity)
 
+    def test_calculate_percent_identity_cigar_string_not_available(self):
+        """
+        Test the calculate percent identity function
+        Test with a cigar string that is not available (not of the standard format)
+        """
+
+        cigar_string="*"
+        md_field="MD:Z:27A5G2T6G4T1A6T2C0A7A1A0A0C0G1G1A5"
+
+        identity, alignment_length, reference_length =nucleotide.calculate_percent_identity(cigar_string,md_field)
+
+        self.assertEqual([identity, alignment_length, reference_length], [0.0, 0.0, 0])
+
+    def test_calculate_percent_identity_repeated_cigar_string(self):
+        """
+        Test the calculate percent identity function
+        Test the same cigar string with different md fields
+        """
+
+        cigar_string="100S84M16S10M"
+
+        first_identity, alignment_length, reference_length =nucleotide.calculate_percent_identity(
+            cigar_string,"MD:Z:27A5G2T6G4T1A6T2C0A7A1A0A0C0G1G1A5")
+        second_identity, alignment_length, reference_length =nucleotide.calculate_percent_identity(
+            cigar_string,"MD:Z:94")
+
+        self.assertEqual([first_identity, second_identity, alignment_length], [100.0 * ( 68 / 94.0 ), 100.0, 94.0])
+
     def test_calculate_percent_identity_multiple_M_cigar_fields_reference_length(self):
         """
         Test the calculate percent identity function
@@ -191,6 +235,30 @@ class TestBasicHumannNucleotideSearchFunctions(unittest.TestCase):
         result=nucleotide.find_md_field(info)
         
         self.assertEqual(result, expected_result)
+
+    def test_bam_reader_read_records_truncated(self):
+        """
+        Test the bam reader read records function
+        Test a truncated bam file exits with an error
+        """
+        
+        with open(cfg.bam_file_unaligned_reads,"rb") as file_handle:
+            data=file_handle.read()
         
+        file_out, truncated_bam=tempfile.mkstemp(suffix=".bam")
+        os.write(file_out, data[:len(data)//2])
+        os.close(file_out)
         
+        with self.assertRaises(SystemExit):
+            list(bam_reader.read_records(truncated_bam))
+        
+        utils.remove_temp_file(truncated_bam)
+        
+    def test_bam_reader_read_records_not_bgzf(self):
+        """
+        Test the bam reader read records function
+        Test a file that is not of the bgzf format exits with an error
+        """
         
+        with self.assertRaises(SystemExit):
+            list(bam_reader.read_records(cfg.sam_file_unaligned_reads))
@@ -51,6 +51,42 @@ class TestHumannStoreFunctions(unittest.TestCase):
         
         self.assertEqual(reads_store.count_reads(), 2)
 
+    def test_Read_write_fasta_records_minimize_memory_use(self):
+        """
+        Read class: Test the writing of the fasta file of the reads stored
+        Test with the location of the records in the file stored
+        Test with minimize memory use
+        """
+        
+        records=[(">id1|4\n","ATCG\n"),(">id2|4\n","ATTG\n"),(">id3|4\n","ATTC\n"),(">id1|4\n","ATCG\n")]
+        file_out, fasta_file=tempfile.mkstemp()
+        os.close(file_out)
+        
+        reads_store=store.Reads(minimize_memory_use=True)
+        offset=0
+        with open(fasta_file,"wb") as file_handle:
+            for header, sequence in records:
+                record=(header+sequence).encode()
+                file_handle.write(record)
+                reads_store.add(header[1:].split("|")[0], sequence.rstrip(), offset, len(record))
+                offset+=len(record)
+        reads_store.set_file(fasta_file)
+        
+        reads_store.remove_id("id2")
+        
+        file_out, output_file=tempfile.mkstemp()
+        os.close(file_out)
+        reads_store.write_fasta(output_file)
+        
+        with open(output_file) as file_handle:
+            written_fasta=file_handle.read()
+        utils.remove_temp_file(fasta_file)
+        utils.remove_temp_file(output_file)
+        
+        self.assertEqual(reads_store.count_reads(), 2)
+        self.assertEqual(sorted(reads_store.id_list()), ["id1","id3"])
+        self.assertEqual(written_fasta, ">id1|4\nATCG\n>id3|4\nATTC\n>id1|4\nATCG\n")
+
     def test_Read_print_fasta_id_count(self):
         """
         Read class: Test the loading of a full fasta file
@@ -86,6 +122,26 @@ class TestHumannStoreFunctions(unittest.TestCase):
         self.assertEqual(reads_store.count_reads(), cfg.small_fasta_file_total_sequences)            
 
 
+    def test_Read_print_fasta_memory_budget_exceeded(self):
+        """
+        Read class: Test the loading of a full fasta file
+        Test the reads printed are the same once the memory budget is exceeded
+        """
+        
+        reads_store=store.Reads(cfg.small_fasta_file)
+        expected_fasta=sorted(reads_store.get_fasta())
+        
+        default_memory_budget_check_additions=config.memory_budget_check_additions
+        config.memory_budget_check_additions=1
+        
+        reads_store=store.Reads(cfg.small_fasta_file, memory_budget=0)
+        stored_fasta=sorted(reads_store.get_fasta())
+        
+        config.memory_budget_check_additions=default_memory_budget_check_additions
+        
+        self.assertEqual(stored_fasta, expected_fasta)
+        self.assertEqual(reads_store.count_reads(), cfg.small_fasta_file_total_sequences)
+
     def test_Read_print_fasta_id_list(self):
         """
         Read class: Test the loading of a full fasta file
@@ -928,6 +984,65 @@ class TestHumannStoreFunctions(unittest.TestCase):
         
         self.assertEqual(sorted(stored_lengths),sorted([1/1000.0,91/1000.0,901/1000.0,901/1000.0]))    
         
+    def test_Alignments_get_hit_list_grouped_by_query(self):
+        """
+        Alignments class: Test get_hit_list function
+        Test the hits are grouped by query in the order the queries were added
+        Test the hits match those stored with the temp alignment file
+        """
+        
+        alignments_store=store.Alignments()
+        alignments_store_temp_file=store.Alignments(minimize_memory_use=True)
+        
+        for store_instance in [alignments_store, alignments_store_temp_file]:
+            store_instance.add("gene2", 10, "Q3", 0.01, "bug1",1)
+            store_instance.add("gene1", 100, "Q1", 0.01, "bug2",1)
+            store_instance.add("gene3", 1000, "Q3", 0.01, "bug3",1)
+            store_instance.add("gene1", 100, "Q1", 0.01, "bug1",1)
+        
+        expected_queries=["Q3","Q3","Q1","Q1"]
+        expected_genes=["gene2","gene3","gene1","gene1"]
+        
+        hits=alignments_store.get_hit_list()
+        hits_temp_file=alignments_store_temp_file.get_hit_list()
+        
+        # delete the temp alignment file
+        alignments_store_temp_file.delete_temp_alignments_file()
+        
+        self.assertEqual([item[0] for item in hits],expected_queries)
+        self.assertEqual([item[2] for item in hits],expected_genes)
+        self.assertEqual(sorted(hits),sorted(hits_temp_file))
+
+    def test_Alignments_get_hit_list_memory_budget_exceeded(self):
+        """
+        Alignments class: Test get_hit_list function
+        Test the hits are the same once the memory budget is exceeded
+        """
+        
+        hits=[("gene2", 10, "Q3", 0.01, "bug1",1),("gene1", 100, "Q1", 0.01, "bug2",1),
+            ("gene3", 1000, "Q3", 0.01, "bug3",1),("gene1", 100, "Q1", 0.01, "bug1",1)]
+        
+        alignments_store=store.Alignments()
+        for hit in hits:
+            alignments_store.add(*hit)
+        expected_hits=alignments_store.get_hit_list()
+        
+        default_memory_budget_check_additions=config.memory_budget_check_additions
+        config.memory_budget_check_additions=3
+        
+        # the hits are written to the temp alignments file after the third hit
+        alignments_store=store.Alignments(memory_budget=0)
+        for hit in hits:
+            alignments_store.add(*hit)
+        stored_hits=alignments_store.get_hit_list()
+        
+        config.memory_budget_check_additions=default_memory_budget_check_additions
+        
+        # delete the temp alignment file
+        alignments_store.delete_temp_alignments_file()
+        
+        self.assertEqual(stored_hits, expected_hits)
+
     def test_Alignments_process_chocophlan_length(self):
         """
         Test the process_chocophlan_length with standard length format
@@ -1017,6 +1132,141 @@ class TestHumannStoreFunctions(unittest.TestCase):
         
         self.assertEqual(expected_output,output) 
         
+    def test_Alignments_process_reference_annotation_stored(self):
+        """
+        Test the process reference annotation function
+        Test the annotations stored are limited to the maximum set in the config
+        """
+        
+        alignments_store=store.Alignments()
+        
+        default_reference_annotations_max=config.reference_annotations_max
+        config.reference_annotations_max=2
+        
+        output=[alignments_store.process_reference_annotation(reference)
+            for reference in ["gene1|100","gene2|200","gene3|300","gene1|100"]]
+        
+        config.reference_annotations_max=default_reference_annotations_max
+        
+        expected_output=[["gene1",100,"unclassified"],["gene2",200,"unclassified"],
+            ["gene3",300,"unclassified"],["gene1",100,"unclassified"]]
+        
+        self.assertEqual(expected_output,output)
+        
+    def test_Alignments_process_reference_annotation_id_mapping_sgb(self):
+        """
+        Test the process reference annotation function with an id mapping
+        Test the species is set for a sgb bug from the id mapping
+        """
+        
+        alignments_store=store.Alignments()
+        
+        # write an id mapping with a sgb bug
+        file_out, id_mapping_file=tempfile.mkstemp()
+        os.close(file_out)
+        with open(id_mapping_file,"w") as file_handle:
+            file_handle.write(config.reference_table_marker+"\n")
+            file_handle.write("\t".join(["ref1","UniRef90_A","100","SGB1871"])+"\n")
+        alignments_store.process_id_mapping(id_mapping_file)
+        utils.remove_temp_file(id_mapping_file)
+        
+        default_sgb_to_species_mapping=config.sgb_to_species_mapping
+        config.sgb_to_species_mapping={"SGB1871":"g__Bacteroides.s__Bacteroides_dorei"}
+        
+        output=alignments_store.process_reference_annotation("ref1")
+        
+        config.sgb_to_species_mapping=default_sgb_to_species_mapping
+        
+        expected_output=["UniRef90_A",100,"g__Bacteroides.s__Bacteroides_dorei.t__SGB1871"]
+        
+        self.assertEqual(expected_output,output)
+        
+    def test_Alignments_process_reference_annotation_id_mapping_sgb_not_reference_table(self):
+        """
+        Test the process reference annotation function with an id mapping
+        Test a sgb bug from an id mapping not written by humann_reference_table is not changed
+        """
+        
+        alignments_store=store.Alignments()
+        
+        # write an id mapping with a sgb bug and without the reference table marker
+        file_out, id_mapping_file=tempfile.mkstemp()
+        os.close(file_out)
+        with open(id_mapping_file,"w") as file_handle:
+            file_handle.write("# "+"\t".join(["reference","gene","gene_length","bug"])+"\n")
+            file_handle.write("\t".join(["ref1","UniRef90_A","100","SGB1871"])+"\n")
+        alignments_store.process_id_mapping(id_mapping_file)
+        utils.remove_temp_file(id_mapping_file)
+        
+        default_sgb_to_species_mapping=config.sgb_to_species_mapping
+        config.sgb_to_species_mapping={"SGB1871":"g__Bacteroides.s__Bacteroides_dorei"}
+        
+        output=alignments_store.process_reference_annotation("ref1")
+        
+        config.sgb_to_species_mapping=default_sgb_to_species_mapping
+        
+        expected_output=["UniRef90_A",100,"SGB1871"]
+        
+        self.assertEqual(expected_output,output)
+        
+    def test_Alignments_get_hit_list_shared_query_ids(self):
+        """
+        Alignments class: Test get_hit_list function
+        Test with the query ids shared with the reads store
+        Test the hits are in the order the queries were added to the alignments
+        Test the hits are the same once the reads are cleared
+        """
+        
+        query_ids=store.QueryIds()
+        reads_store=store.Reads(query_ids=query_ids)
+        alignments_store=store.Alignments(query_ids=query_ids)
+        
+        for query in ["Q1","Q2","Q3"]:
+            reads_store.add(query,"ATCG")
+            
+        alignments_store.add("gene2", 10, "Q3", 0.01, "bug1",1)
+        alignments_store.add("gene1", 100, "Q1", 0.01, "bug2",1)
+        alignments_store.add("gene3", 1000, "Q3", 0.01, "bug3",1)
+        reads_store.remove_id("Q3")
+        reads_store.remove_id("Q1")
+        
+        remaining_reads=reads_store.id_list()
+        reads_store.clear()
+        
+        hits=alignments_store.get_hit_list()
+        
+        self.assertEqual(remaining_reads,["Q2"])
+        self.assertEqual(query_ids.count(),3)
+        self.assertEqual([item[0] for item in hits],["Q3","Q3","Q1"])
+        self.assertEqual([item[2] for item in hits],["gene2","gene3","gene1"])
+
+    def test_FilteredAlignments_alignment_list(self):
+        """
+        FilteredAlignments class: Test alignment_list function
+        Test the alignments are in the order added including those written to the temp file
+        """
+        
+        alignments=[("gene2", 10, "Q3", 0.01, "bug1",1.0),("gene1", 100, "Q1", 0.02, "bug2",2.0),
+            ("gene3", 1000, "Q3", 0.03, "bug3",3.0),("gene1", 100, "Q1", 0.04, "bug2",4.0),
+            ("gene2", 10, "Q2", 0.05, "bug1",5.0)]
+        
+        # write the alignments to the temp file after two are added
+        default_filtered_alignments_max=config.filtered_alignments_max
+        config.filtered_alignments_max=2
+        
+        filtered_alignments=store.FilteredAlignments()
+        for alignment in alignments:
+            filtered_alignments.add(*alignment)
+        
+        config.filtered_alignments_max=default_filtered_alignments_max
+        
+        total_in_memory=filtered_alignments.count_alignments()
+        alignment_list=list(filtered_alignments.alignment_list())
+        filtered_alignments.clear()
+        
+        self.assertEqual(total_in_memory,1)
+        self.assertEqual(alignment_list,alignments)
+
     def test_GeneScores_add(self):
         """
         GeneScores class: Test add function
@@ -0,0 +1,97 @@
+import unittest
+import os
+import sys
+import time
+import subprocess
+import bz2
+
+import cfg
+import utils
+
+from humann.tools import humann_batch
+
+class TestHumannToolsFunctions(unittest.TestCase):
+    """
+    Test the functions found in humann.tools
+    """
+
+    def test_humann_batch_sample_stage_while_running(self):
+        """
+        Test the humann batch sample
+        Test the stage printed by the run is read before the run completes
+        """
+
+        # create a temp directory for output
+        tempdir = utils.create_temp_folder("humann_batch_stage")
+        release_file = os.path.join(tempdir, "release")
+
+        # run a command printing the bowtie2 stage and then waiting for the release file
+        script = "\n".join(["import os, time",
+            "print('Running bowtie2 ........')",
+            "start=time.time()",
+            "while not os.path.isfile(" + repr(release_file) + ") and time.time()-start < 30:",
+            "    time.sleep(0.1)"])
+        sample = humann_batch.Sample("sample.fastq", tempdir, "sample", ["metaphlan","bowtie2","diamond","humann"])
+        sample.command = lambda threads, humann_args: [sys.executable, "-c", script]
+
+        # start without the unbuffered setting in the environment
+        unbuffered = os.environ.pop("PYTHONUNBUFFERED", None)
+        try:
+            sample.start(1, [])
+        finally:
+            if unbuffered is not None:
+                os.environ["PYTHONUNBUFFERED"] = unbuffered
+
+        start = time.time()
+        while sample.stage != "bowtie2" and time.time()-start < 10:
+            time.sleep(0.1)
+
+        # check the stage was read while the run is still waiting
+        self.assertEqual(sample.stage, "bowtie2")
+        self.assertTrue(sample.poll())
+
+        open(release_file, "w").close()
+        sample.process.wait()
+
+        self.assertFalse(sample.poll())
+        self.assertEqual(sample.completed_stages, ["metaphlan","bowtie2"])
+
+        # remove the temp directory
+        utils.remove_temp_folder(tempdir)
+
+    def test_humann_batch_process_tree_memory(self):
+        """
+        Test the humann batch process tree memory function
+        Test the memory is measured for a running process and not for a missing process
+        """
+
+        self.assertTrue(humann_batch.process_tree_memory(os.getpid()) > 0)
+
+        # use the pid of a process that has completed
+        process = subprocess.Popen([sys.executable, "-c", "pass"])
+        process.wait()
+
+        self.assertEqual(humann_batch.process_tree_memory(process.pid), None)
+
+    def test_humann_batch_sample_stages_bz2(self):
+        """
+        Test the humann batch sample stages function
+        Test all of the stages are run for bzip2 compressed reads
+        """
+
+        # create a temp directory for output
+        tempdir = utils.create_temp_folder("humann_batch_bz2")
+        bz2_fastq = os.path.join(tempdir, "sample.fastq.bz2")
+        with open(cfg.small_fastq_file, "rb") as file_handle:
+            data = file_handle.read()
+        with open(bz2_fastq, "wb") as file_handle:
+            file_handle.write(bz2.compress(data))
+
+        stages = humann_batch.sample_stages(bz2_fastq, [])
+        bypass_stages = humann_batch.sample_stages(bz2_fastq, ["--bypass-translated-search"])
+
+        # remove the temp directory
+        utils.remove_temp_folder(tempdir)
+
+        self.assertEqual(stages, humann_batch.STAGES)
+        self.assertEqual(bypass_stages, ["metaphlan","bowtie2","humann"])
@@ -5,13 +5,16 @@ import filecmp
 import sys
 import logging
 import gzip
+import bz2
 import tempfile
 import shutil
+import subprocess
 
 import cfg
 import utils
 
 from humann import utilities
+from humann import store
 from humann import config
 
 class TestHumannUtilitiesFunctions(unittest.TestCase):
@@ -131,6 +134,70 @@ class TestHumannUtilitiesFunctions(unittest.TestCase):
         utils.remove_temp_file(new_fasta_file)  
                        
 
+    def test_collapse_duplicate_reads(self):
+        """
+        Test the collapse_duplicate_reads function
+        Test each sequence is written once with the first read
+        Test the copies of each read are set as the weights of the ids
+        """
+        
+        file_out, fastq_file=tempfile.mkstemp()
+        os.write(file_out,("@read1 first\nATCG\n+\n!!!!\n@read2\nGGCC\n+\n####\n"+
+            "@read3\nATCG\n+\n$$$$\n@read4\nATCG\n+\n%%%%\n").encode())
+        os.close(file_out)
+        
+        config.temp_dir=tempfile.gettempdir()
+        config.file_basename="HUMAnN_test"
+        query_ids=store.QueryIds()
+        collapsed_file, total_reads, unique_reads = utilities.collapse_duplicate_reads(fastq_file, query_ids)
+        
+        with open(collapsed_file) as file_handle:
+            collapsed_reads=file_handle.read()
+        
+        utils.remove_temp_file(fastq_file)
+        utils.remove_temp_file(collapsed_file)
+        
+        self.assertEqual(collapsed_reads,"@read1 first\nATCG\n+\n!!!!\n@read2\nGGCC\n+\n####\n")
+        self.assertEqual((total_reads, unique_reads),(4,2))
+        self.assertEqual(query_ids.get_weight(query_ids.find_id("read1")),3)
+        self.assertEqual(query_ids.get_weight(query_ids.find_id("read2")),1)
+        
+    def test_collapse_duplicate_reads_minimize_memory_use(self):
+        """
+        Test the collapse_duplicate_reads function
+        Test with the reads split into temp files (with minimum memory use or when over the memory budget)
+        Test each sequence is written once with the first read and the copies are set as the weights
+        """
+        
+        file_out, fastq_file=tempfile.mkstemp()
+        os.write(file_out,("@read1 first\nATCG\n+\n!!!!\n@read2\nGGCC\n+\n####\n"+
+            "@read3\nATCG\n+\n$$$$\n@read4\nATCG\n+\n%%%%\n@read5\nGGCC\n+\n&&&&\n").encode())
+        os.close(file_out)
+        
+        config.temp_dir=tempfile.gettempdir()
+        config.unnamed_temp_dir=tempfile.gettempdir()
+        config.file_basename="HUMAnN_test"
+        check_additions=config.memory_budget_check_additions
+        config.memory_budget_check_additions=1
+        
+        for minimize_memory_use, memory_budget in [(True, None), (False, 0.0)]:
+            query_ids=store.QueryIds()
+            collapsed_file, total_reads, unique_reads = utilities.collapse_duplicate_reads(fastq_file, query_ids,
+                minimize_memory_use=minimize_memory_use, memory_budget=memory_budget)
+            
+            with open(collapsed_file) as file_handle:
+                collapsed_reads=file_handle.readlines()
+            utils.remove_temp_file(collapsed_file)
+            
+            self.assertEqual(sorted(collapsed_reads),
+                sorted("@read1 first\nATCG\n+\n!!!!\n@read2\nGGCC\n+\n####\n".splitlines(True)))
+            self.assertEqual((total_reads, unique_reads),(5,2))
+            self.assertEqual(query_ids.get_weight(query_ids.find_id("read1")),3)
+            self.assertEqual(query_ids.get_weight(query_ids.find_id("read2")),2)
+        
+        config.memory_budget_check_additions=check_additions
+        utils.remove_temp_file(fastq_file)
+        
     def test_double_sort(self):
         """
         Test the double_sort function
@@ -353,6 +420,61 @@ class TestHumannUtilitiesFunctions(unittest.TestCase):
         # remove the temp gunzipped file
         utils.remove_temp_file(new_file)
 
+    def test_open_read_multimember_gzip(self):
+        """
+        Test the open_read function
+        Test a gzipped file with multiple members is read completely
+        """
+        
+        file_handle=open(cfg.small_fastq_file,"rt")
+        lines=file_handle.readlines()
+        file_handle.close()
+        
+        # create a temp file
+        file_out, gzip_fastq_file=tempfile.mkstemp(suffix=".gz")
+        os.close(file_out)
+        
+        # write the gzipped file in two members
+        half=len(lines)//2
+        with open(gzip_fastq_file,"wb") as file_handle_gzip:
+            file_handle_gzip.write(gzip.compress("".join(lines[:half]).encode("utf-8")))
+            file_handle_gzip.write(gzip.compress("".join(lines[half:]).encode("utf-8")))
+        
+        file_handle=utilities.open_read(gzip_fastq_file)
+        read_lines=file_handle.readlines()
+        file_handle.close()
+        
+        # remove the temp gzipped file
+        utils.remove_temp_file(gzip_fastq_file)
+        
+        self.assertEqual(read_lines, lines)
+        
+    def test_determine_file_format_fastq_bzip2(self):
+        """
+        Test the determine_file_format function with a bzip2 compressed fastq file
+        """
+        
+        file_handle=open(cfg.small_fastq_file,"rt")
+        
+        # create a temp file
+        file_out, bz2_fastq_file=tempfile.mkstemp(suffix=".bz2")
+        os.close(file_out)
+        
+        # write the compressed file
+        file_handle_bz2=bz2.open(bz2_fastq_file,"wt")
+        shutil.copyfileobj(file_handle, file_handle_bz2)
+        file_handle.close()
+        file_handle_bz2.close()
+        
+        format=utilities.determine_file_format(bz2_fastq_file)
+        total_reads=utilities.count_reads(bz2_fastq_file)
+        
+        # remove the temp compressed file
+        utils.remove_temp_file(bz2_fastq_file)
+        
+        self.assertEqual(format,"fastq.bz2")
+        self.assertEqual(total_reads,utilities.count_reads(cfg.small_fastq_file))
+
     def test_add_length_annotation(self):
         """
         Test the add_length_annotation function
@@ -462,3 +584,183 @@ class TestHumannUtilitiesFunctions(unittest.TestCase):
         self.assertEqual(expected_file_lines, actual_file_lines)
     
         
+
+    def test_check_outfiles_stage_manifest_match(self):
+        """
+        Test the check outfiles function with a stage manifest
+        Test the stage is bypassed on resume if the inputs and settings have not changed
+        """
+        
+        tempdir=utils.create_temp_folder("stage_manifest")
+        config.temp_dir=tempdir
+        config.resume=True
+        
+        outfile=os.path.join(tempdir,"output.tsv")
+        shutil.copy(cfg.small_fasta_file, outfile)
+        utilities.write_stage_manifest([outfile], [cfg.small_fastq_file], ["exe","--option"])
+        
+        bypass=utilities.check_outfiles([outfile], [cfg.small_fastq_file], ["exe","--option"])
+        
+        config.resume=False
+        utils.remove_temp_folder(tempdir)
+        
+        self.assertTrue(bypass)
+        
+    def test_check_outfiles_stage_manifest_settings_changed(self):
+        """
+        Test the check outfiles function with a stage manifest
+        Test the stage is not bypassed on resume if the settings have changed
+        Test the stale output file is removed
+        """
+        
+        tempdir=utils.create_temp_folder("stage_manifest")
+        config.temp_dir=tempdir
+        config.resume=True
+        
+        outfile=os.path.join(tempdir,"output.tsv")
+        shutil.copy(cfg.small_fasta_file, outfile)
+        utilities.write_stage_manifest([outfile], [cfg.small_fastq_file], ["exe","--option"])
+        
+        bypass=utilities.check_outfiles([outfile], [cfg.small_fastq_file], ["exe","--new-option"])
+        outfile_exists=os.path.isfile(outfile)
+        
+        config.resume=False
+        utils.remove_temp_folder(tempdir)
+        
+        self.assertFalse(bypass)
+        self.assertFalse(outfile_exists)
+        
+    def test_check_outfiles_stage_manifest_input_changed(self):
+        """
+        Test the check outfiles function with a stage manifest
+        Test the stage is not bypassed on resume if the input file has changed
+        """
+        
+        tempdir=utils.create_temp_folder("stage_manifest")
+        config.temp_dir=tempdir
+        config.resume=True
+        
+        outfile=os.path.join(tempdir,"output.tsv")
+        shutil.copy(cfg.small_fasta_file, outfile)
+        utilities.write_stage_manifest([outfile], [cfg.small_fastq_file], ["exe"])
+        
+        bypass=utilities.check_outfiles([outfile], [cfg.small_fasta_file], ["exe"])
+        
+        config.resume=False
+        utils.remove_temp_folder(tempdir)
+        
+        self.assertFalse(bypass)
+        
+    def test_file_fingerprint_large_file_edited_outside_blocks(self):
+        """
+        Test the file fingerprint function
+        Test a same-size edit to a large file outside of the blocks sampled changes the fingerprint
+        """
+        
+        tempdir=utils.create_temp_folder("fingerprint")
+        config.temp_dir=tempdir
+        large_file=os.path.join(tempdir,"reads.fastq")
+        block_size=config.stage_fingerprint_block_size
+        size=block_size*64
+        with open(large_file,"wb") as file_handle:
+            file_handle.write(b"A"*size)
+        fingerprint=utilities.file_fingerprint(large_file)
+        
+        # edit a byte between the first two blocks sampled with a later modification time
+        with open(large_file,"r+b") as file_handle:
+            file_handle.seek(block_size+10)
+            file_handle.write(b"C")
+        stat=os.stat(large_file)
+        os.utime(large_file, ns=(stat.st_atime_ns, stat.st_mtime_ns+1000000000))
+        new_fingerprint=utilities.file_fingerprint(large_file)
+        
+        utils.remove_temp_folder(tempdir)
+        
+        self.assertNotEqual(fingerprint,new_fingerprint)
+        
+    def test_check_outfiles_stage_manifest_input_rewritten(self):
+        """
+        Test the check outfiles function with a stage manifest
+        Test the stage is bypassed on resume if the input file is rewritten with the same contents
+        """
+        
+        tempdir=utils.create_temp_folder("stage_manifest")
+        config.temp_dir=tempdir
+        config.resume=True
+        
+        infile=os.path.join(tempdir,"unaligned.fa")
+        shutil.copy(cfg.small_fasta_file, infile)
+        stat=os.stat(infile)
+        os.utime(infile, ns=(stat.st_atime_ns, stat.st_mtime_ns-10*10**9))
+        outfile=os.path.join(tempdir,"output.tsv")
+        shutil.copy(cfg.small_fastq_file, outfile)
+        utilities.write_stage_manifest([outfile], [infile], ["exe"])
+        
+        # write the input again as a new file with the same contents
+        os.remove(infile)
+        shutil.copy(cfg.small_fasta_file, infile)
+        
+        bypass=utilities.check_outfiles([outfile], [infile], ["exe"])
+        outfile_exists=os.path.isfile(outfile)
+        
+        config.resume=False
+        utils.remove_temp_folder(tempdir)
+        
+        self.assertTrue(bypass)
+        self.assertTrue(outfile_exists)
+        
+    def test_check_outfiles_stage_manifest_missing(self):
+        """
+        Test the check outfiles function with a stage manifest
+        Test the stage is not bypassed on resume if the manifest does not exist
+        """
+        
+        tempdir=utils.create_temp_folder("stage_manifest")
+        config.temp_dir=tempdir
+        config.resume=True
+        
+        outfile=os.path.join(tempdir,"output.tsv")
+        shutil.copy(cfg.small_fasta_file, outfile)
+        
+        bypass=utilities.check_outfiles([outfile], [cfg.small_fastq_file], ["exe"])
+        
+        config.resume=False
+        utils.remove_temp_folder(tempdir)
+        
+        self.assertFalse(bypass)
+        
+    def test_performance_stage(self):
+        """
+        Test the performance stage function
+        Test the usage totals are the difference for the stage and the peak values are not
+        """
+        
+        prior_usage={"cpu_seconds": 1.5, "peak_rss_kb": 100, "max_rss_kb": 300, "bytes_read": 10}
+        usage={"cpu_seconds": 4.0, "peak_rss_kb": 200, "max_rss_kb": 300, "bytes_read": 25}
+        
+        performance=utilities.performance_stage("stage1", 3.0, prior_usage, usage, {"genes": 2})
+        
+        expected={"stage": "stage1", "wall_seconds": 3.0, "cpu_seconds": 2.5, "peak_rss_kb": 200,
+            "max_rss_kb": 300, "bytes_read": 15, "counts": {"genes": 2}}
+        
+        self.assertEqual(performance, expected)
+        
+    def test_wait_process_child_peak_memory(self):
+        """
+        Test the wait process function
+        Test the return code is set and the peak memory of the child is recorded for the stage
+        """
+        
+        utilities.reset_peak_memory()
+        self.assertEqual(utilities.resource_usage().get("child_peak_rss_kb",0), 0)
+        
+        process=subprocess.Popen([sys.executable, "-c", "import sys; sys.exit(3)"])
+        returncode=utilities.wait_process(process)
+        
+        self.assertEqual(returncode, 3)
+        self.assertEqual(process.returncode, 3)
+        self.assertTrue(utilities.resource_usage().get("child_peak_rss_kb",0) > 0)
+        
+        # the child peak is cleared for the next stage
+        utilities.reset_peak_memory()
+        self.assertEqual(utilities.resource_usage().get("child_peak_rss_kb",0), 0)
@@ -248,3 +248,101 @@ class TestFunctionalHumannEndtoEnd(unittest.TestCase):
 
         # remove the temp directory
         utils.remove_temp_folder(tempdir)
+
+    def test_humann_batch(self):
+        """
+        Test the standard humann flow on a batch of input files
+        Test the m8 and gene families inputs are run with a single process
+        """
+        
+        # create a temp directory for output
+        tempdir = utils.create_temp_folder("batch")
+        
+        # write the manifest with an output folder for each sample
+        manifest = os.path.join(tempdir, "manifest.tsv")
+        with open(manifest, "w") as file_handle:
+            file_handle.write("\t".join([cfg.demo_m8, os.path.join(tempdir, "m8")])+"\n")
+            file_handle.write("\t".join([cfg.demo_gene_families, os.path.join(tempdir, "gene_families")])+"\n")
+        
+        # run humann test
+        command = ["humann","--batch",manifest]
+        utils.run_humann(command)
+        
+        # check the output files are as expected
+        for expression, message in utils.check_output(cfg.expected_demo_output_files, os.path.join(tempdir, "m8")):
+            self.assertTrue(expression,message)
+        for expression, message in utils.check_output(cfg.expected_demo_output_files_genefamilies_input,
+            os.path.join(tempdir, "gene_families")):
+            self.assertTrue(expression,message)
+
+        # remove the temp directory
+        utils.remove_temp_folder(tempdir)
+
+    def test_humann_serve(self):
+        """
+        Test the standard humann flow on jobs added to the server queue folder
+        Test the server runs the jobs waiting and then stops
+        """
+        
+        # create a temp directory for output
+        tempdir = utils.create_temp_folder("serve")
+        
+        # write a job for each input file and the stop file
+        queue = os.path.join(tempdir, "queue")
+        os.mkdir(queue)
+        with open(os.path.join(queue, "sample1.job"), "w") as file_handle:
+            file_handle.write("\t".join([cfg.demo_m8, os.path.join(tempdir, "m8")])+"\n")
+        with open(os.path.join(queue, "sample2.job"), "w") as file_handle:
+            file_handle.write("\t".join([cfg.demo_gene_families, os.path.join(tempdir, "gene_families")])+"\n")
+        open(os.path.join(queue, "stop"), "w").close()
+        
+        # run humann test
+        command = ["humann","--serve",queue]
+        utils.run_humann(command)
+        
+        # check the jobs completed and the output files are as expected
+        self.assertTrue(os.path.isfile(os.path.join(queue, "sample1.done")))
+        self.assertTrue(os.path.isfile(os.path.join(queue, "sample2.done")))
+        for expression, message in utils.check_output(cfg.expected_demo_output_files, os.path.join(tempdir, "m8")):
+            self.assertTrue(expression,message)
+        for expression, message in utils.check_output(cfg.expected_demo_output_files_genefamilies_input,
+            os.path.join(tempdir, "gene_families")):
+            self.assertTrue(expression,message)
+
+        # remove the temp directory
+        utils.remove_temp_folder(tempdir)
+
+    def test_humann_serve_job_error(self):
+        """
+        Test the server continues with the next job when a job raises an error
+        Test the job with the error is marked as failed and the other job completes
+        """
+        
+        # create a temp directory for output
+        tempdir = utils.create_temp_folder("serve_error")
+        
+        # write a gene table that can not be decoded, a job for each table, and the stop file
+        queue = os.path.join(tempdir, "queue")
+        os.mkdir(queue)
+        bad_gene_families = os.path.join(tempdir, "bad_genefamilies.tsv")
+        with open(bad_gene_families, "wb") as file_handle:
+            file_handle.write(b"# Gene Family\tsample\nUniRef90_\xff\xfe\t1.0\n")
+        with open(os.path.join(queue, "sample1.job"), "w") as file_handle:
+            file_handle.write("\t".join([bad_gene_families, os.path.join(tempdir, "bad")])+"\n")
+        with open(os.path.join(queue, "sample2.job"), "w") as file_handle:
+            file_handle.write("\t".join([cfg.demo_gene_families, os.path.join(tempdir, "gene_families")])+"\n")
+        open(os.path.join(queue, "stop"), "w").close()
+        
+        # run humann test
+        command = ["humann","--serve",queue,"--input-format","genetable"]
+        utils.run_humann(command)
+        
+        # check the job with the error failed and the other job completed
+        self.assertTrue(os.path.isfile(os.path.join(queue, "sample1.failed")))
+        self.assertTrue(os.path.isfile(os.path.join(queue, "sample2.done")))
+        for expression, message in utils.check_output(cfg.expected_demo_output_files_genefamilies_input,
+            os.path.join(tempdir, "gene_families")):
+            self.assertTrue(expression,message)
+
+        # remove the temp directory
+        utils.remove_temp_folder(tempdir)
@@ -257,3 +257,61 @@ class TestFunctionalHumannTools(unittest.TestCase):
 
         # remove the temp file
         utils.remove_temp_file(new_file)
+        
+    def test_humann_batch(self):
+        """
+        Test running a set of samples at the same time with humann_batch
+        """
+        
+        # create a temp directory for output
+        tempdir = utils.create_temp_folder("humann_batch")
+        
+        # write the manifest with an output folder for each sample
+        manifest = os.path.join(tempdir, "manifest.tsv")
+        with open(manifest, "w") as file_handle:
+            file_handle.write("\t".join([cfg.demo_m8, os.path.join(tempdir, "m8")])+"\n")
+            file_handle.write("\t".join([cfg.demo_gene_families, os.path.join(tempdir, "gene_families")])+"\n")
+        
+        # run the command
+        utils.run_command(["humann_batch","--input",manifest,"--memory","16","--threads","2",
+                           "--poll-seconds","1"])
+        
+        # check the output files are as expected
+        for expression, message in utils.check_output(cfg.expected_demo_output_files, os.path.join(tempdir, "m8")):
+            self.assertTrue(expression,message)
+        for expression, message in utils.check_output(cfg.expected_demo_output_files_genefamilies_input,
+            os.path.join(tempdir, "gene_families")):
+            self.assertTrue(expression,message)
+
+        # remove the temp directory
+        utils.remove_temp_folder(tempdir)
+
+    def test_humann_reference_table(self):
+        """
+        Test creating a reference table from the demo chocophlan database
+        """
+        
+        # create a temp directory for output
+        tempdir = utils.create_temp_folder("reference_table")
+        reference_table = os.path.join(tempdir, "reference_table.tsv")
+        
+        # run the command with each of the demo database files
+        command = ["humann_reference_table","--output",reference_table]
+        for file in sorted(os.listdir(cfg.chocophlan_example_demo_folder)):
+            command+=["--input",os.path.join(cfg.chocophlan_example_demo_folder,file)]
+        utils.run_command(command)
+        
+        # check each reference is annotated with the gene and sgb
+        with open(reference_table) as file_handle:
+            marker=file_handle.readline().rstrip("\n")
+            rows=[line.rstrip("\n").split("\t") for line in file_handle if not line.startswith("#")]
+        
+        # remove the temp directory
+        utils.remove_temp_folder(tempdir)
+        
+        self.assertEqual(marker,"# humann_reference_table")
+        self.assertTrue(rows)
+        for reference, gene, length, bug in rows:
+            self.assertEqual(reference.split("|")[2],gene)
+            self.assertTrue(bug.startswith("SGB"))
+
@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+
+"""
+Run a set of samples with HUMAnN at the same time on a single node
+
+Samples are started while the memory reserved for the running samples fits in
+the memory available. Each sample reserves the largest memory estimate of the
+stages it has left to run (metaphlan, bowtie2, diamond, and the HUMAnN
+post-processing), so as a sample completes its diamond alignment the memory
+is released for another sample to start its prescreen.
+
+The memory estimates start from the defaults (or those provided) and are
+replaced by the memory measured (the MaxRSS of the sample and all of its
+children) once a stage has completed for any sample.
+
+The threads are split among the samples expected to run at the same time.
+
+To run:
+$ humann_batch --input manifest.tsv [--memory 64] [--threads 32] [HUMAnN options]
+
+The manifest is of the same format as for "humann --batch" with each line
+containing the input file and, optionally, the output folder and basename.
+All other options are passed to each of the HUMAnN runs.
+"""
+
+import sys
+import os
+import subprocess
+import threading
+import time
+import argparse
+
+from humann import utilities
+from humann.humann import read_batch_manifest
+
+# the stages in the order they are run with the estimated memory (in GB) for each
+STAGES=["metaphlan","bowtie2","diamond","humann"]
+DEFAULT_STAGE_MEMORY={"metaphlan": 6, "bowtie2": 4, "diamond": 18, "humann": 4}
+
+# the software run for each stage (as printed by HUMAnN when it starts to run)
+STAGE_SOFTWARE={"metaphlan": "metaphlan", "bowtie2-build": "bowtie2", "bowtie2": "bowtie2",
+    "diamond": "diamond"}
+# the message printed by HUMAnN once the alignments are complete
+POST_PROCESSING_MESSAGE="Computing gene families"
+
+# the margin added to the memory measured for a stage
+MEASURED_MEMORY_MARGIN=1.1
+
+SAMPLE_OUTPUT_NAME="_humann_batch.txt"
+
+class Sample(object):
+    """
+    A HUMAnN run for a single sample from the manifest
+    """
+
+    def __init__(self, input_file, output_folder, basename, stages):
+        self.input_file=input_file
+        self.output_folder=output_folder
+        self.basename=basename
+        self.stages=stages
+        self.stage=stages[0]
+        self.process=None
+        self.peak_memory={}
+        self.completed_stages=[]
+        self.returncode=None
+
+    def name(self):
+        """ Return the sample basename """
+        if self.basename:
+            return self.basename
+        return os.path.basename(self.input_file).split(".")[0]
+
+    def remaining_stages(self):
+        """ Return the stage running and those left to run """
+        return self.stages[self.stages.index(self.stage):]
+
+    def set_stage(self, stage):
+        """ Move the sample to a later stage """
+        if stage in self.stages and self.stages.index(stage) > self.stages.index(self.stage):
+            self.completed_stages.append(self.stage)
+            self.stage=stage
+
+    def command(self, threads, humann_args):
+        """ Return the humann command for the sample """
+        command=["humann","--input",self.input_file,"--output",self.output_folder,
+            "--threads",str(threads)]
+        if self.basename:
+            command+=["--output-basename",self.basename]
+        return command+humann_args
+
+    def start(self, threads, humann_args):
+        """ Start the humann run writing the stdout to a file in the output folder """
+        if not os.path.isdir(self.output_folder):
+            os.makedirs(self.output_folder)
+        command=self.command(threads, humann_args)
+        print("Starting sample " + self.name() + " with " + str(threads) + " threads: " + " ".join(command))
+        # run unbuffered so the stage messages are read as they are printed
+        try:
+            self.process=subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                universal_newlines=True, env=dict(os.environ, PYTHONUNBUFFERED="1"))
+        except EnvironmentError:
+            sys.exit("Unable to execute command: " + " ".join(command))
+        reader=threading.Thread(target=self.read_stdout)
+        reader.daemon=True
+        reader.start()
+
+    def read_stdout(self):
+        """ Write the stdout to the output file and track the stage running """
+        output_file=os.path.join(self.output_folder,self.name()+SAMPLE_OUTPUT_NAME)
+        with open(output_file,"w") as file_handle:
+            for line in self.process.stdout:
+                file_handle.write(line)
+                file_handle.flush()
+                self.set_stage(stage_from_stdout(line, self.stage))
+
+    def measure_memory(self):
+        """ Record the memory (in GB) used by the sample and its children for the current stage """
+        memory=process_tree_memory(self.process.pid)
+        if memory is not None:
+            self.peak_memory[self.stage]=max(self.peak_memory.get(self.stage,0),memory)
+
+    def poll(self):
+        """ Return True if the sample is still running """
+        self.returncode=self.process.poll()
+        if self.returncode is None:
+            return True
+        self.completed_stages.append(self.stage)
+        return False
+
+def stage_from_stdout(line, stage):
+    """
+    Return the stage based on the humann stdout
+    """
+
+    if line.startswith("Running "):
+        software=line.split()[1]
+        return STAGE_SOFTWARE.get(software,stage)
+    elif line.startswith(POST_PROCESSING_MESSAGE):
+        return "humann"
+
+    return stage
+
+def sample_stages(input_file, humann_args):
+    """
+    Return the stages that will be run for the input file and options
+    """
+
+    # only the post-processing is run for alignment files and gene tables
+    # (missing files are reported by the humann run)
+    if not os.path.isfile(input_file):
+        return ["humann"]
+
+    # the reads can be compressed with any of the formats humann decompresses
+    file_format=utilities.determine_file_format(input_file)
+    extension=utilities.compressed_extension(file_format)
+    if extension:
+        file_format=file_format[:-len(extension)]
+    if not file_format in ["fastq","fasta"]:
+        return ["humann"]
+
+    stages=list(STAGES)
+    if "--bypass-prescreen" in humann_args or "--taxonomic-profile" in humann_args:
+        stages.remove("metaphlan")
+    if "--bypass-nucleotide-search" in humann_args:
+        stages.remove("bowtie2")
+    if "--bypass-translated-search" in humann_args:
+        stages.remove("diamond")
+
+    return stages
+
+def process_tree_memory(pid):
+    """
+    Return the sum of the rss (in GB) for the process and all of its children
+    Return None if the memory can not be measured (so the estimates are kept)
+    """
+
+    # list all of the processes with the posix ps options (available on linux and mac os)
+    try:
+        stdout=subprocess.check_output(["ps","-A","-o","pid=","-o","ppid=","-o","rss="]).decode("utf-8")
+    except (EnvironmentError, subprocess.CalledProcessError):
+        return None
+
+    children={}
+    rss={}
+    for line in stdout.splitlines():
+        try:
+            process_pid, parent_pid, process_rss = [int(value) for value in line.split()]
+        except ValueError:
+            continue
+        children.setdefault(parent_pid,[]).append(process_pid)
+        rss[process_pid]=process_rss
+
+    if not pid in rss:
+        return None
+
+    # walk the tree of children from the process
+    total=0
+    pids=[pid]
+    while pids:
+        process_pid=pids.pop()
+        total+=rss.get(process_pid,0)
+        pids+=children.get(process_pid,[])
+
+    return total / 1024.0**2
+
+def total_memory():
+    """
+    Return the total memory (in GB) of the node
+    """
+
+    try:
+        with open("/proc/meminfo") as file_handle:
+            for line in file_handle:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) / 1024.0**2
+    except EnvironmentError:
+        pass
+
+    return None
+
+def update_stage_memory(stage_memory, measured_memory, samples):
+    """
+    Replace the memory estimates with the largest memory measured for the stages completed
+    """
+
+    for sample in samples:
+        for stage in sample.completed_stages:
+            if stage in sample.peak_memory:
+                measured_memory[stage]=max(measured_memory.get(stage,0),
+                    sample.peak_memory[stage]*MEASURED_MEMORY_MARGIN)
+
+    for stage, memory in measured_memory.items():
+        stage_memory[stage]=memory
+
+def reserved_memory(sample, stage_memory):
+    """
+    Return the memory to reserve for the sample (the most required by any stage left to run)
+    """
+
+    return max(stage_memory[stage] for stage in sample.remaining_stages())
+
+def sample_threads(threads, memory, max_samples, samples, stage_memory):
+    """
+    Return the threads for a sample based on the number of samples expected to run at the same time
+    """
+
+    largest_sample=max(reserved_memory(sample, stage_memory) for sample in samples)
+    concurrent=min(max_samples, len(samples), max(1, int(memory // largest_sample)))
+
+    return max(1, threads // max(1, concurrent))
+
+def run_samples(samples, memory, threads, max_samples, humann_args, stage_memory, poll_seconds):
+    """
+    Run the samples, starting each once the memory it requires is available
+    Return the samples that failed
+    """
+
+    waiting=list(samples)
+    running=[]
+    finished=[]
+    measured_memory={}
+    while waiting or running:
+        # check on the samples running
+        for sample in list(running):
+            if sample.poll():
+                sample.measure_memory()
+            else:
+                running.remove(sample)
+                finished.append(sample)
+                status="completed" if sample.returncode == 0 else "failed"
+                print("Sample " + sample.name() + " " + status)
+
+        update_stage_memory(stage_memory, measured_memory, running+finished)
+
+        # start samples while the memory is available
+        reserved=sum(reserved_memory(sample, stage_memory) for sample in running)
+        while waiting and len(running) < max_samples:
+            sample=waiting[0]
+            required=reserved_memory(sample, stage_memory)
+            if running and reserved+required > memory:
+                break
+            sample.start(sample_threads(threads, memory, max_samples, waiting, stage_memory), humann_args)
+            waiting.pop(0)
+            running.append(sample)
+            reserved+=required
+
+        time.sleep(poll_seconds)
+
+    return [sample for sample in finished if sample.returncode != 0]
+
+def parse_arguments(args):
+    """
+    Parse the arguments from the user
+    """
+
+    parser = argparse.ArgumentParser(
+        description= "Run a set of samples with HUMAnN at the same time on a single node\n" +
+            "Options not listed are passed to each HUMAnN run",
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument(
+        "-i","--input",
+        help="the manifest of samples (the format of the humann --batch option)\n",
+        required=True)
+    parser.add_argument(
+        "-o","--output",
+        help="the output folder for samples without a folder in the manifest\n")
+    parser.add_argument(
+        "--memory",
+        type=float,
+        help="the total memory (in GB) available for the samples\n[DEFAULT: the total memory of the node]")
+    parser.add_argument(
+        "--threads",
+        type=int,
+        help="the total threads available for the samples\n[DEFAULT: " + str(os.cpu_count()) + "]",
+        default=os.cpu_count())
+    parser.add_argument(
+        "--max-samples",
+        type=int,
+        help="the maximum number of samples to run at the same time\n[DEFAULT: the total threads]")
+    parser.add_argument(
+        "--stage-memory",
+        action="append",
+        help="the estimated memory (in GB) for a stage, provide as stage=memory\n" +
+            "stages: " + ",".join(STAGES) + "\n[DEFAULT: " +
+            ",".join(stage+"="+str(DEFAULT_STAGE_MEMORY[stage]) for stage in STAGES) + "]",
+        default=[])
+    parser.add_argument(
+        "--poll-seconds",
+        type=float,
+        help="the seconds between checks on the samples running\n[DEFAULT: 5]",
+        default=5)
+
+    return parser.parse_known_args(args)
+
+def main():
+    args, humann_args = parse_arguments(sys.argv[1:])
+
+    memory=args.memory or total_memory()
+    if not memory:
+        sys.exit("ERROR: Unable to determine the total memory. Please provide it with the --memory option.")
+
+    stage_memory=dict(DEFAULT_STAGE_MEMORY)
+    for setting in args.stage_memory:
+        try:
+            stage, value = setting.split("=")
+            if not stage in STAGES:
+                raise ValueError
+            stage_memory[stage]=float(value)
+        except ValueError:
+            sys.exit("ERROR: Please provide the stage memory as stage=memory with stages: " + ",".join(STAGES))
+
+    max_samples=args.max_samples or args.threads
+
+    samples=[Sample(input_file, output_folder, basename, sample_stages(input_file, humann_args))
+        for input_file, output_folder, basename in read_batch_manifest(args.input, args.output)]
+
+    failed=run_samples(samples, memory, args.threads, max_samples, humann_args, stage_memory, args.poll_seconds)
+
+    print("Samples completed: " + str(len(samples)-len(failed)) + " of " + str(len(samples)))
+    if failed:
+        sys.exit("ERROR: Unable to run samples: " + ", ".join(sample.input_file for sample in failed) +
+            "\nSee the " + SAMPLE_OUTPUT_NAME + " file in each output folder for more information.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+"""
+This script will build a reference table from the sequence headers of the
+nucleotide (ChocoPhlAn) and translated (UniRef) database fasta files
+
+The table is of the id mapping format (reference, gene, gene length, and bug)
+so each alignment to a reference in the table is annotated with a single lookup.
+References with SGB annotations are stored with the SGB as the bug as the species
+for each SGB is set from the taxonomic profile for each sample.
+
+To Run:
+$ humann_reference_table --input chocophlan.ffn --input uniref90.fasta --output reference_table.tsv
+
+Then provide the table to HUMAnN with the "--id-mapping reference_table.tsv" option.
+"""
+
+import argparse
+import sys
+
+from humann import config
+from humann import store
+from humann import utilities
+from humann.humann import parse_chocophlan_gene_indexes
+
+FASTA_ID_START=">"
+
+def reference_ids(fasta_file):
+    """ Yield the reference id from each sequence header """
+
+    try:
+        file_handle=utilities.open_read(fasta_file)
+    except EnvironmentError:
+        sys.exit("ERROR: Unable to read input fasta file: " + fasta_file)
+
+    for line in file_handle:
+        if line.startswith(FASTA_ID_START):
+            # the reference id is the first word of the header
+            yield line[1:].split()[0]
+
+    file_handle.close()
+
+def write_reference_table(fasta_files, output_file):
+    """ Write the gene, gene length, and bug for each reference in the fasta files """
+
+    alignments=store.Alignments()
+
+    try:
+        file_handle=open(output_file,"w")
+    except EnvironmentError:
+        sys.exit("ERROR: Unable to write to output file: " + output_file)
+
+    # the marker is used by humann to set the species for the sgb bugs
+    file_handle.write(config.reference_table_marker+"\n")
+    file_handle.write("# "+config.id_mapping_delimiter.join(["reference","gene","gene_length","bug"])+"\n")
+    total_references=0
+    for fasta_file in fasta_files:
+        for reference in reference_ids(fasta_file):
+            gene, length, bug = alignments.parse_reference_annotation(reference)
+            # store the sgb as the species is set for each sample
+            if ".t__SGB" in bug:
+                bug=bug.split(".t__")[-1]
+            file_handle.write(config.id_mapping_delimiter.join([reference,gene,str(length),bug])+"\n")
+            total_references+=1
+
+    file_handle.close()
+
+    return total_references
+
+def parse_arguments(args):
+    """
+    Parse the arguments from the user
+    """
+
+    parser = argparse.ArgumentParser(
+        description= "Create a reference table from the database fasta files\n",
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument(
+        "-i","--input",
+        help="the database fasta file (can be provided more than once)\n",
+        action="append",
+        required=True)
+    parser.add_argument(
+        "-o","--output",
+        help="the reference table to write\n",
+        required=True)
+    parser.add_argument(
+        "--annotation-gene-index",
+        help="the index of the gene in the sequence annotation\n[DEFAULT: "
+            + ",".join(str(i) for i in config.chocophlan_gene_indexes) + "]",
+        default=",".join(str(i) for i in config.chocophlan_gene_indexes))
+
+    return parser.parse_args()
+
+def main():
+    # Parse arguments from command line
+    args=parse_arguments(sys.argv)
+
+    config.chocophlan_gene_indexes=parse_chocophlan_gene_indexes(args.annotation_gene_index)
+
+    total_references=write_reference_table(args.input, args.output)
+
+    print("Reference table created with " + str(total_references) + " references: " + args.output)
+
+if __name__ == "__main__":
+    main()
@@ -29,6 +29,8 @@ import subprocess
 import re
 import shutil
 import tempfile
+import hashlib
+import json
 
 # try to import urllib.request.urlretrieve for python3
 try:
@@ -40,8 +42,10 @@ import tarfile
 import logging
 import traceback
 import gzip
+import bz2
 import shutil
 import threading
+import signal
 
 # try to import the python2 module Queue
 # if unable to import, try to import the python3 module queue
@@ -97,14 +101,10 @@ def determine_file_format(file):
     format=""
     
     # read in the first 2 lines of the file to check format  
-    gzipped=False
+    compression=compressed_extension(file)
     try:      
-        # check for gzipped files
-        if file.endswith(".gz"):
-            file_handle = gzip.open(file, "rt")
-            gzipped=True
-        else:
-            file_handle = open(file, "rt")
+        # check for compressed files
+        file_handle = open_read(file, parallel=False)
         
         first_line = file_handle.readline().rstrip()
         while re.search("^#",first_line):
@@ -164,8 +164,8 @@ def determine_file_format(file):
                     format="genetable"
     if not format:
         format="unknown"
-    elif gzipped:
-        format+=".gz"
+    elif compression:
+        format+=compression
                 
     message="File ( " + file + " ) is of format:  " + format
     if config.verbose:
@@ -175,13 +175,81 @@ def determine_file_format(file):
                 
     return format
 
+def compressed_extension(file):
+    """
+    Return the extension if the file is gzip or bzip2 compressed
+    """
+    
+    for extension in config.compressed_extensions:
+        if file.endswith(extension):
+            return extension
+        
+    return ""
+
+class DecompressedPipe(object):
+    """
+    A file handle to read the text from a command decompressing the file
+    """
+    
+    def __init__(self, command):
+        self.__command=command
+        self.__process=subprocess.Popen(command, stdout=subprocess.PIPE, universal_newlines=True)
+        self.__handle=self.__process.stdout
+        
+    def readline(self):
+        return self.__handle.readline()
+    
+    def read(self, *args):
+        return self.__handle.read(*args)
+    
+    def __iter__(self):
+        return iter(self.__handle)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        
+    def close(self):
+        """
+        Close the pipe, checking the command completed (or stopped as the pipe was closed early)
+        """
+        self.__handle.close()
+        returncode=wait_process(self.__process)
+        if returncode not in [0, -signal.SIGPIPE]:
+            message="Error executing: " + " ".join(self.__command)
+            logger.critical(message)
+            raise EnvironmentError(message)
+
+def open_read(file, parallel=True):
+    """
+    Open the file to read as text, decompressing gzip (including multi-member) and bzip2 files
+    If parallel, decompress with the first of the parallel software installed
+    """
+    
+    compression=compressed_extension(file)
+    
+    if compression and parallel:
+        for command in config.parallel_decompression_commands[compression]:
+            if find_exe_in_path(command[0]):
+                logger.debug("Decompressing with " + command[0] + " : " + file)
+                return DecompressedPipe(command+[file])
+    
+    if compression == ".gz":
+        return gzip.open(file, "rt")
+    elif compression == ".bz2":
+        return bz2.open(file, "rt")
+    
+    return open(file, "rt")
+
 def space_in_identifier(file):
     """ Check if there are spaces in the fasta/fastq identifier by
     checking the first line of the file """
     
     space_found = False
     try:
-        file_handle = open(file, "rt")
+        file_handle = open_read(file, parallel=False)
         line = file_handle.readline()
         if " " in line:
             space_found = True
@@ -198,7 +266,7 @@ def remove_spaces_from_file(file):
     new_file=unnamed_temp_file()
     
     try:
-        file_handle_read = open(file, "rt")
+        file_handle_read = open_read(file)
         file_handle_write = open(new_file, "wt")
         for line in file_handle_read:
             file_handle_write.write(line.replace(" ",""))
@@ -210,51 +278,32 @@ def remove_spaces_from_file(file):
         
     return new_file
 
-def bam_to_sam(bam_file):
-    """
-    Convert from a bam to sam file
-    """
-    
-    # create a unnamed temp file
-    new_file=unnamed_temp_file()
-
-    exe="samtools"
-    args=["view","-h",bam_file,"-o",new_file]
-    
-    message="Converting bam file to sam format ..."
-    print(message)
-    logger.info(message)
-    
-    execute_command(exe, args, [bam_file], [new_file])
-    
-    return new_file
-
 def gunzip_file(gzip_file):
     """
-    Return a new copy of the file that is not gzipped
+    Return a new copy of the file that is not compressed (gzip or bzip2)
     The new file will be placed in the unnamed temp folder
     """
     
-    message="Decompressing gzipped file ..."
+    message="Decompressing file ..."
     print(message+"\n")
     logger.info(message)    
     
+    # create a unnamed temp file
+    new_file=unnamed_temp_file()
+    
     try:
-        file_handle_gzip=gzip.open(gzip_file,"rt")
-        
-        # create a unnamed temp file
-        new_file=unnamed_temp_file()
-        
-        # write the gunzipped file
-        file_handle=open(new_file,"wt")
-        shutil.copyfileobj(file_handle_gzip, file_handle)
-        
-    except EnvironmentError:
+        # files without the extension are read as gzipped
+        if compressed_extension(gzip_file):
+            file_handle_gzip=open_read(gzip_file)
+        else:
+            file_handle_gzip=gzip.open(gzip_file,"rt")
+        with file_handle_gzip:
+            # write the decompressed file
+            with open(new_file,"wt") as file_handle:
+                shutil.copyfileobj(file_handle_gzip, file_handle)
+    except (EnvironmentError, EOFError):
         print("Critical Error: Unable to unzip input file: " + gzip_file)
         new_file=""
-    finally:
-        file_handle.close()
-        file_handle_gzip.close()
         
     return new_file
 
@@ -548,9 +597,134 @@ def remove_file(file):
         message="Unable to remove file"
         logger.error(message)
 
-def check_outfiles(outfiles):
+def stage_fingerprint_cache():
+    """
+    Return the cache of the file fingerprints, read from the temp folder if available
+    """
+    
+    cache_file=os.path.join(config.temp_dir, config.stage_fingerprint_cache_name)
+    if config.stage_fingerprint_cache_file != cache_file:
+        config.stage_fingerprint_cache_file=cache_file
+        try:
+            with open(cache_file,"rt") as file_handle:
+                config.stage_fingerprint_cache=json.load(file_handle)
+        except (EnvironmentError, ValueError):
+            config.stage_fingerprint_cache={}
+            
+    return config.stage_fingerprint_cache
+
+def write_stage_fingerprint_cache():
+    """
+    Write the cache of the file fingerprints to the temp folder
+    """
+    
+    if not config.temp_dir or not os.path.isdir(config.temp_dir):
+        return
+    
+    try:
+        with open(config.stage_fingerprint_cache_file,"wt") as file_handle:
+            json.dump(config.stage_fingerprint_cache, file_handle)
+    except EnvironmentError:
+        logger.warning("Unable to write stage fingerprint cache: " + config.stage_fingerprint_cache_file)
+
+def file_fingerprint(file):
+    """
+    Return a fingerprint of the file contents (the size and the checksum of the full file)
+    The fingerprints are cached by the size, modification time, and inode of the file so
+    the multi-GB inputs and databases are only read again if they have been changed,
+    while a file rewritten with the same contents has the same fingerprint
+    """
+    
+    try:
+        stat=os.stat(file)
+    except EnvironmentError:
+        return ""
+    
+    cache=stage_fingerprint_cache()
+    path=os.path.abspath(file)
+    cache_key=":".join([str(stat.st_size),str(stat.st_mtime_ns),str(stat.st_ino)])
+    if path in cache and cache[path][0] == cache_key:
+        return cache[path][1]
+    
+    checksum=hashlib.md5()
+    try:
+        with open(file,"rb") as file_handle:
+            for block in iter(lambda: file_handle.read(config.stage_fingerprint_block_size), b""):
+                checksum.update(block)
+    except EnvironmentError:
+        return ""
+    fingerprint=str(stat.st_size)+":"+checksum.hexdigest()
+    
+    # do not cache files modified just now as they could be changed again
+    # without a change to the modification time
+    if time.time() - stat.st_mtime > config.stage_fingerprint_cache_seconds:
+        cache[path]=[cache_key, fingerprint]
+        write_stage_fingerprint_cache()
+        
+    return fingerprint
+
+def stage_manifest_file(outfiles):
+    """
+    Return the name of the manifest file for the stage that creates the outfiles
+    """
+    
+    return os.path.join(config.temp_dir, os.path.basename(outfiles[0])+config.stage_manifest_extension)
+
+def stage_checksum(infiles, stage_settings):
+    """
+    Return a checksum of the input file contents and the settings for a stage
+    """
+    
+    data=[file_fingerprint(file) for file in infiles]+[str(item) for item in stage_settings]
+    
+    return hashlib.md5("\n".join(data).encode("utf-8")).hexdigest()
+
+def write_stage_manifest(outfiles, infiles, stage_settings):
+    """
+    Record the inputs, settings, and outputs of a completed stage
+    """
+    
+    manifest={"checksum" : stage_checksum(infiles, stage_settings),
+        "settings" : [str(item) for item in stage_settings],
+        "outputs" : dict((os.path.basename(file), file_fingerprint(file)) for file in outfiles)}
+    
+    manifest_file=stage_manifest_file(outfiles)
+    try:
+        with open(manifest_file,"wt") as file_handle:
+            json.dump(manifest, file_handle, indent=1, sort_keys=True)
+        logger.debug("Write stage manifest: " + manifest_file)
+    except EnvironmentError:
+        logger.warning("Unable to write stage manifest: " + manifest_file)
+        
+def stage_manifest_matches(outfiles, infiles, stage_settings):
+    """
+    Check the manifest for the stage matches the current inputs, settings, and outputs
+    """
+    
+    manifest_file=stage_manifest_file(outfiles)
+    try:
+        with open(manifest_file,"rt") as file_handle:
+            manifest=json.load(file_handle)
+    except (EnvironmentError, ValueError):
+        logger.info("Unable to read stage manifest: " + manifest_file)
+        return False
+    
+    if manifest.get("checksum") != stage_checksum(infiles, stage_settings):
+        logger.info("Stage inputs or settings have changed since the manifest was written: " + manifest_file)
+        return False
+    
+    outputs=manifest.get("outputs",{})
+    for file in outfiles:
+        if outputs.get(os.path.basename(file)) != file_fingerprint(file):
+            logger.info("Stage output file has changed since the manifest was written: " + file)
+            return False
+        
+    return True
+
+def check_outfiles(outfiles, infiles=None, stage_settings=None):
     """
     If outfiles already_exist, then remove or bypass
+    If stage settings are provided, only bypass if the stage manifest matches
     """
     bypass=[]
     for file in outfiles:
@@ -562,10 +736,16 @@ def check_outfiles(outfiles):
         else:
             bypass.append(False)
 
+    if not False in bypass and bypass and stage_settings is not None:
+        if not stage_manifest_matches(outfiles, infiles or [], stage_settings):
+            bypass.append(False)
+
     if False in bypass or not bypass:
         # remove any existing files
         for file in outfiles:
             remove_file(file)
+        if outfiles and stage_settings is not None:
+            remove_file(stage_manifest_file(outfiles))
         return False
     else:
         return True
@@ -653,9 +833,10 @@ def execute_command_args_convert(args):
 
 
 def execute_command(exe, args, infiles, outfiles, stdout_file=None, 
-        stdin_file=None, raise_error=None, stderr_file=None):
+        stdin_file=None, raise_error=None, stderr_file=None, stage_settings=None):
     """
     Execute third party software or shell command with files
+    If stage settings are provided, record a manifest of the inputs and settings for resume
     """
 	
     if exe == sys.executable:
@@ -694,7 +875,7 @@ def execute_command(exe, args, infiles, outfiles, stdout_file=None,
         file_exists_readable(file, raise_IOError=raise_error)
         
     # check if outfiles already exist
-    bypass=check_outfiles(outfiles)
+    bypass=check_outfiles(outfiles, infiles, stage_settings)
 
     # convert numbers to strings
     args=[str(i) for i in args]
@@ -755,11 +936,17 @@ def execute_command(exe, args, infiles, outfiles, stdout_file=None,
 	
         try:
             if stdin_file or stdout_file or stderr_file:
-                # run command, raise CalledProcessError if return code is non-zero
-                p = subprocess.check_call(cmd, stdin=stdin, stdout=stdout, stderr=stderr)
+                process=subprocess.Popen(cmd, stdin=stdin, stdout=stdout, stderr=stderr)
+                p_out=None
             else:
-                p_out = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-                logger.debug(p_out)            
+                process=subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                p_out=process.stdout.read()
+                process.stdout.close()
+            # raise CalledProcessError if return code is non-zero
+            if wait_process(process) != 0:
+                raise subprocess.CalledProcessError(process.returncode, cmd, output=p_out)
+            if p_out is not None:
+                logger.debug(p_out)
         except (EnvironmentError, subprocess.CalledProcessError) as e:
             message="Error executing: " + " ".join(cmd) + "\n"
             if hasattr(e, 'output') and e.output:
@@ -775,6 +962,10 @@ def execute_command(exe, args, infiles, outfiles, stdout_file=None,
         # check that the output files exist and are readable
         for file in outfiles:
             file_exists_readable(file, raise_IOError=raise_error)
+            
+        # record the manifest for the stage
+        if outfiles and stage_settings is not None:
+            write_stage_manifest(outfiles, infiles, stage_settings)
     
     else:
         if config.verbose:
@@ -782,6 +973,83 @@ def execute_command(exe, args, infiles, outfiles, stdout_file=None,
         else:
             print("Bypass\n")
 
+def execute_command_stream(exe, args, infiles, stderr_file=None):
+    """
+    Execute third party software yielding the lines written to stdout
+    The return code is checked once all of the lines have been read
+    """
+    
+    # check that the executable can be found
+    exe_path=return_exe_path(exe)
+    if not exe_path:
+        message="Can not find executable " + exe
+        logger.critical(message)
+        sys.exit("CRITICAL ERROR: " + message)
+    exe=os.path.join(exe_path,exe)
+    logger.debug("Using software: " + exe)
+    
+    # check that the input files exist and are readable
+    for file in infiles:
+        file_exists_readable(file)
+        
+    # convert numbers to strings
+    args=[str(i) for i in args]
+    cmd=[exe]+args
+
+    message=" ".join(cmd)
+    logger.info("Execute command: "+ message)
+    if config.verbose:
+        print("\n"+message+"\n")
+    
+    stderr=None
+    if stderr_file:
+        try:
+            stderr=open(stderr_file,"w")
+        except EnvironmentError:
+            message="Unable to open file: " + stderr_file
+            logger.critical(message)
+            sys.exit("CRITICAL ERROR: " + message)
+            
+    try:
+        process=subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr, universal_newlines=True)
+    except EnvironmentError:
+        message="Error executing: " + " ".join(cmd) + "\n"
+        logger.critical(message)
+        logger.critical("TRACEBACK: \n" + traceback.format_exc())
+        sys.exit("CRITICAL ERROR: " + message)
+        
+    for line in process.stdout:
+        yield line
+        
+    process.stdout.close()
+    returncode=wait_process(process)
+    
+    if stderr:
+        stderr.close()
+        
+    if returncode != 0:
+        message="Error executing: " + " ".join(cmd) + "\n"
+        if stderr_file:
+            with open(stderr_file) as file_handle:
+                message+="\nError message returned from " + os.path.basename(exe) + " :\n" + file_handle.read()
+        logger.critical(message)
+        log_system_status()
+        sys.exit("CRITICAL ERROR: " + message)
+    elif stderr_file:
+        with open(stderr_file) as file_handle:
+            logger.debug(file_handle.read())
+
+def tee_lines(lines, file):
+    """
+    Yield the lines while also writing them to the file
+    """
+    
+    file_handle=open(file,"w")
+    for line in lines:
+        file_handle.write(line)
+        yield line
+    file_handle.close()
+    
 def fasta_or_fastq(file):
     """
     Check to see if a file is of fasta or fastq format
@@ -805,7 +1073,7 @@ def fasta_or_fastq(file):
     file_exists_readable(file)
 	
     # read in first 2 lines of file to check format
-    file_handle = open(file, "rt")
+    file_handle = open_read(file, parallel=False)
 	
     first_line = file_handle.readline()
     second_line = file_handle.readline()
@@ -822,12 +1090,144 @@ def fasta_or_fastq(file):
 
     return format
 
+def sequence_records(file_handle, file_format):
+    """
+    Yield the header, sequence, and full record for each read in the fasta or fastq file
+    The sequences of fasta records split across lines are joined
+    """
+
+    if file_format == "fastq":
+        while True:
+            header=file_handle.readline()
+            if not header:
+                break
+            if not header.strip():
+                continue
+            sequence=file_handle.readline()
+            separator=file_handle.readline()
+            quality=file_handle.readline()
+            if not quality.endswith("\n"):
+                quality+="\n"
+            yield header, sequence.rstrip(), header+sequence+separator+quality
+    else:
+        header=None
+        sequence_lines=[]
+        for line in file_handle:
+            if line.startswith(">"):
+                if header is not None:
+                    sequence="".join(sequence_lines)
+                    yield header, sequence, header+sequence+"\n"
+                header=line
+                sequence_lines=[]
+            else:
+                sequence_lines.append(line.rstrip())
+        if header is not None:
+            sequence="".join(sequence_lines)
+            yield header, sequence, header+sequence+"\n"
+
+def unique_sequence_records(records, file_handle_write, query_ids, copies, memory_budget=None):
+    """
+    Write the first record for each sequence, counting the copies of the sequences duplicated
+    Return the total reads and the total unique reads
+    Return None if the memory budget is exceeded
+    """
+
+    # the reads are found by the digest of their sequences
+    sequence_reads={}
+    total_reads=0
+    for header, sequence, record in records:
+        total_reads+=1
+        digest=hashlib.md5(sequence.encode("utf-8")).digest()
+        name_id=sequence_reads.get(digest)
+        if name_id is None:
+            # the read is stored with the first word of its header (as for the alignments)
+            sequence_reads[digest]=query_ids.get_id(header[1:].split()[0])
+            file_handle_write.write(record)
+            if (memory_budget is not None and len(sequence_reads) % config.memory_budget_check_additions == 0
+                and current_memory() > memory_budget):
+                return None
+        else:
+            copies[name_id]=copies.get(name_id,1)+1
+
+    return total_reads, len(sequence_reads)
+
+def collapse_duplicate_reads(file, query_ids, minimize_memory_use=False, memory_budget=None):
+    """
+    Write a file of the reads with the duplicate sequences collapsed
+    Each sequence is written once with the first read (including its qualities)
+    and the copies of the sequence are set as the weight of the read in the query ids
+    The digests of the sequences are stored in memory unless minimizing memory use
+    (or the memory budget is exceeded) then the reads are first split into temp files
+    by digest so the digests of only one of the temp files are stored at a time
+    Return the file of the collapsed reads, the total reads, and the total unique reads
+    """
+
+    file_format=fasta_or_fastq(file)
+    extension=config.fasta_extension
+    if file_format == "fastq":
+        extension=config.fastq_extension
+    collapsed_file=name_temp_file(config.collapsed_reads_name_no_ext + extension)
+
+    copies={}
+    counts=None
+    if not minimize_memory_use:
+        file_handle_read=open_read(file)
+        try:
+            file_handle_write=open(collapsed_file,"w")
+        except EnvironmentError:
+            sys.exit("CRITICAL ERROR: Unable to write file: " + collapsed_file)
+        
+        counts=unique_sequence_records(sequence_records(file_handle_read, file_format),
+            file_handle_write, query_ids, copies, memory_budget)
+        
+        file_handle_read.close()
+        file_handle_write.close()
+        
+        if counts is None:
+            logger.info("Memory budget exceeded, collapsing the duplicate reads split into temp files")
+            copies={}
+
+    if counts is None:
+        # split the reads by the digest of their sequences so copies are in the same file
+        partition_files=[unnamed_temp_file("collapse_reads_")
+            for partition in range(config.collapse_duplicate_reads_partitions)]
+        partition_file_handles=[open(partition_file,"w") for partition_file in partition_files]
+        file_handle_read=open_read(file)
+        for header, sequence, record in sequence_records(file_handle_read, file_format):
+            digest=hashlib.md5(sequence.encode("utf-8")).digest()
+            partition_file_handles[bytearray(digest)[0] % len(partition_files)].write(record)
+        file_handle_read.close()
+        for file_handle in partition_file_handles:
+            file_handle.close()
+        
+        try:
+            file_handle_write=open(collapsed_file,"w")
+        except EnvironmentError:
+            sys.exit("CRITICAL ERROR: Unable to write file: " + collapsed_file)
+        
+        total_reads=0
+        unique_reads=0
+        for partition_file in partition_files:
+            with open(partition_file) as file_handle_read:
+                partition_reads, partition_unique_reads = unique_sequence_records(
+                    sequence_records(file_handle_read, file_format), file_handle_write, query_ids, copies)
+            total_reads+=partition_reads
+            unique_reads+=partition_unique_reads
+            remove_file(partition_file)
+        file_handle_write.close()
+        counts=(total_reads, unique_reads)
+
+    for name_id, total in copies.items():
+        query_ids.set_weight(name_id, total)
+
+    return collapsed_file, counts[0], counts[1]
+
 def count_reads(file):
     """
     Count the total number of reads in a file
     """
 
-    file_handle_read=open(file,"rt")
+    file_handle_read=open_read(file)
 
     line=file_handle_read.readline()
 
@@ -963,7 +1363,7 @@ def fastq_to_fasta(file, apply_pick_frames=None, length_annotation=None):
     # check file exists
     file_exists_readable(file)
 	
-    file_handle_read = open(file, "rt")
+    file_handle_read = open_read(file)
 	
     line = file_handle_read.readline()
 	
@@ -1021,7 +1421,7 @@ def pick_frames_from_fasta(file, length_annotation=None):
     # check file exists
     file_exists_readable(file)
     
-    file_handle_read = open(file, "rt")
+    file_handle_read = open_read(file)
     
     line = file_handle_read.readline()
     
@@ -1069,7 +1469,7 @@ def length_annotate_fasta(file):
     # check file exists
     file_exists_readable(file)
     
-    file_handle_read = open(file, "rt")
+    file_handle_read = open_read(file)
     
     line = file_handle_read.readline()
     
@@ -1186,6 +1586,158 @@ def byte_to_kilobyte(byte):
     
     return byte / 1024.0
 
+# lock for the peak memory of child processes run from the worker threads
+performance_lock=threading.Lock()
+
+def rss_scale():
+    """
+    Return the scale to convert the max resident set size from rusage to kilobytes
+    """
+    
+    # the max resident set size is reported in bytes on mac os
+    if sys.platform == "darwin":
+        return 1024
+    return 1
+
+def wait_process(process):
+    """
+    Wait for the process to complete and return its return code
+    Record the peak memory of the process for the performance report of the stage
+    """
+    
+    try:
+        pid, status, usage = os.wait4(process.pid, 0)
+    except (AttributeError, OSError):
+        return process.wait()
+    
+    if os.WIFSIGNALED(status):
+        process.returncode=-os.WTERMSIG(status)
+    else:
+        process.returncode=os.WEXITSTATUS(status)
+        
+    with performance_lock:
+        config.performance_child_peak_rss_kb=max(config.performance_child_peak_rss_kb,
+            usage.ru_maxrss // rss_scale())
+        
+    return process.returncode
+
+def reset_peak_memory():
+    """
+    Reset the peak memory of this process and its child processes at the start of a stage
+    The peak of this process can only be reset on linux (with /proc/self/clear_refs)
+    """
+    
+    with performance_lock:
+        config.performance_child_peak_rss_kb=0
+    
+    try:
+        with open("/proc/self/clear_refs","w") as file_handle:
+            file_handle.write("5")
+        config.performance_peak_reset=True
+    except EnvironmentError:
+        config.performance_peak_reset=False
+
+def resource_usage():
+    """
+    Return the cpu, memory, and io usage of this process and its child processes
+    The max memory values are the maximum resident set sizes (in kilobytes) for the whole run
+    The peak memory values are the maximum resident set sizes (in kilobytes) since
+    the last call to reset_peak_memory, the peak for this process is only included on linux
+    """
+    
+    try:
+        import resource
+    except ImportError:
+        return {}
+    
+    self_usage=resource.getrusage(resource.RUSAGE_SELF)
+    child_usage=resource.getrusage(resource.RUSAGE_CHILDREN)
+    
+    usage={"cpu_seconds": self_usage.ru_utime+self_usage.ru_stime,
+        "max_rss_kb": self_usage.ru_maxrss // rss_scale(),
+        "child_cpu_seconds": child_usage.ru_utime+child_usage.ru_stime,
+        "child_max_rss_kb": child_usage.ru_maxrss // rss_scale(),
+        "child_peak_rss_kb": config.performance_child_peak_rss_kb,
+        "block_bytes_read": (self_usage.ru_inblock+child_usage.ru_inblock)*512,
+        "block_bytes_written": (self_usage.ru_oublock+child_usage.ru_oublock)*512}
+    
+    # add the bytes read and written by this process, if available
+    try:
+        with open("/proc/self/io") as file_handle:
+            for line in file_handle:
+                name, value = line.split(":")
+                if name == "rchar":
+                    usage["bytes_read"]=int(value)
+                elif name == "wchar":
+                    usage["bytes_written"]=int(value)
+    except (EnvironmentError, ValueError):
+        pass
+    
+    # add the peak resident set size of this process since the reset, if available
+    if config.performance_peak_reset:
+        try:
+            with open("/proc/self/status") as file_handle:
+                for line in file_handle:
+                    if line.startswith("VmHWM:"):
+                        usage["peak_rss_kb"]=int(line.split()[1])
+        except (EnvironmentError, ValueError, IndexError):
+            pass
+        
+    return usage
+
+def current_memory():
+    """
+    Return the resident set size (in GB) of this process
+    Use the max resident set size if the current size is not available
+    """
+    
+    try:
+        with open("/proc/self/statm") as file_handle:
+            pages=int(file_handle.readline().split()[1])
+        return pages*os.sysconf("SC_PAGE_SIZE") / 1024.0**3
+    except (EnvironmentError, ValueError, IndexError, AttributeError):
+        pass
+    
+    return resource_usage().get("max_rss_kb",0) / 1024.0**2
+
+def performance_stage(stage, wall_seconds, prior_usage, usage, counts=None):
+    """
+    Return the performance of a stage from the resource usage before and after
+    The peak and max memory values are the maximums at the end of the stage
+    """
+    
+    performance={"stage": stage, "wall_seconds": round(wall_seconds,3)}
+    for name, value in usage.items():
+        if "peak" in name or "max" in name:
+            performance[name]=value
+        elif isinstance(value, float):
+            performance[name]=round(value-prior_usage.get(name,0),3)
+        else:
+            performance[name]=value-prior_usage.get(name,0)
+    if counts:
+        performance["counts"]=counts
+        
+    return performance
+
+def write_performance_report(report_file, version, input_file, stages):
+    """
+    Write the json report of the performance of each stage
+    """
+    
+    report={"version": version,
+        "input": input_file,
+        "threads": config.threads,
+        "memory_use": config.memory_use,
+        "total_wall_seconds": round(sum(stage["wall_seconds"] for stage in stages),3),
+        "stages": stages}
+    
+    try:
+        with open(report_file,"w") as file_handle:
+            json.dump(report, file_handle, indent=1)
+        logger.info("Performance report written: " + report_file)
+    except EnvironmentError:
+        logger.error("Unable to write performance report: " + report_file)
+
 def log_system_status():
     """
     Print the status of the system
@@ -1318,7 +1870,7 @@ def get_filtered_translated_alignments(alignment_file_tsv, alignments, apply_fil
     # read through the alignment file to identify ids
     # that correspond to aligned reads
     # all translated alignment files will be of the tabulated blast format
-    file_handle=open(alignment_file_tsv,"rt")
+    file_handle=open_read(alignment_file_tsv)
     line=file_handle.readline()
 
     log_evalue=False
@@ -1374,8 +1926,22 @@ def get_filtered_translated_alignments(alignment_file_tsv, alignments, apply_fil
                 query_start_index=0
                 query_stop_index=0
                 
-            # check for query length annotation
-            queryid, query_length = get_length_annotation(queryid)
+            # use the query length column if included (as written by diamond)
+            # only if it is a number that agrees with the length annotation (if any)
+            # otherwise check for query length annotation
+            query_length=None
+            if len(alignment_info) > config.blast_query_length_index:
+                query_length_column=alignment_info[config.blast_query_length_index].rstrip()
+                annotation=config.query_length_annotation_delimiter+query_length_column
+                if query_length_column.isdigit():
+                    if queryid.endswith(annotation):
+                        # remove the annotation from reads written after the nucleotide search
+                        queryid=queryid[:-len(annotation)]
+                        query_length=int(query_length_column)
+                    elif get_length_annotation(queryid)[0] == queryid:
+                        query_length=int(query_length_column)
+            if query_length is None:
+                queryid, query_length = get_length_annotation(queryid)
                 
             # try to get the start and end positions for the subject
             try:
@@ -716,10 +716,12 @@ setuptools.setup(
             'humann_unpack_pathways = humann.tools.merge_abundance:main',
             'humann_test = humann.tests.humann_test:main',
             'humann_build_custom_database = humann.tools.build_custom_database:main',
+            'humann_reference_table = humann.tools.reference_table:main',
             'humann_genefamilies_genus_level = humann.tools.genefamilies_genus_level:main',
             'humann_split_stratified_table = humann.tools.split_stratified_table:main',
             'humann_barplot = humann.tools.humann_barplot:main',
             'humann_benchmark = humann.tools.humann_benchmark:main',
+            'humann_batch = humann.tools.humann_batch:main',
             'humann_expand_cluster = humann.tools.expand_cluster:main'
         ]},
     test_suite= 'humann.tests.humann_test.unittests_suite_only',